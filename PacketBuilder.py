@@ -12,6 +12,8 @@ import socket
 import json
 import time
 
+from Transport import FramedSocket
+
 class dataEntry:
     '''
     dataEntry represents a single timestamped datum used for both analog and digital signals
@@ -19,7 +21,13 @@ class dataEntry:
     n.b. pass an integer as "val" if you want to send a binary digital signal (for digital inputs/outputs)
     '''
     allowed_chTypes = ["ao", "ai", "do", "di"]
-    
+    # set only while tracing (see Tracer.py); never sent in the packet
+    trace_id = None # request id of this command, or of the command that this entry answers
+    trace_time = None # when the entry was placed on the master's queue (or when its answer arrived)
+    edge = False # set by the master on a di transition that the RPi's edge capture timed (see the `d` packet below)
+    group = None # ao entries with the same group change their outputs together (the `d` packet's "ao_groups" below)
+    unchanged = False # set by the master on a reading that the RPi left out because it did not change (`val` is None)
+
     def __init__(self, chType: str, gpio_str: str, val: Union[float, int], time: float = None):
         # chType must be one of ["ao", "ai", "do", "di"]
         # gpio_str is like "GPIO26" or one of the formats specified by https://gpiozero.readthedocs.io/en/stable/recipes.html#pin-numbering
@@ -149,21 +157,51 @@ class DataPacketModel:
     msg_type is a single character that denotes the type of packet being sent/received
     `d` means that this packet contains data meant for the recipient
     `w` means that this packet is simply a write request (i.e. contains no data)
+    `h` means heartbeat. The RPi answers right away with an empty `h` packet carrying the same timestamp, without
+        touching its command queue (see master_display_side/HeartbeatMonitor.py)
+    `c` means channel map. Each data entry names one configured channel (chType and gpio_str; `val` is unused) so that
+        the RPi can create all of its drivers up front. The RPi answers with a `c` packet listing the provisioned entries.
+        `info` {"di_edge_capture": N} also turns on di edge capture with an N-edge buffer per pin,
+        {"di_counters": {gpio_str: gate_ms}} puts those di channels in pulse counter mode (their `val` becomes a dict),
+        {"ao_modules": {gpio_str: "T_CLICK_2"}} picks the driver of those ao channels (T_CLICK_1 otherwise), and
+        {"ai_acquisition": {"rate_hz", "buffer", "channels": {gpio_str: filter}}} samples those ai channels in the
+        background and answers their reads from the filtered cache (see RPI_side/acquisition.py), and
+        {"report_by_exception": {gpio_str: {"deadband", "max_silence_ms"}}} leaves unchanged readings of those input
+        channels out of the replies (see RPI_side/report_by_exception.py)
+    `q` means query. The request is in `info` (e.g. {"request": "timing"}) and the RPi answers with a `q` packet whose
+        `info` holds the result. `info` is packed with json.dumps like the rest of the packet, so keep it to json types
+    A `d` packet whose `info` has a "trace" key asks the RPi to time its handling of that packet; the spans come back in
+        the reply's `info` (see Tracer.py). Encoding and sending a reply can only be timed once it is gone, so those
+        spans ride along in "trace_late" ([packet id, name, start, end, -1, lane] lists) of the next traced reply
+    A `d` reply from the RPi may have an "edges" list in `info`: di transitions captured since the previous reply, as
+        dataEntry dicts timed at the edge, oldest first, and an "unchanged" list of [chType, gpio_str]: readings that
+        were left out because they stayed within their deadband. Such a reply has no data entry for them
+    A `d` packet from the master may have an "ao_groups" list in `info`, e.g. [[0, 2], [3, 4]]: each inner list holds
+        the indices of ao entries whose outputs must change at the same moment (see Module_Manager.write_ao_group)
+
+    `seq` is an optional request id. A packet that has one tells the RPi that the connection stays open for more
+    requests; every reply carries the `seq` of the request it answers, and replies may come back in a different order
+    than the requests went out (see SocketSenderManager's `pipelined` mode). Packets without `seq` get one reply, after
+    which the connection is closed.
     
-    Once member attributes `dataEntries` are set, call `get_packet_as_string`, which will pack into a
-    string ready to be sent over a socket
+    Once member attributes `dataEntries` are set, call `to_socket(sock)` to send the packet (or `get_packet_as_string`,
+    which will pack into a string ready to be sent over a socket)
     
     OR, can use DataPacketModel.from_socket(sock) to create an instance from data waiting on sock buffer
     '''
     
-    allowed_msg_types = ['d', 'w']
+    allowed_msg_types = ['d', 'w', 'h', 'c', 'q']
 
     def __init__(self, 
                  dataEntries: List[type(dataEntry)], 
                  msg_type : str,
                  error_entries: List[type(errorEntry)]=None,
-                 time: float = None):
-        '''note: if `time` is unspecified, the packet timestamp will be inserted as the current time when the `get_packet_as_string` method is called'''
+                 time: float = None,
+                 info: dict = None,
+                 seq: int = None):
+        '''note: if `time` is unspecified, the packet timestamp will be inserted as the current time when the `get_packet_as_string` method is called
+        `info` is an optional dict of packet-level metadata (e.g. the request and result of a `q` packet). It is omitted
+        from the packet when None, so older peers see no difference.'''
         
         # these are bi-directional.  If master sends a packet, all values will be outputted by the Pi
         # vice-versa: if Pi sends to master, they report input data
@@ -171,48 +209,28 @@ class DataPacketModel:
         self.error_entries = error_entries
         self.msg_type = msg_type
         self.time = time
+        self.info = info
+        self.seq = seq
     
     @classmethod
-    def from_socket(cls, active_socket: socket) -> 'DataPacketModel':
-        ''' creates an instance of DataPacketModel from the data on the socket input buffer '''
-        first_slice = active_socket.recv(4).decode() # apparently, minimum buffer size is 4
-        
-        if len(first_slice) < 4:
-            # then there's actually no data to parse. Return an empty class object
-            print(f"[PacketBuilder from_socket] Found data on the socket with first slice = {first_slice}. Will not parse rest of data.")
-            import time
-            return cls(dataEntries = None, msg_type = "d", error_entries=[], time=time.time())
-            
-        msg_type = first_slice[0] # first byte should be type of message
-        
-        # do something with the type? IDK yet
-        
-        built_msg_length = first_slice[2:] # omit the msg_type and following colon
-        remainder = "" # in case we read a slice that has part of the data message in it
-        
-        # do-while construct in python...
-        while True:
-            currSlice = active_socket.recv(4).decode()
-            built_msg_length += currSlice.split(":")[0] # only keep bytes before the colon
-            
-            if ":" in currSlice:
-                remainder = currSlice.split(":")[1]
-                break
-        
-        try:
-            msg_length = int(built_msg_length)
-        except ValueError:
-            raise ValueError(f"Expected to find packet length as integer, but got `{built_msg_length}` instead")
-            
-        data_str = remainder
-        while len(data_str) < msg_length:
-            data_str += active_socket.recv(msg_length-len(data_str)).decode()
-            
-        json_payload = json.loads(data_str)
+    def from_socket(cls, active_socket: Union[socket.socket, FramedSocket]) -> 'DataPacketModel':
+        ''' creates an instance of DataPacketModel from the next packet on the socket (reads exactly one packet).
+        Pass a FramedSocket to have the bytes counted on it. Raises ConnectionError if the peer closes the connection
+        first.'''
+        framed = active_socket if isinstance(active_socket, FramedSocket) else FramedSocket(active_socket)
+        msg_type, payload = framed.recv_frame()
+        return cls.from_payload(msg_type, payload)
+
+    @classmethod
+    def from_payload(cls, msg_type: str, payload: bytes) -> 'DataPacketModel':
+        ''' creates an instance of DataPacketModel from the json part of a packet '''
+        json_payload = json.loads(payload)
         
         time = json_payload.get("time")
         data = json_payload["data"] # is a list of data entry dictionaries
         errors = json_payload.get("errors") # might be None
+        info = json_payload.get("info") # might be None
+        seq = json_payload.get("seq") # None unless the sender pipelines its requests
         
         # call parsing functions to load entry objects from dictionaries
         dataEntries = [dataEntry.from_dict(d) for d in data]
@@ -222,7 +240,7 @@ class DataPacketModel:
         else:
             error_entries = [errorEntry.from_dict(e) for e in errors]
 
-        return cls(dataEntries, msg_type, error_entries=error_entries, time=time)
+        return cls(dataEntries, msg_type, error_entries=error_entries, time=time, info=info, seq=seq)
         
 
     # private method
@@ -298,10 +316,16 @@ class DataPacketModel:
         # also append error entries if there are any
         if self.error_entries is not None and len(self.error_entries)>0:
             json["errors"] = [ee.as_dict() for ee in self.error_entries]
+        if self.info is not None:
+            json["info"] = self.info
+        if self.seq is not None:
+            json["seq"] = self.seq
             
         return json
 
-    def get_packet_as_string(self) -> str:
+    def get_payload_bytes(self) -> bytes:
+        ''' the json part of the packet. It is pure ASCII (json.dumps escapes everything else), so its length in
+        bytes is also its length in characters, which is what older peers count '''
         if self.msg_type=="d" and (self.data_entries is None or len(self.data_entries)==0):
             # then we expect this packet to contain data, but it doesn't
             # raise ValueError("There are no data entries.  Did you forget to initialize them?")
@@ -310,12 +334,17 @@ class DataPacketModel:
             
         if self.time is None:
             self.time = time.time()
-            
-        json_section_str = str(self._pack_json(self.time))
-            
-        packet_string = f"{self.msg_type}:{len(json_section_str)}:{json_section_str}"
-        packet_string = packet_string.replace("'", "\"") # because json.loads requires double quotes
-        return packet_string
+        return json.dumps(self._pack_json(self.time)).encode()
+
+    def get_packet_as_string(self) -> str:
+        json_section_str = self.get_payload_bytes().decode()
+        return f"{self.msg_type}:{len(json_section_str)}:{json_section_str}"
+
+    def to_socket(self, active_socket: Union[socket.socket, FramedSocket]) -> int:
+        ''' writes the whole packet to the socket, header and payload without joining them first (see Transport.py).
+        Returns the number of bytes written.'''
+        framed = active_socket if isinstance(active_socket, FramedSocket) else FramedSocket(active_socket)
+        return framed.send_frame(self.msg_type, self.get_payload_bytes())
     
         
     def __str__(self):
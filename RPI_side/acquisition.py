@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Continuous acquisition of the RPi's analog inputs. Instead of doing `ai_LPF_boxcar_length` fresh SPI reads inside every
+read request, a background thread samples every configured ai channel at a fixed rate into a fixed-size ring buffer
+per channel, and runs that channel's filter after each sample. A read request is then answered with the latest
+filtered value straight from the cache, so its latency no longer grows with the filter length.
+
+Filters (the "type" of a channel's filter config):
+    "moving_average" : mean of the last `window` samples (kept as a running sum)
+    "ema"            : exponential moving average, y += alpha * (x - y)
+    "median"         : median of the last `window` samples; rejects single-sample SPI glitches
+    "none"           : the latest sample
+Any of them takes a `decimation` D: the cached value is only refreshed on every D-th sample (which also saves the
+median's sort on the samples in between).
+
+Module_Manager.start_acquisition sets this up from the channel map's "ai_acquisition" info, e.g.
+    {"rate_hz": 100, "buffer": 256, "channels": {"GPIO23": {"type": "median", "window": 9, "decimation": 2}}}
+"""
+
+import threading
+import time
+from statistics import median
+
+
+class ChannelFilter:
+    TYPES = ("moving_average", "ema", "median", "none")
+
+    def __init__(self, bufferSize: int = 256, type: str = "moving_average", window: int = 5, alpha: float = 0.2,
+                 decimation: int = 1):
+        '''
+        bufferSize : number of raw samples kept in the ring buffer; `window` is clamped to it
+        type, window, alpha, decimation : see the module docstring
+        '''
+        if type not in self.TYPES:
+            raise ValueError(f"Unknown filter type {type}. Use one of {list(self.TYPES)}")
+        if not 0 < alpha <= 1:
+            raise ValueError(f"The ema alpha must be in (0, 1], not {alpha}")
+        self.type = type
+        self.size = max(int(bufferSize), 1)
+        self.window = min(max(int(window), 1), self.size)
+        self.alpha = alpha
+        self.decimation = max(int(decimation), 1)
+
+        self.ring = [0.0] * self.size
+        self.index = 0 # where the next sample goes
+        self.count = 0 # samples in the ring, up to `size`
+        self.windowSum = 0.0 # sum of the newest min(count, window) samples
+        self.ema = None
+        self.sinceOutput = 0
+        self.latest = None # (filtered value, time.time() of its newest sample); replaced as a whole, so readers need no lock
+
+    def push(self, sample: float, t: float) -> None:
+        ring, size = self.ring, self.size
+        if self.count >= self.window:
+            self.windowSum -= ring[(self.index - self.window) % size] # the sample that leaves the window
+        ring[self.index] = sample
+        self.index = (self.index + 1) % size
+        self.count = min(self.count + 1, size)
+        self.windowSum += sample
+        if self.index == 0: # once per lap, start the running sum afresh so float errors cannot pile up
+            self.windowSum = sum(self._window())
+        self.ema = sample if self.ema is None else self.ema + self.alpha * (sample - self.ema)
+
+        self.sinceOutput += 1
+        if self.sinceOutput < self.decimation:
+            return
+        self.sinceOutput = 0
+        if self.type == "moving_average":
+            value = self.windowSum / min(self.count, self.window)
+        elif self.type == "ema":
+            value = self.ema
+        elif self.type == "median":
+            value = median(self._window())
+        else:
+            value = sample
+        self.latest = (value, t)
+
+    def _window(self) -> list[float]:
+        n = min(self.count, self.window)
+        return [self.ring[(self.index - k) % self.size] for k in range(1, n + 1)]
+
+
+class AcquisitionLoop:
+    STALE_PASSES = 5 # a cached value is stale once this many of its channel's outputs in a row are missing
+
+    def __init__(self, readers: dict, filters: dict, rate_hz: float = 100, spiLock = None, spiObserver = None):
+        '''
+        readers : {gpio_str: callable returning one fresh reading in mA} (e.g. R_CLICK.read_mA)
+        filters : {gpio_str: ChannelFilter} for the same channels
+        rate_hz : samples per second per channel. If a pass over all channels takes longer than 1/rate_hz, the loop
+                  runs as fast as the bus allows (and counts an overrun)
+        spiLock : held during each read, so that samples never interleave with other transfers on the shared bus
+        spiObserver : optional callable like f(gpio_str, "ai", 1), called after every read (see Module_Manager)
+        '''
+        self.readers = readers
+        self.filters = filters
+        self.period = 1 / rate_hz
+        self.spiLock = spiLock if spiLock is not None else threading.Lock()
+        self.spiObserver = spiObserver
+        self.passDuration = 0.0 # seconds taken by the latest pass over all channels
+        self.numPasses = 0
+        self.numOverruns = 0
+        self.readErrors = dict() # gpio_str -> description of the last failed read
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout=1)
+
+    def latest(self, gpio_str: str) -> tuple[float, float] | None:
+        ''' (filtered value, time of its newest sample), or None before the channel's first output '''
+        f = self.filters.get(gpio_str)
+        return None if f is None else f.latest
+
+    def is_stale(self, gpio_str: str, t: float) -> bool:
+        ''' True if a filtered value whose newest sample is from `t` should have been replaced by now, e.g. because
+        the channel's reads keep failing (see `readErrors`) or the loop has stopped '''
+        outputPeriod = max(self.period, self.passDuration) * self.filters[gpio_str].decimation
+        return time.time() - t > self.STALE_PASSES * outputPeriod
+
+    def _run(self) -> None:
+        items = list(self.readers.items())
+        spiObserver = self.spiObserver
+        nextPass = time.perf_counter()
+        while not self._stop.is_set():
+            passStart = time.perf_counter()
+            for gpio_str, read_mA in items:
+                try:
+                    with self.spiLock:
+                        sample = read_mA()
+                except Exception as e:
+                    self.readErrors[gpio_str] = str(e)
+                    continue
+                finally:
+                    if spiObserver is not None:
+                        spiObserver(gpio_str, "ai", 1)
+                self.filters[gpio_str].push(sample, time.time())
+            self.numPasses += 1
+            self.passDuration = time.perf_counter() - passStart
+
+            nextPass += self.period
+            waitFor = nextPass - time.perf_counter()
+            if waitFor > 0:
+                self._stop.wait(waitFor)
+            else: # behind schedule: don't try to catch up with a burst of passes
+                self.numOverruns += 1
+                nextPass = time.perf_counter()
+
+    def stats(self) -> dict:
+        return {"passes": self.numPasses, "overruns": self.numOverruns, "period_ms": self.period * 1000,
+                "channels": len(self.readers), "read_errors": dict(self.readErrors)}
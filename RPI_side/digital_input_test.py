@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the di driver against gpiozero's MockFactory, so that it runs without an RPi:
+    python -m pytest RPI_side/digital_input_test.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__))) # find the RPi modules from any working directory
+
+from gpiozero import Device, DigitalInputDevice
+from gpiozero.pins.mock import MockFactory
+
+from module_drivers.Digital_Input_Module import Digital_Input_Module
+
+Device.pin_factory = MockFactory()
+
+
+def _make_module(gpio_str: str) -> tuple[DigitalInputDevice, Digital_Input_Module]:
+    pin = DigitalInputDevice(gpio_str, pull_up=True) # like GPIO_Manager.put_gpio
+    return (pin, Digital_Input_Module(gpio_in_pin=pin))
+
+
+def test_counter_counts_pulses_of_driven_pin():
+    pin, dim = _make_module("GPIO5")
+    try:
+        dim.startCounter(gate_s=0.2)
+        assert dim.readCounter()["level"] == 0 # pulled up and not driven: inactive
+        for _ in range(5): # the input is active low
+            pin.pin.drive_low()
+            pin.pin.drive_high()
+        pin.pin.drive_low()
+        time.sleep(0.3) # let the gate end
+        reading = dim.readCounter()
+        assert reading["count"] == 6
+        assert reading["freq_hz"] > 0
+        assert reading["level"] == 1
+    finally:
+        dim.close()
+        pin.close()
+
+
+def test_edges_are_taken_as_readState_values():
+    pin, dim = _make_module("GPIO6")
+    try:
+        dim.startEdgeCapture(capacity=16)
+        pin.pin.drive_low()
+        pin.pin.drive_high()
+        edges, lost = dim.takeEdges()
+        assert [value for _, value in edges] == [1, 0]
+        assert lost == 0
+        assert dim.takeEdges() == ([], 0)
+    finally:
+        dim.close()
+        pin.close()
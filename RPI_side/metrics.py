@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Small in-process metrics for the RPi server: counters, gauges and histograms with labels, rendered in the Prometheus
+plain-text exposition format. Updating a metric is a dict lookup and an addition under a lock, so the metrics are
+always collected; only the HTTP endpoint is optional (see `start_metrics_server`).
+
+Example scrape config entry for a fleet of simulators:
+    - job_name: simulators
+      static_configs:
+        - targets: ["192.168.80.1:9100", "192.168.81.1:9100"]
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Metric:
+    TYPE = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.mutex = threading.Lock()
+
+    def _label_str(self, labelvalues: tuple, extra: str = "") -> str:
+        parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(self.labelnames, labelvalues)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if len(parts) > 0 else ""
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"] + self._samples()
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self.values = dict() # label values tuple -> count
+
+    def inc(self, *labelvalues, amount: float = 1) -> None:
+        with self.mutex:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def _samples(self) -> list[str]:
+        with self.mutex:
+            return [f"{self.name}{self._label_str(k)} {v}" for k, v in self.values.items()]
+
+
+class Gauge(_Metric):
+    TYPE = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self.values = dict()
+
+    def set(self, value: float, *labelvalues) -> None:
+        with self.mutex:
+            self.values[labelvalues] = value
+
+    def _samples(self) -> list[str]:
+        with self.mutex:
+            return [f"{self.name}{self._label_str(k)} {v}" for k, v in self.values.items()]
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0) # seconds
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self.values = dict() # label values tuple -> [per-bucket counts (last is +Inf), sum, count]
+
+    def observe(self, value: float, *labelvalues) -> None:
+        i = 0
+        buckets = self.buckets
+        while i < len(buckets) and value > buckets[i]:
+            i += 1
+        with self.mutex:
+            v = self.values.get(labelvalues)
+            if v is None:
+                v = [[0] * (len(buckets) + 1), 0.0, 0]
+                self.values[labelvalues] = v
+            v[0][i] += 1
+            v[1] += value
+            v[2] += 1
+
+    def _samples(self) -> list[str]:
+        lines = []
+        with self.mutex:
+            for k, (counts, total, n) in self.values.items():
+                cumulative = 0
+                for edge, c in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += c
+                    le = 'le="+Inf"' if edge == float("inf") else f'le="{edge!r}"'
+                    lines.append(f"{self.name}_bucket{self._label_str(k, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{self._label_str(k)} {total}")
+                lines.append(f"{self.name}_count{self._label_str(k)} {n}")
+        return lines
+
+
+def _escape(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for m in self.metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics:
+    ''' the metrics exported by mt_server_w_handlers.py '''
+    def __init__(self):
+        self.registry = Registry()
+        r = self.registry
+        self.commands_received = r.register(Counter("sim_commands_received_total", "Data entries received from the master", ("chType",)))
+        self.commands_executed = r.register(Counter("sim_commands_executed_total", "Data entries executed by the hardware thread", ("chType",)))
+        self.spi_calls = r.register(Counter("sim_spi_transactions_total",
+                                            "SPI transactions per module (an ao write of an unchanged value skips the bus and is not counted)",
+                                            ("module", "chType")))
+        self.spi_seconds = r.register(Histogram("sim_spi_transaction_seconds", "Driver call duration per SPI module command", ("module", "chType")))
+        self.errors = r.register(Counter("sim_error_entries_total", "Error entries reported to the master", ("source",)))
+        self.queue_depth = r.register(Gauge("sim_command_queue_depth", "Entries waiting for the hardware thread"))
+        self.request_seconds = r.register(Histogram("sim_request_seconds", "Time from receiving a packet to sending its reply", ("msg_type",)))
+        self.socket_bytes = r.register(Counter("sim_socket_bytes_total", "Bytes of packets sent to and received from the master", ("direction",)))
+        self.socket_frames = r.register(Counter("sim_socket_packets_total", "Packets sent to and received from the master", ("direction",)))
+
+    def on_executed(self, de, start: float, end: float, cached: bool = False) -> None:
+        ''' observer for Module_Manager.execute_batch. `cached` is True for an ai read answered from the acquisition
+        loop, which makes no SPI transfer of its own. Transactions are counted where they happen (see `on_spi_transfers`) '''
+        self.commands_executed.inc(de.chType)
+        if de.chType in ("ai", "ao") and not cached:
+            self.spi_seconds.observe(end - start, de.gpio_str, de.chType)
+
+    def on_spi_transfers(self, gpio_str: str, chType: str, numTransfers: int) -> None:
+        ''' spiObserver for Module_Manager and its AcquisitionLoop: transfers that actually went out on the bus '''
+        self.spi_calls.inc(gpio_str, chType, amount=numTransfers)
+
+    def on_transfer(self, direction: str, numBytes: int) -> None:
+        ''' onTransfer callback of Transport.FramedSocket '''
+        self.socket_bytes.inc(direction, amount=numBytes)
+        self.socket_frames.inc(direction)
+
+    def on_errors(self, errors: list) -> None:
+        for e in errors:
+            self.errors.inc(e.source)
+
+
+def start_metrics_server(registry: Registry, port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    ''' serves `registry` as plain text on http://host:port/metrics from a daemon thread '''
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # one line per scrape would drown out the server's own output
+
+    httpd = ThreadingHTTPServer((host, port), _Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -7,6 +7,8 @@ Created on 1/17/25
 
 # import spidev
 import time
+import threading
+from collections import deque
 import gpiozero # because RPi.GPIO is unsupported on RPi5
 
 # import sys
@@ -15,12 +17,125 @@ import gpiozero # because RPi.GPIO is unsupported on RPi5
 class Digital_Input_Module:
     def __init__(self, gpio_in_pin : gpiozero.DigitalInputDevice):
         self.gpio_in_pin = gpio_in_pin
+        self.edges = None # ring buffer of (ticks, pin state) while edge capture is on
+        self.numLost = 0 # edges pushed out of the full ring buffer since the last takeEdges
+        self.takeLock = threading.Lock() # replies on both lanes of a pipelined connection take edges
+        self.counting = False # True while the pulse counter runs (see `startCounter`)
+        self._chained = None
+        self._hooked = False
     
     def readState(self) -> int:
         return int(self.gpio_in_pin.value)
+
+    def _activeLevel(self) -> bool:
+        # the pin level at which readState is 1. gpiozero keeps the device's active state private, but it follows from
+        # the pull: with a pullup the input is active low
+        return not self.gpio_in_pin.pull_up
+
+    def _hookPin(self) -> None:
+        # one callback on the pin driver's edge interrupt (lgpio on the RPi 5) serves both edge capture and the counter
+        if self._hooked:
+            return
+        pin = self.gpio_in_pin.pin
+        self._chained = pin.when_changed # gpiozero's own handler (when_activated etc.) must keep working
+        pin.when_changed = self._onEdge
+        self._hooked = True
+
+    def _onEdge(self, ticks, state) -> None:
+        edges = self.edges
+        if edges is not None:
+            if len(edges) == edges.maxlen:
+                self.numLost += 1
+            edges.append((ticks, state)) # appends from the callback thread are thread-safe
+        if self.counting:
+            self._countEdge(ticks, int(bool(state) == self.activeState))
+        if self._chained is not None:
+            self._chained(ticks, state)
+
+    def startEdgeCapture(self, capacity: int = 256) -> None:
+        ''' records every transition of the pin from the pin driver's edge callback, timestamped with the driver's
+        tick counter rather than whenever a poll comes by. The newest `capacity` edges are kept.'''
+        if self.edges is not None:
+            return
+        self.edges = deque(maxlen=capacity)
+        self._hookPin()
+
+    def takeEdges(self) -> tuple[list[tuple[float, int]], int]:
+        ''' removes the captured edges and returns ([(time.time() of the edge, value after the edge), ...], number of
+        edges lost to a full buffer since the last call). Values are 0/1 like readState. '''
+        with self.takeLock:
+            edges = self.edges
+            if edges is None or len(edges) == 0:
+                return ([], 0)
+            numEdges = len(edges) # only edges from before `now`; later ones stay for the next call
+            factory = self.gpio_in_pin.pin_factory
+            nowTicks, now = factory.ticks(), time.time() # ticks wrap around, so each edge is placed relative to now
+            activeState = self._activeLevel()
+            taken = []
+            for _ in range(numEdges):
+                ticks, state = edges.popleft()
+                taken.append((now - factory.ticks_diff(nowTicks, ticks), int(bool(state) == activeState)))
+            lost, self.numLost = self.numLost, 0
+        return (taken, lost)
+
+    def startCounter(self, gate_s: float = 1.0) -> None:
+        ''' counts pulses in the background: every `gate_s` seconds the activations of the input during the gate that
+        just ended are turned into a reading (see `readCounter`). Edges come from the pin's interrupt, so pulses much
+        shorter than a poll period are still counted.'''
+        if self.counting:
+            return
+        self.factory = self.gpio_in_pin.pin_factory
+        self.activeState = self._activeLevel()
+        self.counterLock = threading.Lock()
+        with self.counterLock:
+            self.level = self.readState()
+            self.gateStart = self.lastEdge = self.factory.ticks()
+            self.gateCount = 0 # activations (inactive -> active edges) so far in this gate
+            self.gateActive_s = 0.0 # time spent active so far in this gate
+            self.reading = {"count": 0, "freq_hz": 0.0, "duty": float(self.level), "level": self.level}
+        self.gateStop = threading.Event()
+        self.counting = True
+        self._hookPin()
+        threading.Thread(target=self._gateLoop, args=(gate_s,), daemon=True).start()
+
+    def _countEdge(self, ticks, value: int) -> None:
+        with self.counterLock:
+            if value == self.level:
+                return # a repeated state (e.g. contact bounce seen as two callbacks) is not a new edge
+            if self.level == 1:
+                self.gateActive_s += self.factory.ticks_diff(ticks, self.lastEdge)
+            else:
+                self.gateCount += 1
+            self.level = value
+            self.lastEdge = ticks
+
+    def _gateLoop(self, gate_s: float) -> None:
+        while not self.gateStop.wait(gate_s):
+            with self.counterLock:
+                now = self.factory.ticks()
+                elapsed = self.factory.ticks_diff(now, self.gateStart)
+                active = self.gateActive_s + (self.factory.ticks_diff(now, self.lastEdge) if self.level == 1 else 0)
+                if elapsed > 0:
+                    self.reading = {"count": self.gateCount, "freq_hz": self.gateCount / elapsed,
+                                    "duty": min(active / elapsed, 1.0), "level": self.level}
+                self.gateStart = self.lastEdge = now
+                self.gateCount = 0
+                self.gateActive_s = 0.0
+
+    def readCounter(self) -> dict:
+        ''' the reading of the last complete gate: {"count": activations, "freq_hz": activations per second,
+        "duty": fraction of the gate spent active, "level": 0/1 right now} '''
+        with self.counterLock:
+            return dict(self.reading, level=self.level)
     
     def close(self):
-        pass
+        if self.counting:
+            self.gateStop.set()
+            self.counting = False
+        if self._hooked:
+            self.gpio_in_pin.pin.when_changed = self._chained
+            self._hooked = False
+        self.edges = None
 
 if __name__ == "__main__":
     my_pin = gpiozero.DigitalInputDevice("GPIO19", pull_up=True)
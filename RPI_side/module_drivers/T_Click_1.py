@@ -12,6 +12,8 @@ class T_CLICK_1:
 
     CURRENT_OUTPUT_RANGE_MIN = 2 # arbitrarily chosen
     CURRENT_OUTPUT_RANGE_MAX = 20.048 # calculated from pcb component choices
+
+    _frame_tables = dict() # (BUF, GAB, SHDNB) -> list of 2**BIT_RES ready-to-send byte frames, shared by all instances
     
     def __init__(self, gpio_cs_pin, spi: spidev.SpiDev, SHDNB:int=1, GAB:int=1, BUF:int=0): # originally 1,1,0
         ''' T_CLICK_1 board has an MCP4921 (12-bit DAC) that feeds an XTR116 loop driver (voltage-to-current converter).
@@ -32,20 +34,39 @@ class T_CLICK_1:
         self.SHDNB = SHDNB
         self.GAB = GAB
         self.BUF = BUF
+
+        self.frames = T_CLICK_1.get_frame_table(BUF=BUF, GAB=GAB, SHDNB=SHDNB)
+        self.lastCode = None # DAC code of the last frame written; None until the first write
+        self.numTransfers = 0 # SPI frames written; a write of the code the DAC already holds is skipped and not counted
+
+    @classmethod
+    def get_frame_table(cls, BUF: int, GAB: int, SHDNB: int) -> list[list[int]]:
+        ''' returns the byte frame for every one of the 4096 DAC codes, built once per combination of config bits.
+        Indexing this table replaces building the command word, `to_bytes` and the list comprehension on every write.'''
+        key = (BUF, GAB, SHDNB)
+        table = cls._frame_tables.get(key)
+        if table is None:
+            header = (0 << cls.BITS_PER_TRANSACTION-1) + (BUF << cls.BITS_PER_TRANSACTION - 2) \
+                     + (GAB << cls.BITS_PER_TRANSACTION - 3) + (SHDNB << cls.BITS_PER_TRANSACTION - 4)
+            table = [[(header + code) >> 8, (header + code) & 0xFF] for code in range(2**cls.BIT_RES)]
+            cls._frame_tables[key] = table
+        return table
+
+    def mA_to_code(self, mA_val: float) -> int:
+        ''' DAC code for a loop current (see the derivation in `write_mA`), clamped to the 12-bit range'''
+        Amps_value = mA_val / 1E3
+        DAC_CODE_float = abs((Amps_value * T_CLICK_1.R_IN * 2**T_CLICK_1.BIT_RES) / (100*T_CLICK_1.V_REF))
+        return int(min(DAC_CODE_float, 2**T_CLICK_1.BIT_RES-1)) # safety
     
-    def write_mA(self, mA_val: float) -> None:
+    def write_mA(self, mA_val: float, force: bool = False) -> None:
+        ''' writes the frame for `mA_val`. If the DAC already holds that code, the SPI transfer is skipped unless `force`
+        is True (e.g. to re-assert the output after the board may have lost power).'''
         # writeToSPI(spi, cs_obj, t1.get_command_for(maVal)
         if (mA_val < self.CURRENT_OUTPUT_RANGE_MIN) or (mA_val > self.CURRENT_OUTPUT_RANGE_MAX):
             print(f"The requested current value of {mA_val} mA is outside the valid range of the transmitter.")
             # don't throw an exception because this driver will need to run uninterrupted in a main loop
         
-        # first four msb bits are for config instructions
-        command = 0
-        command += 0 << self.BITS_PER_TRANSACTION-1
-        command += self.BUF << self.BITS_PER_TRANSACTION - 2
-        command += self.GAB << self.BITS_PER_TRANSACTION -3
-        command += self.SHDNB << self.BITS_PER_TRANSACTION - 4
-        
+        # first four msb bits are for config instructions (precomputed in `self.frames`)
         # according to XTR116 datasheet, I_out = 100*I_in
         # The T-Click datasheet uses a 20k resistor between the DAC and the XTR116, and "The input voltage at the I_IN pin is zero"
         # Thus, I_out=100*(V_DAC/R_in) where R_in=20k
@@ -55,23 +76,28 @@ class T_CLICK_1:
             # and D_N is the digital input value
         # therefore, I_out = (100*V_REF*D_N)/(R_IN * 2^12)
         # by inspection, the maximum output current is 20.48 mA
-        Amps_value = mA_val / 1E3
-        DAC_CODE_float = abs((Amps_value * T_CLICK_1.R_IN * 2**T_CLICK_1.BIT_RES) / (100*T_CLICK_1.V_REF))
-        DAC_CODE_float = min(DAC_CODE_float, 2**T_CLICK_1.BIT_RES-1) # safety
+        code = self.mA_to_code(mA_val)
+        if code == self.lastCode and not force:
+            return # the DAC already outputs this value
     
-        # add the actual DAC signal code
-        command += int(DAC_CODE_float)
-        # sending as single int doesn't work.  Try splitting into two 8-bit ints
-        asBytes = int(command).to_bytes(int(T_CLICK_1.BITS_PER_TRANSACTION/8), byteorder="big")
-        
-        bytesList = [int(b) for b in asBytes] # separate into 8-bit chunks for the SPI channel's limitations on word length
-
+        # sending as single int doesn't work, so each frame is two 8-bit ints for the SPI channel's limitations on word length
         self.gpio_cs_pin.value = 0 # initiate transaction by pulling low
-        self.spi_master.writebytes(bytesList)
+        self.spi_master.writebytes(self.frames[code])
         self.gpio_cs_pin.value = 1
+        self.lastCode = code
+        self.numTransfers += 1
+    
+    def frame_for(self, mA_val: float) -> tuple[int, list[int]]:
+        ''' (DAC code, byte frame) for `mA_val`, so that a group write can look up every frame before its first transfer.
+        This driver has no LDAC line, so the MCP4921 updates its output as soon as CS goes high after a frame; writing
+        the frames back to back is the closest this board gets to a simultaneous update.'''
+        if (mA_val < self.CURRENT_OUTPUT_RANGE_MIN) or (mA_val > self.CURRENT_OUTPUT_RANGE_MAX):
+            print(f"The requested current value of {mA_val} mA is outside the valid range of the transmitter.")
+        code = self.mA_to_code(mA_val)
+        return (code, self.frames[code])
     
     def close(self) -> None:
-        self.write_mA(self.CURRENT_OUTPUT_RANGE_MIN)
+        self.write_mA(self.CURRENT_OUTPUT_RANGE_MIN, force=True)
         return
 
 
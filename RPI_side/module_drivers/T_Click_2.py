@@ -109,6 +109,11 @@ class T_CLICK_2:
     CURRENT_LIMIT_RANGE_MAX = 24.1
     CURRENT_OUTPUT_RANGE_MIN = 3.9
     CURRENT_OUTPUT_RANGE_MAX = 20.0
+
+    CODE_PER_mA = 2**BIT_RES / 24 # I_LOOP = 24 mA (DACCODE / 2**16) (pg 18 of datasheet)
+
+    WR_MODE_PROTECT = 0x0001 # in protect mode a DACCODE write only takes effect on the next XFER command
+    XFER_FRAME = [REG_XFER, 0x00, 0xFF] # XFER command; its data must be 0x00FF
     
     def __init__(self, gpio_cs_pin, spi : spidev.SpiDev, make_persistent : bool = True):
         '''
@@ -118,6 +123,9 @@ class T_CLICK_2:
         self.spi_master = spi           
         self.gpio_cs_pin = gpio_cs_pin # use the gpio_manager class to fetch the GPIO object
         self.dac997_status = DAC997_status(None, None, None, None, None, None) # initialize to empty data model
+        self.lastCode = None # DACCODE of the last `write_mA`; None when unknown (before the first write, after a reset)
+        self.protected = False # True once `preload_mA` has put the chip in protect mode (see WR_MODE_PROTECT)
+        self.numTransfers = 0 # SPI frames written; a write of the code the DAC already holds is skipped and not counted
         
         if make_persistent:
             # disable SPI timeout error reporting (i.e. maintain output current indefinitely)
@@ -141,22 +149,59 @@ class T_CLICK_2:
         resp = self.spi_master.xfer(write_list) # also catches the shift register contents that are being shifted out
 
         self.gpio_cs_pin.value = 1 # end transaction by pulling cs high
+        self.numTransfers += 1
         return resp        
     
-    def write_mA(self, mA_val: float) -> None:
-        ''' produces as 24-bit word REG+DACCODE, and writes it to SPI '''
+    def write_mA(self, mA_val: float, force: bool = False) -> None:
+        ''' produces as 24-bit word REG+DACCODE, and writes it to SPI. If the DAC already holds that code, the SPI
+        transfer is skipped unless `force` is True.'''
         # modeled after c420mat2_set_output_current
         if (mA_val < self.CURRENT_OUTPUT_RANGE_MIN) or (mA_val > self.CURRENT_OUTPUT_RANGE_MAX):
             raise ValueError(f"The requested current value of {mA_val} mA is outside the valid range of the transmitter.")
-        # print(f"{mA_val} mA converted to DAC code is {self._convert_mA_to_DAC_code(mA_val)}")
-        self._write_data(self.REG_DACCODE, self._convert_mA_to_DAC_code(mA_val))
+        code = int(mA_val * T_CLICK_2.CODE_PER_mA)
+        if code == self.lastCode and not force:
+            return
+        # fast path: build the three bytes directly instead of going through `_write_data`
+        self.gpio_cs_pin.value = 0
+        self.spi_master.xfer([T_CLICK_2.REG_DACCODE, code >> 8, code & 0xFF])
+        self.gpio_cs_pin.value = 1
+        self.numTransfers += 1
+        if self.protected: # a chip that took part in a group write needs the XFER for single writes too
+            self.latch()
+        self.lastCode = code
+
+    def preload_mA(self, mA_val: float) -> bool:
+        ''' loads the DACCODE for `mA_val` without changing the output current, which keeps its old value until
+        `latch`. This lets several T Click 2 modules change at the same moment (see Module_Manager.write_ao_group).
+        Returns False if the DAC already holds that code, in which case no latch is needed.'''
+        if (mA_val < self.CURRENT_OUTPUT_RANGE_MIN) or (mA_val > self.CURRENT_OUTPUT_RANGE_MAX):
+            raise ValueError(f"The requested current value of {mA_val} mA is outside the valid range of the transmitter.")
+        code = int(mA_val * T_CLICK_2.CODE_PER_mA)
+        if code == self.lastCode:
+            return False
+        if not self.protected:
+            self._write_data(self.REG_WR_MODE, self.WR_MODE_PROTECT)
+            self.protected = True
+        self.gpio_cs_pin.value = 0
+        self.spi_master.xfer([T_CLICK_2.REG_DACCODE, code >> 8, code & 0xFF])
+        self.gpio_cs_pin.value = 1
+        self.numTransfers += 1
+        self.lastCode = code
+        return True
+
+    def latch(self) -> None:
+        ''' moves the preloaded DACCODE to the output (XFER command) '''
+        self.gpio_cs_pin.value = 0
+        self.spi_master.xfer(T_CLICK_2.XFER_FRAME)
+        self.gpio_cs_pin.value = 1
+        self.numTransfers += 1
         
     
     def _convert_mA_to_DAC_code(self, mA_value: float) -> int:
         ''' see datasheet '''
         # I_LOOP = 24 mA (DACCODE / 2**16) (pg 18 of datasheet)
         # so DACCODE = (I_LOOP/24mA) * 2**16
-        return int((mA_value / 24) * 2**T_CLICK_2.BIT_RES)
+        return int(mA_value * T_CLICK_2.CODE_PER_mA)
     
     def read_status_register(self) -> 'DAC997_status':
         # requires two SPI transactions: one to send read command, another with dummy data to flush out the data from the registers
@@ -207,6 +252,8 @@ class T_CLICK_2:
     def reset(self) -> None:
         ''' return all writable registers to their defaults '''
         self._write_data(self.REG_RESET, 0xC33C) # see datasheet pg 15
+        self.lastCode = None # DACCODE is back at its power-on default
+        self.protected = False # and so is WR_MODE
         self.write_NOP()
         
     def close(self) -> None:
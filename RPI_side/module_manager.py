@@ -3,6 +3,7 @@ import warnings
 import gpiozero
 import time
 import spidev
+import threading
 
 import sys
 sys.path.append("..") # include parent directory in path
@@ -10,10 +11,12 @@ sys.path.append("..") # include parent directory in path
 from PacketBuilder import dataEntry, errorEntry
 from gpio_manager import GPIO_Manager
 from module_drivers.T_Click_1 import T_CLICK_1
+from module_drivers.T_Click_2 import T_CLICK_2
 from module_drivers.Digital_Input_Module import Digital_Input_Module
 from module_drivers.R_Click import R_CLICK
 from module_drivers.Relay_Channel import RELAY_CHANNEL
 from module_drivers.Indicator_Light import INDICATOR_LIGHT
+from acquisition import ChannelFilter, AcquisitionLoop
 
 class Module_Manager:
     # maintain a list of modules (e.g. R_CLICK, COMPARATOR_CLICK)
@@ -24,10 +27,27 @@ class Module_Manager:
     # also responsible for creating a module if not exist yet
     # or to write a value to a module at the specified gpio pin
 
-    def __init__(self, spi : spidev.SpiDev):
+    AO_MODULES = {"T_CLICK_1": T_CLICK_1, "T_CLICK_2": T_CLICK_2} # ao drivers by name (see `set_ao_module`)
+
+    def __init__(self, spi : spidev.SpiDev, verbose : bool = True, spiObserver = None):
+        '''
+        spi : the SPI bus shared by all modules
+        verbose : print every module creation. Commands themselves are never printed; they run in the hot path.
+        spiObserver : optional callable like f(gpio_str, chType, numTransfers), called whenever frames of a module went
+                      out on the bus (e.g. ServerMetrics.on_spi_transfers). An ao write the DAC already holds sends none.
+        '''
         self.spi = spi
+        self.verbose = verbose
+        self.spiObserver = spiObserver
         self.module_dict = dict() # a dict like {"GPIO26" : ["ao", driver_obj]}
+        self.handlers = dict() # a dict like {("GPIO26", "ao") : handler}; see `_bind_handler`
         self.gpio_manager = GPIO_Manager() # initialize to empty at first
+        self.lock = threading.RLock() # module creation can come from the command thread and from a channel map at the same time
+        self.edgeCapacity = 0 # per-pin edge buffer of every di module; 0 while edge capture is off (see `enable_edge_capture`)
+        self.aoModules = dict() # a dict like {"GPIO19" : "T_CLICK_2"}; ao channels not listed use T_CLICK_1
+        self.spiLock = threading.Lock() # held for every SPI transfer: the command thread and the acquisition loop share the bus
+        self.acquisition = None # the AcquisitionLoop while ai channels are sampled in the background (see `start_acquisition`)
+        self.acquisitionConfig = None
     
     def execute_command(self, gpio_str: str, chType: str, val: float | int) -> Tuple[dataEntry, list[errorEntry]]:
         '''
@@ -42,81 +62,398 @@ class Module_Manager:
         :param str chType: one of ["ao", "ai", "di", "do"]
         :param float|int val: the value to write to the module
         '''
-        if gpio_str not in self.module_dict:
-            print(f"[Module_Manager] making a module entry for {gpio_str} as a {chType}")
-            self.make_module_entry(gpio_str = gpio_str, chType = chType)
-            print(f"[module_manager] made a new module entry. module_dict is now {self.module_dict}")
-
-        driverObj = self.module_dict.get(gpio_str)[1] # second element in value list is the driver object
-        print(f"[module_manager] driverObj is {driverObj}")
-        
-        valueResponse = None # we will update these later
-        errorResponse_list = []
+        handler = self.handlers.get((gpio_str, chType))
+        if handler is None:
+            handler = self._get_handler_slow(gpio_str, chType)
+        valueResponse, errorResponses = handler(val)
+        return (valueResponse, list(errorResponses))
 
-        # first element is the channel type
-        if chType.lower() == "ao": # then it's a T_CLICK_1 instance
+    def execute_batch(self, entries: list[dataEntry], observer = None) -> Tuple[list[dataEntry], list[errorEntry]]:
+        '''
+        Executes every entry of a packet in order and returns (responses, errors). There is exactly one response per
+        entry, in the same order: the reading for an input, or an acknowledgement for an output (a copy of the entry
+        whose `val` is "NAK" if the command produced an error).
+        observer : optional callable like f(entry, startTime, endTime), called after each entry's driver call
+                   (e.g. TimingStats.on_executed). Entries are not timed at all when it is None.
+        '''
+        responses = [None] * len(entries)
+        errors = []
+        handlers = self.handlers
+        for i, de in enumerate(entries):
+            if de.group is not None:
+                if responses[i] is None: # the group's first entry executes the whole group
+                    self._execute_group(entries, i, responses, errors, observer)
+                continue
+            handler = handlers.get((de.gpio_str, de.chType))
             try:
-                driverObj.write_mA(val)
+                if handler is None:
+                    handler = self._get_handler_slow(de.gpio_str, de.chType)
+                if observer is None:
+                    valueResponse, errorResponses = handler(de.val)
+                else:
+                    start = time.time()
+                    valueResponse, errorResponses = handler(de.val)
+                    observer(de, start, time.time())
             except Exception as e:
-                errorResponse_list.append(errorEntry(source = "ao", criticalityLevel = "High", description = f"{e}. Encountered unexpected exception:{gpio_str}"))
-                        
-            # don't update the valueResponse with anything. This is no ao signal, so don't return anything
-        elif chType.lower() == "ai": # then it's an R_CLICK instance
-            # the ai adc readings can be noisy, so do a simple average to attenuate noise
-            numMeasurements = max(int(val), 1) # at least one measurement
-            sum = 0
-            for _ in range(numMeasurements):
-                sum += driverObj.read_mA()
-                
-            ma_reading = sum / numMeasurements
-            valueResponse = dataEntry(chType = chType, gpio_str = gpio_str, val = ma_reading, time = time.time())
-
-            if ma_reading == 0: # there is always a small amount of random noise that can be read on the adc chip to indicate a valid SPI connection
-                errorResponse_list.append(errorEntry(source = "ai", criticalityLevel = "High", description = f"SPI communication error detected:{gpio_str}"))
-
-        elif chType.lower() == "do": # then it's a relay channel instance
-            print("[module_manager] entered do branch to write val: {bool(val)}")
-            driverObj.writeState(state = bool(val))
-            # don't update either the value response or the error response list
-        elif chType.lower() == "di": # then it's a comparator channel instance
-            di_value = int(driverObj.readState())
-            valueResponse = dataEntry(chType = chType, gpio_str = gpio_str, val = di_value, time = time.time())
+                cleaned_error_str = str(e).replace('"', '`') # double quotes would break the response packet's json
+                valueResponse, errorResponses = None, (errorEntry(source="RPi", criticalityLevel="High", description=f"unhandled exception: {cleaned_error_str}. gpio_str:{de.gpio_str}"),)
+            if len(errorResponses) > 0:
+                errors.extend(errorResponses)
+            if valueResponse is None:
+                # populate with an ack response
+                valueResponse = dataEntry(chType = de.chType, gpio_str = de.gpio_str, val = de.val if len(errorResponses) == 0 else "NAK", time = time.time())
+            responses[i] = valueResponse
+        return (responses, errors)
+
+    def _execute_group(self, entries: list[dataEntry], first: int, responses: list, errors: list, observer) -> None:
+        ''' executes the ao entries of `entries` that share the group of `entries[first]` with `write_ao_group`, filling in
+        their responses like `execute_batch` does. Each of them is reported to `observer` with the time of the whole group.'''
+        group = entries[first].group
+        members = [j for j in range(first, len(entries)) if entries[j].group == group]
+        start = time.time()
+        try:
+            groupErrors = self.write_ao_group([(entries[j].gpio_str, entries[j].val) for j in members])
+        except Exception as e:
+            cleaned_error_str = str(e).replace('"', '`')
+            groupErrors = [(errorEntry(source="RPi", criticalityLevel="High", description=f"unhandled exception: {cleaned_error_str}. gpio_str:{entries[j].gpio_str}"),) for j in members]
+        end = time.time()
+        for j, errorResponses in zip(members, groupErrors):
+            de = entries[j]
+            if observer is not None:
+                observer(de, start, end)
+            errors.extend(errorResponses)
+            responses[j] = dataEntry(chType = de.chType, gpio_str = de.gpio_str, val = de.val if len(errorResponses) == 0 else "NAK", time = end)
+
+    def write_ao_group(self, writes: list[Tuple[str, float]]) -> list[Tuple[errorEntry, ...]]:
+        '''
+        Sets several analog outputs so that they change together. Returns the errors of each write, in order.
+        T Click 2 modules are preloaded first: their new code goes into the DAC in protect mode, so their outputs don't
+        move yet. Then every output is switched in one run of back-to-back transfers: an XFER frame for each T Click 2
+        and the (looked up beforehand) data frame for each T Click 1, which has no latch of its own. The outputs thus
+        change within a few SPI frames of each other, with no code conversion or other packet entries in between.
+
+        :param writes: (gpio_str, mA) pairs, e.g. [("GPIO25", 12.0), ("GPIO19", 8.5)]
+        '''
+        errors = [()] * len(writes)
+        transfers = [] # (driver, cs pin, spi function, frame), sent back to back once everything is loaded
+        t1Codes = [] # (T_CLICK_1 driver, code) whose frame is among the transfers
+        for gpio_str, _ in writes:
+            if gpio_str not in self.module_dict:
+                self._get_handler_slow(gpio_str, "ao") # creates the module (which takes the SPI lock itself)
+        transfersBefore = dict() # gpio_str -> numTransfers of its driver before the group
+        with self.spiLock: # no other transfer, e.g. an acquisition sample, can get between the preloads and the latches
+            for i, (gpio_str, mA_val) in enumerate(writes):
+                chType, driverObj = self.module_dict[gpio_str]
+                transfersBefore.setdefault(gpio_str, getattr(driverObj, "numTransfers", 0))
+                if chType.lower() != "ao":
+                    errors[i] = (errorEntry(source = "Module Manager", criticalityLevel = "Medium", description = f"Invalid channel type given ao for module at {gpio_str}, which is set up as {chType}."),)
+                    continue
+                try:
+                    if isinstance(driverObj, T_CLICK_2):
+                        if driverObj.preload_mA(mA_val):
+                            transfers.append((driverObj, driverObj.gpio_cs_pin, driverObj.spi_master.xfer, T_CLICK_2.XFER_FRAME))
+                    else:
+                        code, frame = driverObj.frame_for(mA_val)
+                        if code != driverObj.lastCode:
+                            transfers.append((driverObj, driverObj.gpio_cs_pin, driverObj.spi_master.writebytes, frame))
+                            t1Codes.append((driverObj, code))
+                except Exception as e:
+                    errors[i] = (errorEntry(source = "ao", criticalityLevel = "High", description = f"{e}. Encountered unexpected exception:{gpio_str}"),)
+
+            for driverObj, cs, send, frame in transfers:
+                cs.value = 0
+                send(frame)
+                cs.value = 1
+                driverObj.numTransfers += 1
+        for driverObj, code in t1Codes:
+            driverObj.lastCode = code
+        if self.spiObserver is not None:
+            for gpio_str, before in transfersBefore.items():
+                sent = getattr(self.module_dict[gpio_str][1], "numTransfers", 0) - before
+                if sent > 0:
+                    self.spiObserver(gpio_str, "ao", sent)
+        return errors
+
+    def _get_handler_slow(self, gpio_str: str, chType: str):
+        ''' handler lookup for a (gpio_str, chType) pair that has none yet: creates the module if the gpio is unused,
+        otherwise returns a handler that reports the mismatch'''
+        with self.lock:
+            if gpio_str not in self.module_dict:
+                # not provisioned by a channel map, so create it now. This first command pays for the device creation
+                if self.verbose: print(f"[Module_Manager] making a module entry for {gpio_str} as a {chType}")
+                self.make_module_entry(gpio_str = gpio_str, chType = chType)
+            handler = self.handlers.get((gpio_str, chType.lower()))
+        if handler is not None:
+            return handler
+        existingType = self.module_dict.get(gpio_str)[0]
+        err = (errorEntry(source = "Module Manager", criticalityLevel = "Medium", description = f"Invalid channel type given {chType} for module at {gpio_str}, which is set up as {existingType}."),)
+        return lambda val: (None, err)
+
+    def _bind_handler(self, gpio_str: str, chType: str, driverObj) -> None:
+        ''' builds the one callable that executes commands for this channel. A handler takes the packet `val` and returns
+        (valueResponse or None, sequence of errorEntry). Everything that does not depend on `val` is looked up here once,
+        so that a command costs little more than the hardware access itself.'''
+        noErrors = ()
+        chType = chType.lower()
+
+        spiLock = self.spiLock
+        spiObserver = self.spiObserver
+        if chType == "ao": # then it's a T_CLICK_1 or T_CLICK_2 instance (see `set_ao_module`)
+            write_mA = driverObj.write_mA
+            def handler(val):
+                before = driverObj.numTransfers
+                try:
+                    with spiLock:
+                        write_mA(val)
+                except Exception as e:
+                    return (None, (errorEntry(source = "ao", criticalityLevel = "High", description = f"{e}. Encountered unexpected exception:{gpio_str}"),))
+                finally:
+                    # counted by the driver, so a write of the value the DAC already holds doesn't count
+                    if spiObserver is not None and driverObj.numTransfers != before:
+                        spiObserver(gpio_str, chType, driverObj.numTransfers - before)
+                # don't update the valueResponse with anything. This is no ao signal, so don't return anything
+                return (None, noErrors)
+        elif chType == "ai": # then it's an R_CLICK instance
+            read_mA = driverObj.read_mA
+            def handler(val):
+                # the ai adc readings can be noisy, so do a simple average to attenuate noise
+                numMeasurements = max(int(val), 1) # at least one measurement
+                sum = 0
+                for _ in range(numMeasurements):
+                    with spiLock: # per read, so that an ao write never waits for the whole average
+                        sum += read_mA()
+                if spiObserver is not None:
+                    spiObserver(gpio_str, chType, numMeasurements)
+                ma_reading = sum / numMeasurements
+                valueResponse = dataEntry(chType = chType, gpio_str = gpio_str, val = ma_reading, time = time.time())
+                if ma_reading == 0: # there is always a small amount of random noise that can be read on the adc chip to indicate a valid SPI connection
+                    return (valueResponse, (errorEntry(source = "ai", criticalityLevel = "High", description = f"SPI communication error detected:{gpio_str}"),))
+                return (valueResponse, noErrors)
+        elif chType == "do": # then it's a relay channel instance
+            writeState = driverObj.writeState
+            def handler(val):
+                writeState(state = bool(val))
+                # don't update either the value response or the error response list
+                return (None, noErrors)
+        elif chType == "di": # then it's a comparator channel instance
+            readState = driverObj.readState
+            def handler(val):
+                if driverObj.counting: # pulse counter mode: a dict reading instead of the level (see `start_counter`)
+                    return (dataEntry(chType = chType, gpio_str = gpio_str, val = driverObj.readCounter(), time = time.time()), noErrors)
+                return (dataEntry(chType = chType, gpio_str = gpio_str, val = int(readState()), time = time.time()), noErrors)
 
         # the "in" chtype is not controlled by packet data. The RPi locally controls the indicator lights, but
         # we still need the GUI to tell the RPi which GPIO pin the lights are using
-        elif chType.lower() == "in": # indicator light
-            # different indication modes: 2:blink rapidly, 1:solid on, 0:off
-            if val==2:
-                driverObj.setBlink(on_time=0.3, off_time=0.3)
-            elif val==1:
-                driverObj.turnOn()
-            elif val==0:
-                driverObj.turnOff()
-            valueResponse = None
-            errorResponse_list.append(errorEntry(source = "Module Manager", criticalityLevel = "Medium", description = "The indicator light channel is reserved. Any commands from master will be ignored."))
+        elif chType == "in": # indicator light
+            reserved = (errorEntry(source = "Module Manager", criticalityLevel = "Medium", description = "The indicator light channel is reserved. Any commands from master will be ignored."),)
+            def handler(val):
+                # different indication modes: 2:blink rapidly, 1:solid on, 0:off
+                if val==2:
+                    driverObj.setBlink(on_time=0.3, off_time=0.3)
+                elif val==1:
+                    driverObj.turnOn()
+                elif val==0:
+                    driverObj.turnOff()
+                return (None, reserved)
         else:
-            valueResponse = None
-            errorResponse_list.append(errorEntry(source = "Module Manager", criticalityLevel = "Medium", description = f"Invalid channel type given {chType} for module at {gpio_str}."))
+            invalid = (errorEntry(source = "Module Manager", criticalityLevel = "Medium", description = f"Invalid channel type given {chType} for module at {gpio_str}."),)
+            def handler(val):
+                return (None, invalid)
+
+        self.handlers[(gpio_str, chType)] = handler
+
+    def provision(self, channels: list[Tuple[str, str]]) -> list[errorEntry]:
+        '''
+        Creates the driver and GPIO reservation for every channel of a channel map ahead of time, so that the first
+        command on each channel costs no more than any other. Channels that already exist are left alone.
+        Returns an error entry for every channel that could not be created.
+
+        :param channels: (gpio_str, chType) pairs, e.g. [("GPIO25", "ao"), ("GPIO23", "ai")]
+        '''
+        errors = []
+        with self.lock:
+            todo = []
+            for gpio_str, chType in channels:
+                existing = self.module_dict.get(gpio_str)
+                if existing is None:
+                    todo.append((gpio_str, chType))
+                elif existing[0].lower() != chType.lower():
+                    errors.append(errorEntry(source = "Module Manager", criticalityLevel = "Medium", description = f"Channel map asks for {gpio_str} as {chType}, but it is already in use as {existing[0]}."))
+            if len(todo) == 0:
+                return errors
+
+            # one at a time: neither GPIO_Manager nor gpiozero's lazily created pin factory is thread-safe, and the
+            # drivers share the SPI bus (some of them write to the chip when created). It's a one-off startup cost
+            numCreated = 0
+            for gpio_str, chType in todo:
+                try:
+                    self.make_module_entry(gpio_str = gpio_str, chType = chType)
+                    numCreated += 1
+                except Exception as e:
+                    errors.append(errorEntry(source = "Module Manager", criticalityLevel = "High", description = f"Could not provision {gpio_str} as {chType}: {e}"))
+        print(f"[module_manager.provision] provisioned {numCreated} of {len(todo)} new channels")
+        return errors
+
+    def set_ao_module(self, gpio_str: str, module: str) -> list[errorEntry]:
+        '''
+        Chooses the driver of the ao channel at `gpio_str`: "T_CLICK_1" (the default) or "T_CLICK_2". It takes effect when
+        the channel is created, so call it before `provision`. Returns an error entry if the name is unknown or if the
+        channel already exists with another driver.
+        '''
+        if module not in self.AO_MODULES:
+            return [errorEntry(source = "Module Manager", criticalityLevel = "Medium", description = f"Unknown ao module {module} for {gpio_str}. Use one of {list(self.AO_MODULES.keys())}.")]
+        with self.lock:
+            self.aoModules[gpio_str] = module
+            existing = self.module_dict.get(gpio_str)
+            if existing is not None and existing[0].lower() == "ao" and not isinstance(existing[1], self.AO_MODULES[module]):
+                return [errorEntry(source = "Module Manager", criticalityLevel = "Medium", description = f"{gpio_str} already runs as {type(existing[1]).__name__}; restart the RPi server to make it a {module}.")]
+        return []
+
+    def enable_edge_capture(self, capacity: int = 256) -> None:
+        '''
+        Turns on edge capture for every di module, existing and future: each transition of the pin is recorded with
+        its own timestamp as it happens, so that short pulses between two polls are not missed. Collect the edges
+        with `take_edges`.
+
+        :param capacity: edges kept per pin between two `take_edges` calls; older ones are dropped (and reported)
+        '''
+        with self.lock:
+            self.edgeCapacity = capacity
+            for chType, driverObj in self.module_dict.values():
+                if chType.lower() == "di":
+                    driverObj.startEdgeCapture(capacity = capacity)
+
+    def start_counter(self, gpio_str: str, gate_s: float) -> list[errorEntry]:
+        '''
+        Puts the di module at `gpio_str` in pulse counter mode (creating it if needed). From then on a di command on
+        that channel is answered with {"count", "freq_hz", "duty", "level"} for the last complete gate of `gate_s`
+        seconds instead of the 0/1 level. Returns an error entry if the channel is not a di.
+        '''
+        with self.lock:
+            if gpio_str not in self.module_dict:
+                self.make_module_entry(gpio_str = gpio_str, chType = "di")
+            chType, driverObj = self.module_dict[gpio_str]
+            if chType.lower() != "di":
+                return [errorEntry(source = "Module Manager", criticalityLevel = "Medium", description = f"Cannot count pulses on {gpio_str}, which is set up as {chType}.")]
+            try:
+                driverObj.startCounter(gate_s = gate_s)
+            except Exception as e: # reported in the channel map's reply rather than losing the whole reply
+                return [errorEntry(source = "Module Manager", criticalityLevel = "High", description = f"Could not start the pulse counter of {gpio_str}: {e}".replace('"', '`'))]
+        return []
+
+    def start_acquisition(self, rate_hz: float, channels: dict, buffer_size: int = 256) -> list[errorEntry]:
+        '''
+        Samples the given ai channels in the background (creating them if needed) and answers their read requests
+        from the latest filtered value instead of reading the ADC on request; the request's `val` (the boxcar length)
+        is then ignored. Calling it again with the same settings (e.g. the channel map after a reconnect) keeps the
+        running loop and its buffers. Returns an error entry for every channel that keeps reading on request.
+
+        :param rate_hz: samples per second per channel
+        :param channels: {gpio_str: filter config}, e.g. {"GPIO23": {"type": "median", "window": 9}} (see acquisition.py)
+        :param buffer_size: raw samples kept per channel
+        '''
+        config = (rate_hz, buffer_size, channels)
+        if config == self.acquisitionConfig:
+            return []
+        errors = []
+        readers, filters = dict(), dict()
+        with self.lock:
+            for gpio_str, filterConfig in channels.items():
+                if gpio_str not in self.module_dict:
+                    self.make_module_entry(gpio_str = gpio_str, chType = "ai")
+                chType, driverObj = self.module_dict[gpio_str]
+                if chType.lower() != "ai":
+                    errors.append(errorEntry(source = "Module Manager", criticalityLevel = "Medium", description = f"Cannot acquire {gpio_str} in the background, which is set up as {chType}."))
+                    continue
+                try:
+                    filters[gpio_str] = ChannelFilter(bufferSize = buffer_size, **filterConfig)
+                except (TypeError, ValueError) as e:
+                    errors.append(errorEntry(source = "Module Manager", criticalityLevel = "Medium", description = f"Invalid ai filter for {gpio_str}: {e}".replace('"', '`')))
+                    continue
+                readers[gpio_str] = driverObj.read_mA
+
+            if self.acquisition is not None:
+                self.acquisition.stop()
+                for gpio_str in self.acquisition.readers: # back to reading on request
+                    self._bind_handler(gpio_str, "ai", self.module_dict[gpio_str][1])
+            self.acquisition = None
+            self.acquisitionConfig = config
+            if len(readers) > 0:
+                self.acquisition = AcquisitionLoop(readers, filters, rate_hz = rate_hz, spiLock = self.spiLock,
+                                                   spiObserver = self.spiObserver)
+                for gpio_str in readers:
+                    self._bind_cached_ai_handler(gpio_str)
+                self.acquisition.start()
+        return errors
+
+    def reads_from_cache(self, gpio_str: str) -> bool:
+        ''' True if ai requests for `gpio_str` are answered by the acquisition loop (see `start_acquisition`) '''
+        acquisition = self.acquisition
+        return acquisition is not None and gpio_str in acquisition.filters
 
-        return (valueResponse, errorResponse_list)
+    def _bind_cached_ai_handler(self, gpio_str: str) -> None:
+        ''' replaces the ai handler of `gpio_str` with one that answers from the acquisition loop. If the loop's value is
+        stale (see AcquisitionLoop.is_stale), the channel is read on request instead and the stall is reported '''
+        acquisition = self.acquisition
+        latest = acquisition.filters[gpio_str]
+        readOnRequest = self.handlers[(gpio_str, "ai")]
+        noErrors = ()
+        def handler(val):
+            cached = latest.latest
+            if cached is None: # no filtered value yet (the loop has only just started)
+                return readOnRequest(val)
+            ma_reading, t = cached
+            if acquisition.is_stale(gpio_str, t):
+                try:
+                    valueResponse, errorResponses = readOnRequest(val)
+                except Exception as e: # most likely the same fault that stalled the loop
+                    valueResponse, errorResponses = None, (errorEntry(source = "ai", criticalityLevel = "High", description = f"{e}. Encountered unexpected exception:{gpio_str}".replace('"', '`')),)
+                reason = acquisition.readErrors.get(gpio_str, "the acquisition loop is behind")
+                stalled = errorEntry(source = "ai", criticalityLevel = "Medium", description = f"Background acquisition stalled, no sample for {int((time.time() - t)*1000)} ms ({reason}); read on request:{gpio_str}".replace('"', '`'))
+                return (valueResponse, tuple(errorResponses) + (stalled,))
+            valueResponse = dataEntry(chType = "ai", gpio_str = gpio_str, val = ma_reading, time = t)
+            if ma_reading == 0: # see the ai handler in `_bind_handler`
+                return (valueResponse, (errorEntry(source = "ai", criticalityLevel = "High", description = f"SPI communication error detected:{gpio_str}"),))
+            return (valueResponse, noErrors)
+        self.handlers[(gpio_str, "ai")] = handler
 
+    def take_edges(self) -> Tuple[list[dataEntry], list[errorEntry]]:
+        ''' removes the edges captured on every di module since the last call and returns them as di entries (the
+        value after the edge, timed at the edge), oldest first, and an error entry for every pin that lost edges '''
+        if self.edgeCapacity == 0:
+            return ([], [])
+        edges = []
+        errors = []
+        for gpio_str, (chType, driverObj) in list(self.module_dict.items()):
+            if chType.lower() != "di":
+                continue
+            taken, lost = driverObj.takeEdges()
+            edges.extend(dataEntry(chType = "di", gpio_str = gpio_str, val = val, time = t) for t, val in taken)
+            if lost > 0:
+                errors.append(errorEntry(source = "di", criticalityLevel = "Medium", description = f"{lost} edges were lost because the edge buffer of {gpio_str} was full"))
+        edges.sort()
+        return (edges, errors)
 
     def make_module_entry(self, gpio_str: str, chType: str):
         # add an entry to the dictionary because it doesn't exist yet.
-        # Also need to request the gpio_manager to add a GPIO object to itself
-        self.gpio_manager.put_gpio(gpio_str, chType = chType)
-        print(f"[module_manager.make_module_entry] after put_gpio, list is {self.gpio_manager.gpio_dict}")
+        # Also need to request the gpio_manager to add a GPIO object to itself (unless `provision` already did)
+        if self.gpio_manager.get_gpio(gpio_str) is None:
+            self.gpio_manager.put_gpio(gpio_str, chType = chType)
+        if self.verbose: print(f"[module_manager.make_module_entry] after put_gpio, list is {self.gpio_manager.gpio_dict}")
 
         # now create a driver object for the module of the correct type
         if chType.lower() == "ai":
             driverObj = R_CLICK(gpio_cs_pin = self.gpio_manager.get_gpio(gpio_str),
                                 spi = self.spi)
         elif chType.lower() == "ao":
-            driverObj = T_CLICK_1(gpio_cs_pin = self.gpio_manager.get_gpio(gpio_str),
-                                    spi = self.spi)
+            with self.spiLock: # the T Click 2 configures its chip when it is created
+                driverObj = self.AO_MODULES[self.aoModules.get(gpio_str, "T_CLICK_1")](gpio_cs_pin = self.gpio_manager.get_gpio(gpio_str),
+                                                                                     spi = self.spi)
         
         elif chType.lower() == "di":
             driverObj = Digital_Input_Module(gpio_in_pin = self.gpio_manager.get_gpio(gpio_str))
+            if self.edgeCapacity > 0:
+                driverObj.startEdgeCapture(capacity = self.edgeCapacity)
         elif chType.lower() == "do":
             driverObj = RELAY_CHANNEL(gpio_out_pin = self.gpio_manager.get_gpio(gpio_str))
         elif chType.lower() == "in": # this channel is not writable by the master. We include it here so that the 
@@ -125,14 +462,20 @@ class Module_Manager:
         else:
             driverObj = None
             warnings.warn(f"[module_manager] Invalid channel type {chType}")
-        print("[Module_Manager make_module_entry] will insert key {gpio_str} with values {chType} and {driverObj}")
+        if self.verbose: print(f"[Module_Manager make_module_entry] will insert key {gpio_str} with values {chType} and {driverObj}")
         self.module_dict[gpio_str] = [chType, driverObj]
-        print(f"[module_manager.make_module_entry] new module_dict is {self.module_dict}")
+        self._bind_handler(gpio_str, chType, driverObj)
+        if self.verbose: print(f"[module_manager.make_module_entry] new module_dict is {self.module_dict}")
     
     def release_all_modules(self):
-        for chType, driver_obj in self.module_dict.values():
-            driver_obj.close()
+        if self.acquisition is not None:
+            self.acquisition.stop()
+            self.acquisition = None
+        with self.spiLock:
+            for chType, driver_obj in self.module_dict.values():
+                driver_obj.close()
 
         self.gpio_manager.release_all_gpios()
         self.module_dict.clear()
+        self.handlers.clear()
 
@@ -16,12 +16,20 @@ import time
 from datetime import datetime
 import spidev
 import os
+import json
+import queue
+from collections import deque
 
 import sys
 sys.path.insert(0, "/home/fsepi51/Documents/FSE_Capstone_sim") # allow this file to find other project modules
 
 from PacketBuilder import dataEntry, errorEntry, DataPacketModel
+from Transport import FramedSocket
 from module_manager import Module_Manager
+from timing_stats import TimingStats, make_thread_realtime
+from metrics import ServerMetrics, start_metrics_server
+from relay_sequencer import RelaySequencer
+from report_by_exception import ReportByException
 
 # these are not special queues because the RPI is not resposible for managing
 # the timing of output data
@@ -30,6 +38,42 @@ outQueue = list() # list of dataEntries to be sent back to master
 errorList = [] # most recent at end
 
 mutex = Lock()
+batchLock = Lock() # one batch at a time goes through the hardware thread
+gpioLock = Lock() # one batch at a time on the gpio lane (digital-only batches, which skip the hardware thread)
+GPIO_LANE_CHTYPES = ("do", "di") # plain gpio, never touches the SPI bus
+workReady = threading.Event() # set by handle_client once a batch is on the commandQueue
+batchDone = threading.Event() # set by the hardware thread once it has executed the whole batch
+
+# optional real-time scheduling of the hardware thread (needs root), e.g. in the systemd unit:
+# Environment=SIM_RT_PRIORITY=50
+# Environment=SIM_RT_CPUS=3
+rt_priority = int(os.environ["SIM_RT_PRIORITY"]) if os.environ.get("SIM_RT_PRIORITY") else None
+rt_cpus = {int(c) for c in os.environ["SIM_RT_CPUS"].split(",")} if os.environ.get("SIM_RT_CPUS") else None
+
+timing_stats = TimingStats() # intended vs actual time of every output write; the master reads it with a `q` packet
+
+# counters and histograms are always kept; set SIM_METRICS_PORT (e.g. 9100) to serve them at http://<pi>:<port>/metrics
+metrics = ServerMetrics()
+if os.environ.get("SIM_METRICS_PORT"):
+    start_metrics_server(metrics.registry, port = int(os.environ["SIM_METRICS_PORT"]))
+
+# SO_SNDBUF / SO_RCVBUF of every client connection, e.g. Environment=SIM_SOCKET_BUFFER_BYTES=262144. OS default if unset
+socket_buffer_bytes = int(os.environ["SIM_SOCKET_BUFFER_BYTES"]) if os.environ.get("SIM_SOCKET_BUFFER_BYTES") else None
+
+# while a batch that the master asked to trace is in the hardware thread: (spans, {id(entry): index in the packet}).
+# The spans are sent back in the reply's info; see Tracer.py on the master side
+batchTrace = None
+# the "encode reply" and "send reply" spans of traced packets; they end after their own reply has gone out, so they
+# are sent with the next traced reply instead (info["trace_late"])
+lateTraceSpans = deque(maxlen = 256)
+
+def _observe_execution(de, start, end):
+    # observer for execute_batch: feeds both the timing histograms and the metrics
+    timing_stats.on_executed(de, start, end)
+    metrics.on_executed(de, start, end, cached = de.chType == "ai" and my_module_manager.reads_from_cache(de.gpio_str))
+    trace = batchTrace
+    if trace is not None:
+        trace[0].append([f"execute {de.chType}", start, end, trace[1].get(id(de), -1), "hardware"])
 
 # assumes that one spi bus is connected to all modules
 spi = spidev.SpiDev()
@@ -37,66 +81,300 @@ spi.open(0, 0)
 spi.max_speed_hz = 10000
 spi.no_cs
 
-my_module_manager = Module_Manager(spi = spi)
+my_module_manager = Module_Manager(spi = spi, verbose = False, spiObserver = metrics.on_spi_transfers)
 indicator_gpio_str = "GPIO20"
 my_module_manager.make_module_entry(gpio_str=indicator_gpio_str, chType="in") # indicator light
+
+# input readings within their channel's deadband are left out of the replies (configured by the master's channel map)
+report_filter = ReportByException()
+
+# relay sequences uploaded by the master run on their own thread, with the hardware thread's scheduling
+relay_sequencer = RelaySequencer(my_module_manager, rt_priority = rt_priority, rt_cpus = rt_cpus)
+
+# optional: a channel map saved next to this file lets the drivers be created before the master first connects.
+# Format: {"channels": [{"chType": "ao", "gpio_str": "GPIO25"}, {"chType": "ai", "gpio_str": "GPIO23"}, ...]}
+# The master also sends its own map (a `c` packet) whenever it connects; see SocketSenderManager.set_channel_map
+channel_map_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "channel_map.json")
+if os.path.exists(channel_map_path):
+    try:
+        with open(channel_map_path, 'r') as f:
+            startup_channels = json.load(f).get("channels", [])
+        for err in my_module_manager.provision([(c["gpio_str"], c["chType"]) for c in startup_channels]):
+            errorList.append(err) # reported to the master with the first response
+    except Exception as e:
+        print(f"[mt_server_w_handlers] could not load channel map from {channel_map_path}: {e}")
         
 # --- functions ---
 
 def handle_client(conn, addr, commandQueue):
 
-    # this thread reads data from the active socket, passes to the commandQueue, and waits
-    # for the GPIO handler thread to place outgoing data onto the outQueue.
-    # Once the outqueue is non-empty, this thread sends a response over the active socket
+    # this thread reads data from the active socket and answers every packet on it.
+    # A packet without a `seq` is answered once, then the connection is closed (the original protocol).
+    # A packet with a `seq` keeps the connection open: every packet read from it afterwards goes to the worker of
+    # its lane (see `_lane_of`), and the replies go back (tagged with the request's seq) in whatever order they finish.
+    # Each lane runs its packets one at a time in the order they arrived, so only packets of different lanes can
+    # finish out of order (see SocketSenderManager's `pipelined` mode on the master side)
 
     print("[thread] new thread for handling the client has started")
+    framed = FramedSocket(conn, sendBufferSize = socket_buffer_bytes, recvBufferSize = socket_buffer_bytes,
+                          onTransfer = metrics.on_transfer)
+    sendLock = Lock() # replies of a pipelined connection are written by several threads
+    pipelined = False
+    lanes = dict() # lane name -> (queue.Queue of packets, its worker Thread)
+
+    while True:
+        # recv message
+        try:
+            parseStart = time.time()
+            dpm = DataPacketModel.from_socket(framed)
+            receiveTime = time.time()
+        except ConnectionError as e:
+            if not pipelined: # a pipelined master closes its end whenever it's done
+                print(f"[handle_client] connection closed before a packet arrived: {e}")
+            break
+        except (ValueError, OSError) as e:
+            print(f"[handle_client] error reading socket data. Will close socket connection. Error is {e}")
+            break
+
+        # every packet (heartbeats especially, since they arrive steadily) refines the master clock offset estimate
+        timing_stats.on_packet(master_send_time = dpm.time, receive_time = receiveTime)
+
+        if dpm.seq is None:
+            _serve_packet(framed, sendLock, dpm, commandQueue, parseStart, receiveTime)
+            break
+        pipelined = True
+        lane = _lane_of(dpm)
+        if lane not in lanes:
+            laneQueue = queue.Queue()
+            worker = Thread(target=_serve_lane, args=(framed, sendLock, laneQueue, commandQueue), daemon=True)
+            worker.start()
+            lanes[lane] = (laneQueue, worker)
+        lanes[lane][0].put((dpm, parseStart, receiveTime))
+
+    for laneQueue, worker in lanes.values():
+        laneQueue.put(None) # the packets already read are still answered
+    for laneQueue, worker in lanes.values():
+        worker.join()
+    conn.close() # this will flush out all data on output buffer
+
+def _lane_of(dpm):
+    # digital-only batches never wait behind SPI transfers; heartbeats and queries never wait behind either
+    if dpm.msg_type in ("h", "q"):
+        return "control"
+    if dpm.msg_type == "d" and dpm.data_entries and all(de.chType in GPIO_LANE_CHTYPES for de in dpm.data_entries):
+        return "gpio"
+    return "spi"
+
+def _serve_lane(framed, sendLock, laneQueue, commandQueue):
+    # worker of one lane of a pipelined connection: answers its packets in arrival order until it gets None
+    while True:
+        item = laneQueue.get()
+        if item is None:
+            return
+        dpm, parseStart, receiveTime = item
+        _serve_packet(framed, sendLock, dpm, commandQueue, parseStart, receiveTime)
 
-    # recv message
+def _serve_packet(framed, sendLock, dpm, commandQueue, parseStart, receiveTime):
+    # builds the reply to one packet and writes it back on the connection
     try:
-        dpm = DataPacketModel.from_socket(conn)
-    except ValueError as e:
-        print(f"ValueError: unexpected error parsing socket data. Will close socket connection. Error is {e}")
-        conn.close()
-        return
+        dpm_out = _handle_packet(dpm, commandQueue, parseStart, receiveTime)
+        handledTime = time.time()
+        dpm_out.seq = dpm.seq # the correlation id: tells the master which request this reply answers
+        if dpm_out.msg_type == "d":
+            _suppress_unchanged(dpm_out)
+            _attach_edges(dpm_out)
+        traced = dpm_out.info is not None and "trace_clock" in dpm_out.info
+        if traced:
+            encodeStart = time.time()
+            dpm_out.info["trace"].append(["build reply", handledTime, encodeStart, -1, "handle_client"])
+            late = []
+            while len(lateTraceSpans) > 0:
+                late.append(lateTraceSpans.popleft())
+            if len(late) > 0:
+                dpm_out.info["trace_late"] = late
+            dpm_out.info["trace_clock"][1] = encodeStart # the reply's send time, as close to the socket as it can be
+        payload = dpm_out.get_payload_bytes()
+        encodeEnd = time.time()
+        with sendLock:
+            framed.send_frame(dpm_out.msg_type, payload)
+        if traced:
+            packetId = dpm.info["trace"]
+            lateTraceSpans.append([packetId, "encode reply", encodeStart, encodeEnd, -1, "handle_client"])
+            lateTraceSpans.append([packetId, "send reply", encodeEnd, time.time(), -1, "handle_client"])
+    except Exception as e:
+        print(f"[mt_server_w_handlers.handle_client] encountered the following error on {dpm.msg_type} reply: {e}")
+    finally:
+        metrics.request_seconds.observe(time.time() - receiveTime, dpm.msg_type)
 
-    
+def _attach_edges(dpm_out):
+    # di edges captured since the last reply ride along in `info`, so that the data entries keep their one
+    # response per command. See Module_Manager.enable_edge_capture
+    try:
+        edges, edgeErrors = my_module_manager.take_edges()
+    except Exception as e: # the reply itself must still go out
+        cleaned_error_str = _clean_string_for_json(str(e))
+        edges, edgeErrors = [], [errorEntry(source="di", criticalityLevel="High", description=f"Could not collect the captured di edges: {cleaned_error_str}")]
+    if len(edges) == 0 and len(edgeErrors) == 0:
+        return
+    info = dpm_out.info if dpm_out.info is not None else {}
+    info["edges"] = [de.as_dict() for de in edges]
+    dpm_out.info = info
+    dpm_out.error_entries = (dpm_out.error_entries or []) + edgeErrors
+
+def _suppress_unchanged(dpm_out):
+    # report by exception: readings that stayed within their channel's deadband are only named in `info`,
+    # so the master knows they were read without getting (and redrawing) the same value again
+    kept, unchanged = report_filter.filter(dpm_out.data_entries or [])
+    if len(unchanged) == 0:
+        return
+    dpm_out.data_entries = kept
+    info = dpm_out.info if dpm_out.info is not None else {}
+    info["unchanged"] = unchanged
+    dpm_out.info = info
+
+def _handle_packet(dpm, commandQueue, parseStart, receiveTime) -> DataPacketModel:
+    # returns the reply to `dpm`
+    if dpm.msg_type == "h":
+        # heartbeat from the master's link monitor: echo it straight back. Don't touch the command queue,
+        # so that a heartbeat never waits behind (or interferes with) a batch of hardware commands
+        return DataPacketModel(dataEntries = [], msg_type = "h", error_entries = None, time = dpm.time)
+
+    if dpm.msg_type == "c":
+        # channel map from the master: create every driver now rather than on each channel's first command.
+        # Answered with the entries that were provisioned and any errors
+        entries = dpm.data_entries if dpm.data_entries is not None else []
+        edgeBuffer = (dpm.info or {}).get("di_edge_capture", 0)
+        if edgeBuffer > 0: # before provisioning, so the new di modules start capturing right away
+            my_module_manager.enable_edge_capture(capacity = edgeBuffer)
+        report_filter.configure((dpm.info or {}).get("report_by_exception", {}))
+        provisionErrors = []
+        for gpio_str, module in (dpm.info or {}).get("ao_modules", {}).items(): # before provisioning creates the drivers
+            provisionErrors += my_module_manager.set_ao_module(gpio_str, module)
+        provisionErrors += my_module_manager.provision([(de.gpio_str, de.chType) for de in entries])
+        for gpio_str, gate_ms in (dpm.info or {}).get("di_counters", {}).items():
+            provisionErrors += my_module_manager.start_counter(gpio_str, gate_s = gate_ms / 1000)
+        acquisition = (dpm.info or {}).get("ai_acquisition")
+        if acquisition is not None: # ai channels sampled in the background and read from cache
+            provisionErrors += my_module_manager.start_acquisition(rate_hz = acquisition.get("rate_hz", 100),
+                                                                   channels = acquisition.get("channels", {}),
+                                                                   buffer_size = acquisition.get("buffer", 256))
+        return DataPacketModel(dataEntries = entries, msg_type = "c", error_entries = provisionErrors, time = time.time())
+
+    if dpm.msg_type == "q":
+        # query from the master. Answered right away; doesn't touch the command queue
+        request = dpm.info if dpm.info is not None else {}
+        if request.get("request") == "timing":
+            info = {"timing": timing_stats.report(reset=bool(request.get("reset", 0)))}
+        elif request.get("request") == "relay_sequence":
+            seqId, err = relay_sequencer.start(request.get("steps", []))
+            info = {"sequence_id": seqId} if err is None else {"error": _clean_string_for_json(err)}
+        elif request.get("request") == "relay_sequence_result":
+            # the clock offset lets the master put the switch times on its own clock
+            info = {"sequence": relay_sequencer.result(request.get("sequence_id", 0)) or {"state": "unknown"},
+                    "clock_offset_ms": timing_stats.clock_offset() * 1000}
+        elif request.get("request") == "relay_sequence_cancel":
+            relay_sequencer.cancel()
+            info = {}
+        else:
+            info = {"error": f"unknown request {request.get('request')}"}
+        return DataPacketModel(dataEntries = [], msg_type = "q", error_entries = None, time = time.time(), info = info)
+
+    if dpm.info is not None and "ao_groups" in dpm.info:
+        _mark_groups(dpm)
+
+    if _lane_of(dpm) == "gpio":
+        # digital only: run it right here rather than queueing behind a batch of SPI transfers on the hardware thread,
+        # so that a relay toggle doesn't wait for a slow boxcar-averaged ai read
+        with gpioLock:
+            return _execute_on_gpio_lane(dpm, parseStart, receiveTime)
+
+    with batchLock:
+        return _execute_on_hardware_thread(dpm, commandQueue, parseStart, receiveTime)
+
+def _mark_groups(dpm):
+    # tags the entries named by the packet's "ao_groups" so that execute_batch writes each group together.
+    # Group numbers only need to be unique within the packet: the hardware thread runs one packet at a time
+    entries = dpm.data_entries or []
+    for group, indices in enumerate(dpm.info["ao_groups"]):
+        for i in indices:
+            if 0 <= i < len(entries) and entries[i].chType == "ao":
+                entries[i].group = group
+
+def _execute_on_gpio_lane(dpm, parseStart, receiveTime) -> DataPacketModel:
+    traced = dpm.info is not None and "trace" in dpm.info
+    if traced:
+        spans = [["parse", parseStart, receiveTime, -1, "handle_client"],
+                 ["wait for gpio lane", receiveTime, time.time(), -1, "handle_client"]]
+        index = {id(de): i for i, de in enumerate(dpm.data_entries)}
+
+    def observer(de, start, end):
+        # like _observe_execution, but with this packet's own spans (batchTrace belongs to the hardware thread)
+        timing_stats.on_executed(de, start, end)
+        metrics.on_executed(de, start, end)
+        if traced:
+            spans.append([f"execute {de.chType}", start, end, index.get(id(de), -1), "gpio lane"])
+
+    for de in dpm.data_entries:
+        metrics.commands_received.inc(de.chType)
+    try:
+        responses, err_resp_list = my_module_manager.execute_batch(dpm.data_entries, observer = observer)
+    except Exception as e:
+        cleaned_error_str = _clean_string_for_json(str(e))
+        responses, err_resp_list = [], [errorEntry(source="RPi", criticalityLevel="High", description=f"unhandled exception: {cleaned_error_str}")]
+    metrics.on_errors(err_resp_list)
+
+    info = {"trace": spans, "trace_clock": [parseStart, time.time()]} if traced else None
+    return DataPacketModel(dataEntries = responses, msg_type = "d", error_entries = err_resp_list, time = time.time(), info = info)
+
+def _execute_on_hardware_thread(dpm, commandQueue, parseStart, receiveTime) -> DataPacketModel:
+    global batchTrace
+    traced = dpm.info is not None and "trace" in dpm.info
+    if traced:
+        lockedTime = time.time()
+        spans = [["parse", parseStart, receiveTime, -1, "handle_client"],
+                 ["wait for batch lock", receiveTime, lockedTime, -1, "handle_client"]]
+        batchTrace = (spans, {id(de): i for i, de in enumerate(dpm.data_entries or [])})
 
     # if dpm.msg_type == "d":
     if dpm.data_entries is not None:
+        for de in dpm.data_entries:
+            metrics.commands_received.inc(de.chType)
         with mutex:
             commandQueue += dpm.data_entries # now the GPIO handler can start executing thes commands
+            metrics.queue_depth.set(len(commandQueue))
         print(f"[handle client] placed {len(dpm.data_entries)} dpm entries on command queue")
     else :
         print("[handle client] received empty data packet")
     
     
-    # immediately send data back to waiting client...
     # the GPIO handler thread will place at least one element onto the outQueue
     # even if its just an ACK
 
-    # loop infinitely while there's not stuff on the outQueue
-    # and there's still stuff remaining on the commandQueue
-    while len(commandQueue) > 0:
-        # the commandQueueManager will clear the commandQueue when it finishes the batch
-        pass
-        
-    dpm_out = DataPacketModel(dataEntries = outQueue, 
-                              msg_type = "d", 
-                              error_entries = errorList, 
-                              time = time.time())
-    
-    packet_contents = dpm_out.get_packet_as_string().encode()
-    try:
-        conn.send(packet_contents)
-    except Exception as e:
-        print(f"[mt_server_w_handlers.handle_client] encountered the following error on send: {e}")
-        conn.close()
-        return
-
-    outQueue.clear() # reset because we've sent all of them to the master
-    errorList.clear()
-    
-    conn.close() # this will flush out all data on output buffer
+    # wait (without spinning) until the hardware thread has finished the batch
+    queuedTime = time.time()
+    batchDone.clear()
+    workReady.set()
+    batchDone.wait()
+
+    info = None
+    if traced:
+        batchTrace = None
+        doneTime = time.time()
+        executeStarts = [sp[1] for sp in spans if sp[4] == "hardware"]
+        spans.append(["wait for hardware thread", queuedTime, min(executeStarts) if len(executeStarts) > 0 else doneTime, -1, "handle_client"])
+        spans.append(["hardware batch", queuedTime, doneTime, -1, "handle_client"])
+        # the receive and send times let the master put these spans on its own clock
+        info = {"trace": spans, "trace_clock": [parseStart, time.time()]}
+
+    with mutex:
+        dpm_out = DataPacketModel(dataEntries = list(outQueue), 
+                                  msg_type = "d", 
+                                  error_entries = list(errorList), 
+                                  time = time.time(),
+                                  info = info)
+        outQueue.clear() # reset because these all go to the master
+        errorList.clear()
+    return dpm_out
 
 def _replace_double_quotes(s: str):
     # to satisfy json syntax (required when master parses error messages)
@@ -120,43 +398,36 @@ def commandQueueManager(commandQueue, outQueue):
 
     # call the carrier board object to execute the data entries placed on the outQueue
     print("[commandQueueManager] thread has started")
+    for warning in make_thread_realtime(priority = rt_priority, cpus = rt_cpus):
+        print(f"[commandQueueManager] {warning}")
     while True:
         try:
+            workReady.wait()
+            workReady.clear()
             if len(commandQueue) != 0:
                 # send data to R1000
-                for de in commandQueue: # a list of data entries
-                    
-                    # try to find the carrier board object that corresponds to the data entry
-                    # this execute_command method handles the different behaviors necessary for inputs vs outputs
-                    try:
-                        de_resp, err_resp_list = my_module_manager.execute_command(gpio_str = de.gpio_str, chType = de.chType, val = de.val)
-                    except Exception as e:
-                        cleaned_error_str = _clean_string_for_json(str(e))
-                        errorList.append(errorEntry(source="RPi", criticalityLevel="High", description=f"unhandled exception: {cleaned_error_str}"))
-                    
-                    # now place the responses onto the outgoing queues for the handle_client thread
-                    if len(err_resp_list) > 0:
-                        with mutex:
-                            errorList.extend(err_resp_list) # append all entries to the end of list
-
-                    if de_resp is not None:
-                        with mutex:
-                            outQueue.append(de_resp)
-                    else:
-                        resp = dataEntry(chType = f"{de.chType}", gpio_str = de.gpio_str, val = de.val, time = time.time())
-                        # populate with an ack response
-                        if len(err_resp_list) > 0:
-                            resp.val = "NAK" # negative ACK to indicate error
-                        with mutex:
-                            outQueue.append(resp) # chtype as ao to avoid error raised by dataEntry class
-
-                    
+                # execute_batch picks the driver for every entry and builds the responses, including the
+                # ACK (or NAK) for output commands
+                try:
+                    responses, err_resp_list = my_module_manager.execute_batch(commandQueue, observer = _observe_execution)
+                except Exception as e:
+                    cleaned_error_str = _clean_string_for_json(str(e))
+                    responses, err_resp_list = [], [errorEntry(source="RPi", criticalityLevel="High", description=f"unhandled exception: {cleaned_error_str}")]
+
+                metrics.on_errors(err_resp_list)
+                # now place the responses onto the outgoing queues for the handle_client thread
+                with mutex:
+                    outQueue.extend(responses)
+                    errorList.extend(err_resp_list) # append all entries to the end of list
+
                 with mutex:
                     # clearing the command queue is the designated
                     # way of informing the client socket thread that 
                     # this thread has finished treating the current batch of 
                     # commands. Now it can send a response
                     commandQueue.clear()
+                    metrics.queue_depth.set(0)
+            batchDone.set()
                
         except KeyboardInterrupt:
             print("commandQueueManager process terminated by keyboardinterrupt")
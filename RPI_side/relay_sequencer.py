@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Runs a relay sequence uploaded by the master (e.g. "close R1, 250 ms later close R2, 2 s later open both") locally on
+the RPi, so that the time between the switches does not depend on the network or the GUI.
+
+A sequence is a list of steps [at_ms, gpio_str, state], where at_ms is the step's offset from the start of the
+sequence. Each step is written through the Module_Manager's `do` handler from a dedicated thread that sleeps until
+shortly before the step is due and spins out the rest, like the master's sender loop. The actual time of every write
+is recorded and can be read back while or after the sequence runs.
+
+The master drives this with `q` packets (see mt_server_w_handlers.py):
+    {"request": "relay_sequence", "steps": [[0, "GPIO6", 1], [250, "GPIO5", 1], ...]} -> {"sequence_id": 3}
+    {"request": "relay_sequence_result", "sequence_id": 3} -> {"sequence": {...}} (see `RelaySequencer.result`)
+    {"request": "relay_sequence_cancel"}
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from timing_stats import make_thread_realtime
+
+
+class RelaySequencer:
+    def __init__(self, module_manager, rt_priority: int | None = None, rt_cpus: set[int] | None = None,
+                 spin_window: float = 0.002, max_results: int = 16):
+        '''
+        module_manager : the Module_Manager whose `do` handlers are used
+        rt_priority, rt_cpus : optional real-time scheduling of the sequence thread (see make_thread_realtime)
+        spin_window : seconds before each step that are spun out instead of slept
+        max_results : results of this many recent sequences are kept
+        '''
+        self.module_manager = module_manager
+        self.rt_priority = rt_priority
+        self.rt_cpus = rt_cpus
+        self.spin_window = spin_window
+        self.max_results = max_results
+        self.mutex = threading.Lock()
+        self.results = OrderedDict() # sequence id -> result dict, oldest first
+        self.nextId = 1
+        self.running = None # id of the sequence in progress
+        self.cancelEvent = threading.Event()
+
+    def start(self, steps: list) -> tuple[int | None, str | None]:
+        ''' validates `steps` and starts running them. Returns (sequence id, None), or (None, error message) if the steps
+        are invalid or another sequence is still running. '''
+        try:
+            steps = sorted(([float(at_ms), str(gpio_str), int(state)] for at_ms, gpio_str, state in steps), key=lambda s: s[0])
+        except (TypeError, ValueError) as e:
+            return (None, f"steps must be [at_ms, gpio_str, state] lists: {e}")
+        if len(steps) == 0 or steps[0][0] < 0:
+            return (None, "a sequence needs at least one step, and no step may have a negative offset")
+        for _, gpio_str, _ in steps:
+            existing = self.module_manager.module_dict.get(gpio_str)
+            if existing is not None and existing[0].lower() != "do":
+                return (None, f"{gpio_str} is set up as {existing[0]}, not as a do channel")
+
+        with self.mutex:
+            if self.running is not None:
+                return (None, f"sequence {self.running} is still running")
+            seqId = self.nextId
+            self.nextId += 1
+            self.running = seqId
+            self.results[seqId] = {"state": "running", "start": 0, "steps": [], "errors": []}
+            while len(self.results) > self.max_results:
+                self.results.popitem(last=False)
+        self.cancelEvent.clear()
+        threading.Thread(target=self._run, args=(seqId, steps), daemon=True).start()
+        return (seqId, None)
+
+    def cancel(self) -> None:
+        ''' stops the running sequence before its next step; switches already made stay as they are '''
+        self.cancelEvent.set()
+
+    def result(self, seqId: int) -> dict | None:
+        '''
+        {"state": "running" | "done" | "cancelled" | "failed", "start": time.time() the sequence started,
+         "steps": [[at_ms, gpio_str, state, actual time.time() of the write, lateness in ms], ...] for the steps made so far,
+         "errors": [descriptions]}, or None for an unknown (or long forgotten) id
+        '''
+        with self.mutex:
+            r = self.results.get(seqId)
+            return None if r is None else {**r, "steps": list(r["steps"]), "errors": list(r["errors"])}
+
+    def _run(self, seqId: int, steps: list) -> None:
+        state = "failed"
+        try:
+            state = self._run_steps(seqId, steps)
+        except Exception as e: # e.g. a relay channel could not claim its gpio
+            with self.mutex:
+                self.results[seqId]["errors"].append(f"sequence {seqId} failed: {e}")
+        finally:
+            with self.mutex:
+                self.results[seqId]["state"] = state
+                self.running = None
+
+    def _run_steps(self, seqId: int, steps: list) -> str:
+        ''' runs the steps of sequence `seqId` and returns its final state ("done" or "cancelled") '''
+        make_thread_realtime(priority = self.rt_priority, cpus = self.rt_cpus) # best effort; runs normally otherwise
+        handlers = []
+        for _, gpio_str, _ in steps:
+            handler = self.module_manager.handlers.get((gpio_str, "do"))
+            if handler is None:
+                handler = self.module_manager._get_handler_slow(gpio_str, "do") # creates the relay channel if needed
+            handlers.append(handler)
+
+        # time.time() can be stepped by NTP, so steps are scheduled on perf_counter and only reported as wall time
+        startWall, startPerf = time.time(), time.perf_counter()
+        with self.mutex:
+            self.results[seqId]["start"] = startWall
+        for (at_ms, gpio_str, value), handler in zip(steps, handlers):
+            due = startPerf + at_ms / 1000
+            waitFor = due - time.perf_counter() - self.spin_window
+            if waitFor > 0 and self.cancelEvent.wait(waitFor):
+                return "cancelled"
+            if self.cancelEvent.is_set():
+                return "cancelled"
+            while time.perf_counter() < due:
+                pass
+            writePerf = time.perf_counter()
+            try:
+                _, errors = handler(value)
+                errors = [e.description for e in errors]
+            except Exception as e:
+                errors = [f"writing {gpio_str} failed: {e}"]
+            with self.mutex:
+                r = self.results[seqId]
+                r["steps"].append([at_ms, gpio_str, value, startWall + (writePerf - startPerf), (writePerf - due) * 1000])
+                r["errors"].extend(errors)
+        return "done"
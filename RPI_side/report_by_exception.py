@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Report by exception for input channels. A reading of a configured ai/di channel is only sent back to the master when
+it has moved by more than the channel's deadband since the value last sent, or when nothing was sent for that channel
+for `max_silence_ms`. Readings left out are listed in the `d` reply's info as "unchanged" ([chType, gpio_str] pairs),
+so the master still knows that the channel was read and that its last value holds, without the full entry (or a
+redraw of its meter).
+
+The master configures this with the channel map's "report_by_exception" info, e.g.
+    {"GPIO14": {"deadband": 0.05, "max_silence_ms": 5000}, "GPIO5": {"deadband": 0, "max_silence_ms": 10000}}
+Deadbands are in packet units: mA for ai, and Hz for a di in pulse counter mode (whose level must match as well).
+A di level reading is reported whenever it changes.
+"""
+
+import threading
+import time
+
+
+class ReportByException:
+    def __init__(self):
+        self.mutex = threading.Lock() # replies of a pipelined connection are built on several threads
+        self.channels = dict() # gpio_str -> (deadband, max silence in seconds)
+        self.lastReported = dict() # gpio_str -> (value, time.time() it was sent)
+        self.numSuppressed = 0
+
+    def configure(self, channels: dict) -> None:
+        ''' replaces the settings with `channels` (see the module docstring). What was reported so far is forgotten, so the
+        next reading of every channel goes out in full: a new channel map means a master that may have just connected.'''
+        with self.mutex:
+            self.channels = {gpio_str: (float(c.get("deadband", 0)), float(c.get("max_silence_ms", 5000)) / 1000)
+                             for gpio_str, c in channels.items()}
+            self.lastReported.clear()
+
+    def filter(self, responses: list) -> tuple[list, list[list[str]]]:
+        ''' splits the responses of a batch into (entries to send, [chType, gpio_str] of the readings left out) '''
+        if len(self.channels) == 0:
+            return (responses, [])
+        kept, unchanged = [], []
+        now = time.time()
+        with self.mutex:
+            for de in responses:
+                config = self.channels.get(de.gpio_str)
+                if config is None or de.chType not in ("ai", "di") or de.val == "NAK":
+                    kept.append(de)
+                    continue
+                deadband, maxSilence = config
+                last = self.lastReported.get(de.gpio_str)
+                if last is not None and now - last[1] < maxSilence and not self._moved(de.val, last[0], deadband):
+                    unchanged.append([de.chType, de.gpio_str])
+                    continue
+                self.lastReported[de.gpio_str] = (de.val, now)
+                kept.append(de)
+            self.numSuppressed += len(unchanged)
+        return (kept, unchanged)
+
+    @staticmethod
+    def _moved(value, last, deadband: float) -> bool:
+        if isinstance(value, dict): # a di pulse counter reading
+            if not isinstance(last, dict):
+                return True
+            return value.get("level") != last.get("level") or abs(value.get("freq_hz", 0) - last.get("freq_hz", 0)) > deadband
+        try:
+            return abs(value - last) > deadband
+        except TypeError:
+            return value != last
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Timing instrumentation for the RPi's hardware thread. For every output command, the hardware thread records how far
+the hardware write happened from the time the master scheduled it (`lateness`) and how long the driver call took
+(`duration`). Both are kept as fixed-bucket histograms, which cost a few comparisons per command and never grow.
+
+The master reads them with a `q` packet (see SocketSenderManager.get_timing_report).
+
+The master's and the RPi's clocks are not synchronized, so every incoming packet yields an offset sample
+(RPi receive time minus the master's send time = clock offset + one-way network delay). The smallest recent sample
+is the best estimate of the clock offset, and it is used to translate RPi times back to the master's clock.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+
+# bucket upper edges in milliseconds; the last bucket catches everything above 1 s
+BUCKET_EDGES_MS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+class Histogram:
+    def __init__(self, edges_ms: list[float] = BUCKET_EDGES_MS):
+        self.edges_ms = edges_ms
+        self.reset()
+
+    def reset(self) -> None:
+        self.counts = [0] * (len(self.edges_ms) + 1)
+        self.numSamples = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value_ms: float) -> None:
+        i = 0
+        edges = self.edges_ms
+        while i < len(edges) and value_ms > edges[i]:
+            i += 1
+        self.counts[i] += 1
+        self.numSamples += 1
+        self.total += value_ms
+        if self.min is None or value_ms < self.min:
+            self.min = value_ms
+        if self.max is None or value_ms > self.max:
+            self.max = value_ms
+
+    def as_dict(self) -> dict:
+        # only numbers, strings and lists: this dict is sent inside a packet
+        return {"count": self.numSamples,
+                "mean_ms": 0 if self.numSamples == 0 else self.total / self.numSamples,
+                "min_ms": 0 if self.min is None else self.min,
+                "max_ms": 0 if self.max is None else self.max,
+                "bucket_edges_ms": self.edges_ms,
+                "bucket_counts": self.counts}
+
+
+class TimingStats:
+    def __init__(self, offset_window: int = 50):
+        '''
+        offset_window : number of recent packets used for the clock offset estimate
+        '''
+        self.mutex = threading.Lock()
+        self._offsetSamples = deque(maxlen=offset_window)
+        self.lateness = dict() # chType -> Histogram of (actual - intended) write time, ms
+        self.duration = dict() # chType -> Histogram of driver call duration, ms
+        self.numEarly = 0 # writes that appear to happen before their intended time (clock offset estimate error)
+
+    def on_packet(self, master_send_time: float | None, receive_time: float) -> None:
+        ''' call once per received packet with the packet's timestamp (master clock) and the local receive time'''
+        if master_send_time is None:
+            return
+        with self.mutex:
+            self._offsetSamples.append(receive_time - master_send_time)
+
+    def clock_offset(self) -> float:
+        ''' estimated RPi clock minus master clock, in seconds (0 until a packet has been seen)'''
+        with self.mutex:
+            if len(self._offsetSamples) == 0:
+                return 0.0
+            return min(self._offsetSamples)
+
+    def on_executed(self, de, start: float, end: float) -> None:
+        ''' observer for Module_Manager.execute_batch. Records outputs only; a read has no intended time'''
+        if de.chType[1] != "o" or not isinstance(de.time, (int, float)):
+            return
+        latenessMs = (start - self.clock_offset() - de.time) * 1000
+        with self.mutex:
+            if de.chType not in self.lateness:
+                self.lateness[de.chType] = Histogram()
+                self.duration[de.chType] = Histogram()
+            if latenessMs < 0:
+                self.numEarly += 1
+            self.lateness[de.chType].add(max(latenessMs, 0))
+            self.duration[de.chType].add((end - start) * 1000)
+
+    def report(self, reset: bool = False) -> dict:
+        with self.mutex:
+            r = {"clock_offset_ms": (min(self._offsetSamples) if len(self._offsetSamples) > 0 else 0) * 1000,
+                 "early_writes": self.numEarly,
+                 "lateness": {k: h.as_dict() for k, h in self.lateness.items()},
+                 "duration": {k: h.as_dict() for k, h in self.duration.items()}}
+            if reset:
+                for h in list(self.lateness.values()) + list(self.duration.values()):
+                    h.reset()
+                self.numEarly = 0
+        return r
+
+
+def make_thread_realtime(priority: int | None, cpus: set[int] | None = None) -> list[str]:
+    '''
+    Gives the calling thread SCHED_FIFO scheduling at `priority` (1-99) and pins it to `cpus`. Either part is skipped
+    if None. Requires root (or CAP_SYS_NICE); if a part fails, the thread keeps running with normal scheduling.
+    Returns a list of human-readable warnings for the parts that failed.
+    '''
+    warnings = []
+    if cpus is not None:
+        try:
+            os.sched_setaffinity(0, cpus) # 0 = the calling thread on Linux
+        except (AttributeError, OSError) as e:
+            warnings.append(f"could not pin the hardware thread to CPUs {cpus}: {e}")
+    if priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except (AttributeError, OSError) as e:
+            warnings.append(f"could not give the hardware thread SCHED_FIFO priority {priority}: {e}")
+    return warnings
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in tracing of single commands on their way through the simulator, exported in the Chrome trace event format
+(open the file in chrome://tracing or https://ui.perfetto.dev).
+
+Every traced command gets a request id when it is placed on the master's command queue. The master then records
+the stages of that command (queue wait, packet encode, socket connect, send, waiting for the reply, GUI pickup), and
+asks the RPi to time its own stages of the same packet (parse, wait for the hardware thread, the driver call of every
+entry, building, encoding and sending the reply). The RPi's spans come back in the reply's `info` and are moved onto
+the master's clock, so both machines show up as two processes of one trace. A reply can't carry the time it took to
+encode and send itself, so those two spans arrive with the next traced reply. Every span carries the request id (`id`) and packet id (`packet`) in its args.
+
+Tracing is off unless `tracer.enable()` is called. While it is off, each hook is a single attribute check.
+
+Example:
+    from Tracer import tracer
+    tracer.enable()
+    ... run commands ...
+    tracer.export("logs/trace.json")
+"""
+
+import itertools
+import json
+import threading
+import time
+from collections import deque
+
+MASTER_PID = 1
+RPI_PID = 2
+_PROCESS_NAMES = {MASTER_PID: "master", RPI_PID: "RPi"}
+
+
+class Tracer:
+    def __init__(self, max_events: int = 200000):
+        '''
+        max_events : the oldest events are dropped beyond this many, so a forgotten trace can't eat all the memory
+        '''
+        self.enabled = False
+        self.events = deque(maxlen=max_events) # appending to a deque is thread-safe
+        self._ids = itertools.count(1)
+        self._threadNames = dict() # (pid, tid) -> thread name, for the trace's metadata events
+        self._laneIds = dict() # lane name of a remote span -> tid
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def next_id(self) -> int:
+        ''' a new request (or packet) id '''
+        return next(self._ids)
+
+    def span(self, name: str, start: float, end: float, args: dict | None = None, pid: int = MASTER_PID, tid: int | None = None) -> None:
+        ''' records one complete event. `start` and `end` are time.time() values. By default it is placed on the
+        calling thread's row of the master process.'''
+        if tid is None:
+            tid = threading.get_ident()
+            if (pid, tid) not in self._threadNames:
+                self._threadNames[(pid, tid)] = threading.current_thread().name
+        self.events.append({"name": name, "ph": "X", "ts": start * 1e6, "dur": max(end - start, 0) * 1e6,
+                            "pid": pid, "tid": tid, "args": args if args is not None else {}})
+
+    def add_remote_spans(self, spans: list, clock_offset: float, ids: list, packet_id: int, pid: int = RPI_PID) -> None:
+        '''
+        records spans timed by the RPi (see `batchTrace` and `_serve_packet` in RPI_side/mt_server_w_handlers.py).
+        spans : lists like [name, start, end, entryIndex, lane]. entryIndex is the entry's position in the packet, or -1
+                for a span of the whole packet. lane names the RPi thread that recorded the span.
+        clock_offset : RPi clock minus master clock, in seconds (see `estimate_clock_offset`)
+        ids : the request id of every entry of the packet, in packet order
+        '''
+        for name, start, end, index, lane in spans:
+            tid = self._laneIds.get(lane)
+            if tid is None:
+                tid = len(self._laneIds) + 1
+                self._laneIds[lane] = tid
+                self._threadNames[(pid, tid)] = lane
+            args = {"packet": packet_id}
+            if 0 <= index < len(ids):
+                args["id"] = ids[index]
+            self.span(name, start - clock_offset, end - clock_offset, args=args, pid=pid, tid=tid)
+
+    def export(self, file_path: str) -> int:
+        ''' writes every recorded event to `file_path` as Chrome trace JSON. Returns the number of events written.'''
+        events = list(self.events)
+        meta = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": name}}
+                for pid, name in _PROCESS_NAMES.items()]
+        meta += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                 for (pid, tid), name in list(self._threadNames.items())]
+        with open(file_path, 'w') as f:
+            json.dump({"traceEvents": meta + events, "displayTimeUnit": "ms"}, f)
+        return len(events)
+
+    def clear(self) -> None:
+        self.events.clear()
+
+
+def estimate_clock_offset(master_send: float, remote_receive: float, remote_send: float, master_receive: float) -> float:
+    ''' remote clock minus master clock from one request/reply exchange, assuming the network delay is the same
+    both ways (the NTP estimate)'''
+    return ((remote_receive - master_send) + (remote_send - master_receive)) / 2
+
+
+tracer = Tracer() # the one tracer of this process; every hook records into it
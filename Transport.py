@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Length-prefixed frames over a TCP socket, shared by the master (SocketSenderManager, HeartbeatMonitor) and the RPi
+server. A frame is `{msg_type}:{payload length in bytes}:{payload}`, which is the packet format of PacketBuilder.py.
+
+The header and the payload are handed to the kernel separately (a scatter-gather `sendmsg` where the platform has
+one, i.e. on the RPi; Windows has no `sendmsg`, so the master joins them once and uses `sendall`). Either way the whole
+frame is written: a short write is continued from where it stopped instead of silently truncating the packet.
+Receiving reads exactly one frame, so several frames can follow each other on one connection.
+
+Example:
+    framed = FramedSocket(sock, sendBufferSize=256*1024)
+    framed.send_frame("d", payloadBytes)
+    msg_type, payload = framed.recv_frame()
+    print(framed.stats())
+"""
+
+import socket
+
+MAX_HEADER_BYTES = 24 # msg_type, two colons and the length digits
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+
+class FramedSocket:
+    def __init__(self, sock: socket.socket, sendBufferSize: int | None = None, recvBufferSize: int | None = None,
+                 onTransfer = None):
+        '''
+        sock : a connected socket. Its timeout applies to every send and receive
+        sendBufferSize, recvBufferSize : SO_SNDBUF / SO_RCVBUF in bytes, or None to keep the OS default
+        onTransfer : optional callable like f(direction, numBytes), called after every frame with direction
+                     "sent" or "received" (e.g. to feed the RPi's metrics)
+        '''
+        self.sock = sock
+        if sendBufferSize:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sendBufferSize)
+        if recvBufferSize:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recvBufferSize)
+        self.onTransfer = onTransfer
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.framesSent = 0
+        self.framesReceived = 0
+        self.partialSends = 0 # writes that the kernel only partly accepted and that had to be continued
+
+    def send_frame(self, msg_type: str, payload: bytes) -> int:
+        ''' writes one whole frame. Returns the number of bytes written (header included).'''
+        header = f"{msg_type}:{len(payload)}:".encode()
+        if _HAS_SENDMSG:
+            self._sendmsg_all([memoryview(header), memoryview(payload)])
+        else:
+            self.sock.sendall(header + payload)
+        numBytes = len(header) + len(payload)
+        self.bytesSent += numBytes
+        self.framesSent += 1
+        if self.onTransfer is not None:
+            self.onTransfer("sent", numBytes)
+        return numBytes
+
+    def _sendmsg_all(self, views: list[memoryview]) -> None:
+        while len(views) > 0:
+            sent = self.sock.sendmsg(views)
+            while len(views) > 0 and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if len(views) > 0:
+                views[0] = views[0][sent:]
+                self.partialSends += 1
+
+    def recv_frame(self) -> tuple[str, bytes]:
+        ''' reads exactly one frame and returns (msg_type, payload). Raises ConnectionError if the peer closes the
+        connection (before or during the frame) and ValueError if the header is malformed.'''
+        header = self._recv_header()
+        try:
+            msg_type, length, _ = header.decode().split(":")
+            length = int(length)
+        except ValueError:
+            raise ValueError(f"Expected a header like `d:123:`, but got `{header}` instead")
+        payload = self._recv_exact(length)
+        self.bytesReceived += len(header) + length
+        self.framesReceived += 1
+        if self.onTransfer is not None:
+            self.onTransfer("received", len(header) + length)
+        return (msg_type, payload)
+
+    def _recv_header(self) -> bytes:
+        # peek first so that the header can be taken off the socket in one read without eating into the payload
+        peek = self.sock.recv(MAX_HEADER_BYTES, socket.MSG_PEEK)
+        if peek == b"":
+            raise ConnectionError("connection closed by the peer")
+        first = peek.find(b":")
+        end = peek.find(b":", first + 1) if first >= 0 else -1
+        if end >= 0:
+            return self._recv_exact(end + 1)
+        # only part of the header has arrived so far: take it a byte at a time
+        header = bytearray()
+        while header.count(b":") < 2:
+            if len(header) >= MAX_HEADER_BYTES:
+                raise ValueError(f"no frame header found in `{bytes(header)}`")
+            header += self._recv_exact(1)
+        return bytes(header)
+
+    def _recv_exact(self, numBytes: int) -> bytes:
+        buffer = bytearray(numBytes)
+        view = memoryview(buffer)
+        received = 0
+        while received < numBytes:
+            n = self.sock.recv_into(view[received:], numBytes - received)
+            if n == 0:
+                raise ConnectionError(f"connection closed by the peer after {received} of {numBytes} bytes")
+            received += n
+        return bytes(buffer)
+
+    def stats(self) -> dict:
+        return {"bytes_sent": self.bytesSent, "bytes_received": self.bytesReceived,
+                "frames_sent": self.framesSent, "frames_received": self.framesReceived,
+                "partial_sends": self.partialSends}
+
+    def fileno(self) -> int:
+        return self.sock.fileno() # lets a FramedSocket be passed to select
+
+    def close(self) -> None:
+        self.sock.close()
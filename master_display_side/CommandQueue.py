@@ -12,105 +12,326 @@ import time
 from PacketBuilder import dataEntry
 import copy
 
+# priority classes, most urgent first. When several entries are due at once, every due entry of a more urgent
+# class is popped before any entry of a less urgent one.
+PRIORITY_OPERATOR = 0 # commands the operator asked for directly (AO set points, DO/relay toggles)
+PRIORITY_WAVEFORM = 1 # scheduled steps of a ramp
+PRIORITY_POLL = 2 # background AI/DI read requests
+
+# what to do with ramp steps that became overdue, e.g. because the link was down (see CommandQueue.__init__)
+RAMP_CATCHUP_POLICIES = ["replay", "jump", "shift"]
+
 # this class is designed to run on the master laptop in a separate thread that sends out interpolated
 # packets at the right times
 # the timestamp of any entry can be in the future, and this queue will send out those elements
 # at the right times
 class CommandQueue:
-    ''' a priority queue that stores dataEntry objects ranked by date due (soonest to furthest)
+    ''' a priority queue that stores dataEntry objects ranked first by priority class, then by date due (soonest to furthest).
+    Each class has its own heap and its own size bound, so a pile-up of background polls on a slow link can never
+    delay an operator command: polls are merged per channel and shed once they are stale or over their bound.
     '''
-    def __init__(self):
-        self.heap = [] # yes, I know it's a list...
-        
-    def put(self, entry: dataEntry):
-        ''' place a dataEntry object onto the heap. Its timestamp determines
+    def __init__(self, max_operator: int | None = None, max_waveform: int | None = 20000, max_poll: int | None = 256,
+                 stale_poll_s: float | None = 2.0, in_flight_timeout_s: float = 10.0,
+                 ramp_catchup: str = "replay", ramp_late_s: float = 0.5):
+        '''
+        max_operator, max_waveform, max_poll : most entries kept per class (None = unbounded). When a class is full,
+                    its soonest-due (oldest) entry is shed to make room. Operator commands are unbounded by default.
+        stale_poll_s : a poll that is still waiting this many seconds after its due time is dropped instead of sent.
+                    Its answer would be out of date anyway, and the poller places a fresh one. None keeps every poll.
+        in_flight_timeout_s : a popped poll counts as outstanding until `resolve_in_flight` is called for it, or for at
+                    most this long (in case the answer was lost without the sender noticing).
+        ramp_catchup : how overdue ramp (waveform) steps are released once sending is possible again:
+                    "replay" sends every missed step at once (the whole staircase in one burst);
+                    "jump" sends only the newest overdue step per channel, i.e. the value the ramp should have now;
+                    "shift" resumes from the first missed step and delays the rest of that ramp by the outage, so the
+                    staircase keeps its original spacing.
+        ramp_late_s : a ramp step must be at least this late before "jump" or "shift" kick in, so that ordinary
+                    scheduling jitter never reshapes a ramp
+        '''
+        if ramp_catchup not in RAMP_CATCHUP_POLICIES:
+            raise ValueError(f"Expected one of {RAMP_CATCHUP_POLICIES} as `ramp_catchup`, but received {ramp_catchup}")
+        self.heaps = {PRIORITY_OPERATOR: [], PRIORITY_WAVEFORM: [], PRIORITY_POLL: []} # yes, I know they're lists...
+        self.bounds = {PRIORITY_OPERATOR: max_operator, PRIORITY_WAVEFORM: max_waveform, PRIORITY_POLL: max_poll}
+        self.stale_poll_s = stale_poll_s
+        self.pendingPolls = dict() # (chType, gpio_str) -> the poll entry waiting on the poll heap
+        self.inFlight = dict() # (chType, gpio_str) -> (poll entry, time popped) for polls sent but not yet answered
+        self.in_flight_timeout_s = in_flight_timeout_s
+        self.ramp_catchup = ramp_catchup
+        self.ramp_late_s = ramp_late_s
+        self.stats = {"polls_coalesced": 0, "polls_shed": 0, "waveform_shed": 0, "operator_shed": 0, "outputs_coalesced": 0,
+                      "waveform_skipped": 0, "waveform_superseded": 0, "ramps_shifted": 0}
+        self.dropListeners = [] # callables like f(entries), called with entries that leave the queue without being sent (merged, shed or skipped)
+
+    @staticmethod
+    def infer_priority(entry: dataEntry) -> int:
+        ''' read requests (ai, di) are background polls; anything that drives an output is an operator command.
+        Ramp steps are placed with PRIORITY_WAVEFORM explicitly (see SocketSenderManager.place_ramp).'''
+        if entry.chType.lower()[1] == "i":
+            return PRIORITY_POLL
+        return PRIORITY_OPERATOR
+
+    def put(self, entry: dataEntry, priority: int | None = None):
+        ''' place a dataEntry object onto the heap of its priority class. Its timestamp determines
         its insertion point in the heap.  A large timestamp (future) will be placed after a 
         smaller timestamp (past)
+        If `priority` is None, the class the entry was first placed with is kept (e.g. when a failed send is re-placed);
+        a brand new entry gets the class from `infer_priority`.
         This function assumes that the `time` field in the dataEntry is a float (POSIX) or a datetime object
         '''
-        time = entry.time
-        if isinstance(time, datetime):
-            time = time.timestamp() # convert to numerical value for insertion
-        heapq.heappush(self.heap, entry) # note that the dataEntry class has __lt__ defined as comparing the `time` elements
-        # first element in tuple is priority ranking, second element
-        # is object to store
+        if isinstance(entry.time, datetime):
+            entry.time = entry.time.timestamp() # convert to numerical value for insertion
+        if priority is None:
+            priority = getattr(entry, "priority", None)
+        if priority is None:
+            priority = self.infer_priority(entry)
+        entry.priority = priority # remembered so that a re-placed entry stays in its class
+
+        if priority == PRIORITY_POLL:
+            key = (entry.chType.lower(), entry.gpio_str)
+            if entry.time <= time.time() and self._is_in_flight(key):
+                # the previous read of this channel is still unanswered; its answer will serve this request too
+                self.stats["polls_coalesced"] += 1
+                self._dropped([entry])
+                return
+            pending = self.pendingPolls.get(key)
+            if pending is not None and entry.time <= max(pending.time, time.time()):
+                # one outstanding read per channel is enough. Keep the earlier due time; take the newer request's value
+                # (e.g. a changed boxcar length). A poll scheduled for after the pending one is a separate read
+                pending.val = entry.val
+                if entry.time < pending.time:
+                    pending.time = entry.time
+                    heapq.heapify(self.heaps[PRIORITY_POLL])
+                self.stats["polls_coalesced"] += 1
+                self._dropped([entry])
+                return
+            if pending is None:
+                self.pendingPolls[key] = entry
+
+        heap = self.heaps[priority]
+        bound = self.bounds[priority]
+        if bound is not None and len(heap) >= bound:
+            shed = heapq.heappop(heap) # shed the oldest entry of this class
+            self._forget(shed)
+            self._dropped([shed])
+            self.stats[{PRIORITY_OPERATOR: "operator_shed", PRIORITY_WAVEFORM: "waveform_shed", PRIORITY_POLL: "polls_shed"}[priority]] += 1
+        heapq.heappush(heap, entry) # note that the dataEntry class has __lt__ defined as comparing the `time` elements
         
-    def put_all(self, entries: list[dataEntry]) -> None:
+    def put_all(self, entries: list[dataEntry], priority: int | None = None) -> None:
         for d in entries:
-            self.put(d)
-    
-    # def get_num_due(self) -> int:
-    #     ''' returns the number of elements that are (over)due. Useful to call before `pop_all_due` in a multi-threaded
-    #     context where a mutex lock is required
-    #     '''
-    #     if len(self.heap) == 0:
-    #         return 0
-        
-    #     refTime = time.time() 
-    #     n = 0
-    #     for i in range(0, len(self.heap)):
-    #         if self.heap[i][0] <= refTime:
-    #             n += 1
-    #         else:
-    #             break
-            
-    #     return n
+            self.put(d, priority=priority)
+
+    def _forget(self, entry: dataEntry) -> None:
+        ''' drops the bookkeeping for an entry that just left the poll heap'''
+        if getattr(entry, "priority", None) != PRIORITY_POLL:
+            return
+        key = (entry.chType.lower(), entry.gpio_str)
+        if self.pendingPolls.get(key) is entry:
+            del self.pendingPolls[key]
+
+    def _dropped(self, entries: list[dataEntry]) -> None:
+        if len(entries) == 0:
+            return
+        for listener in self.dropListeners:
+            listener(entries)
                 
-    def pop_due(self) -> Union[dataEntry, None]:
-        ''' checks to see if the next entry in the heap is (over)due.  If so, pop and return that entry object.
-        Otherwise, return None.'''
-        if len(self.heap) == 0:
+    def peek_next_time(self) -> Union[float, None]:
+        ''' returns the timestamp of the soonest entry of any class without popping it, or None if the queue is empty.
+        Used by the sender loop to sleep exactly until the next entry is due'''
+        times = [h[0].time for h in self.heaps.values() if len(h) > 0]
+        if len(times) == 0:
             return None
-        
+        return min(times)
+
+    def pop_due(self) -> Union[dataEntry, None]:
+        ''' checks to see if the next entry of the most urgent class is (over)due.  If so, pop and return that entry object.
+        Otherwise, return None. Stale polls are dropped along the way. A returned poll counts as in flight (and further
+        polls of its channel are merged into it) until `resolve_in_flight` is called for it.'''
         refTime = time.time()
-        if self.heap[0].time <= refTime: # remember that first element in tuple is timestamp, second is object
-            # if the timestamp on the heap should have been completed earlier
-            # return it immediately
-            return heapq.heappop(self.heap)
+        for priority in (PRIORITY_OPERATOR, PRIORITY_WAVEFORM, PRIORITY_POLL):
+            heap = self.heaps[priority]
+            while len(heap) > 0 and heap[0].time <= refTime:
+                # if the timestamp on the heap should have been completed earlier
+                # return it immediately
+                entry = heapq.heappop(heap)
+                self._forget(entry)
+                if priority == PRIORITY_POLL:
+                    if self.stale_poll_s is not None and refTime - entry.time > self.stale_poll_s:
+                        self.stats["polls_shed"] += 1
+                        self._dropped([entry])
+                        continue
+                    self.inFlight[(entry.chType.lower(), entry.gpio_str)] = (entry, refTime)
+                return entry
         return None
     
-    def pop_all_due(self) -> list[dataEntry]:
-        ''' pop all items that are (over)due. May return an empty list if none are (over)due '''
+    def pop_all_due(self, max_entries: int | None = None) -> list[dataEntry]:
+        ''' pop all items that are (over)due, operator commands first. May return an empty list if none are (over)due.
+        If `max_entries` is given, waveform steps and polls beyond that count stay on the queue for the next packet;
+        due operator commands are always returned, even if they alone exceed `max_entries`.
+        Overdue ramp steps are first thinned out or re-timed according to `ramp_catchup`. Ramp steps of a channel that
+        are due no later than a popped operator command for it are dropped, since the operator's value must win.
+        The returned batch is in time order, so that the RPi executes it in the order it was scheduled.'''
+        self._apply_ramp_catchup()
         l = []
         currEl = self.pop_due()
         while currEl is not None:
             l.append(currEl) # keep popping until we reach elements scheduled in the future
+            if max_entries is not None and len(l) >= max_entries and not self._operator_due():
+                break
             currEl = self.pop_due()
+        l = self._drop_superseded_steps(l)
+        l.sort(key=lambda e: e.time) # stable: entries due at the same time keep their class order
         return l
+
+    def _drop_superseded_steps(self, batch: list[dataEntry]) -> list[dataEntry]:
+        ''' removes ramp steps (from `batch` and from the waveform heap) that are due no later than an operator
+        command for the same channel in `batch` '''
+        operatorTimes = dict() # (chType, gpio_str) -> latest due time of a popped operator command
+        for e in batch:
+            if getattr(e, "priority", None) == PRIORITY_OPERATOR:
+                key = (e.chType.lower(), e.gpio_str)
+                operatorTimes[key] = max(operatorTimes.get(key, e.time), e.time)
+        if len(operatorTimes) == 0:
+            return batch
+
+        def superseded(e: dataEntry) -> bool:
+            t = operatorTimes.get((e.chType.lower(), e.gpio_str))
+            return t is not None and e.time <= t
+
+        dropped = [e for e in batch if getattr(e, "priority", None) == PRIORITY_WAVEFORM and superseded(e)]
+        heap = self.heaps[PRIORITY_WAVEFORM]
+        onHeap = [e for e in heap if superseded(e)]
+        if len(onHeap) > 0:
+            heap[:] = [e for e in heap if not superseded(e)]
+            heapq.heapify(heap)
+        dropped += onHeap
+        if len(dropped) == 0:
+            return batch
+        self.stats["waveform_superseded"] += len(dropped)
+        self._dropped(dropped)
+        droppedIds = set(id(e) for e in dropped)
+        return [e for e in batch if id(e) not in droppedIds]
+
+    def _apply_ramp_catchup(self) -> None:
+        if self.ramp_catchup == "replay":
+            return
+        heap = self.heaps[PRIORITY_WAVEFORM]
+        refTime = time.time()
+        overdue = dict() # (chType, gpio_str) -> overdue steps of that channel's ramp
+        for entry in heap:
+            if entry.time <= refTime:
+                overdue.setdefault((entry.chType.lower(), entry.gpio_str), []).append(entry)
+        changed = False
+        for key, steps in overdue.items():
+            first = min(steps)
+            if refTime - first.time < self.ramp_late_s:
+                continue # on time, give or take some jitter
+            changed = True
+            if self.ramp_catchup == "jump":
+                newest = max(steps)
+                skipped = set(id(e) for e in steps if e is not newest)
+                heap[:] = [e for e in heap if id(e) not in skipped]
+                self.stats["waveform_skipped"] += len(skipped)
+                self._dropped([e for e in steps if e is not newest])
+            else: # "shift"
+                lateness = refTime - first.time
+                for e in heap:
+                    if (e.chType.lower(), e.gpio_str) == key:
+                        e.time += lateness
+                self.stats["ramps_shifted"] += 1
+        if changed:
+            heapq.heapify(heap)
+
+    def _is_in_flight(self, key: tuple) -> bool:
+        sent = self.inFlight.get(key)
+        if sent is None:
+            return False
+        if time.time() - sent[1] > self.in_flight_timeout_s:
+            del self.inFlight[key] # never answered; allow a new read
+            return False
+        return True
+
+    def resolve_in_flight(self, entries: list[dataEntry]) -> None:
+        ''' call once the batch that carried `entries` was answered or failed to send. Frees their channels for new
+        polls. Entries that are not outstanding polls are ignored.'''
+        for entry in entries:
+            key = (entry.chType.lower(), entry.gpio_str)
+            sent = self.inFlight.get(key)
+            if sent is not None and sent[0] is entry:
+                del self.inFlight[key]
+
+    def coalesce_outputs(self, entries: list[dataEntry]) -> tuple[list[dataEntry], list[dataEntry]]:
+        ''' last-writer-wins: of several output entries (ao/do) for the same channel in one popped batch, only the one
+        with the latest timestamp is worth executing; the others would be overwritten immediately.
+        Returns (entries to send, superseded entries). Inputs are always kept, and the batch order is preserved.'''
+        latest = dict() # (chType, gpio_str) -> index of the entry that wins
+        for i, entry in enumerate(entries):
+            if entry.chType.lower()[1] != "o":
+                continue
+            key = (entry.chType.lower(), entry.gpio_str)
+            j = latest.get(key)
+            if j is None or entries[j].time <= entry.time: # on a tie, the one placed later wins
+                latest[key] = i
+        winners = set(latest.values())
+        kept, superseded = [], []
+        for i, entry in enumerate(entries):
+            if entry.chType.lower()[1] == "o" and i not in winners:
+                superseded.append(entry)
+            else:
+                kept.append(entry)
+        self.stats["outputs_coalesced"] += len(superseded)
+        return kept, superseded
+
+    def _operator_due(self) -> bool:
+        heap = self.heaps[PRIORITY_OPERATOR]
+        return len(heap) > 0 and heap[0].time <= time.time()
     
     def clear_all(self) -> None:
-        ''' clears the heap without returning any of the popped values'''
-        self.heap.clear()
+        ''' clears every heap without returning any of the popped values. They are handed to `dropListeners`'''
+        self._dropped([e for heap in self.heaps.values() for e in heap])
+        self._clear_heaps()
+
+    def _clear_heaps(self) -> None:
+        for heap in self.heaps.values():
+            heap.clear()
+        self.pendingPolls.clear()
+        self.inFlight.clear()
 
 
     def pop_all(self) -> list[dataEntry]:
         ''' 
-        pops all items in the heap, regardless of their timestamp priority, sorted newest to oldest.
+        pops all items of every class, regardless of their timestamp priority, sorted newest to oldest.
         '''
-        if len(self.heap) == 0:
+        if len(self) == 0:
             return []
-        beforeRemoveAll = copy.deepcopy(self.heap)
+        beforeRemoveAll = copy.deepcopy(self._heapsort(e for heap in self.heaps.values() for e in heap))
         
-        self.heap.clear() # remove all items from heap
+        self._clear_heaps() # remove all items from heap; they are returned, not dropped
         
-        reversedHeap = beforeRemoveAll[::-1]
-        return [h for h in reversedHeap] # return only the object, not the timestamp
+        return beforeRemoveAll[::-1]
 
     def pop_all_with_gpio_str(self, gpio_str:str) -> int:
-        # finds all heap entries having the given gpio_str, and deletes them from the heap
+        # finds all entries of every class having the given gpio_str, and deletes them
         # returns the number popped
-        if len(self.heap) == 0:
-            return 0
-        indicesToRemove = []
-        for i in range(len(self.heap)):
-            if self.heap[i].gpio_str == gpio_str:
-                indicesToRemove.append(i)
-        # now iterate from larger indices to smaller indices, removing values
-        for i in sorted(indicesToRemove, reverse=True):
-            del self.heap[i]
-        
-        heapq.heapify(self.heap)
-        return len(indicesToRemove)
+        numRemoved = 0
+        for priority, heap in self.heaps.items():
+            kept = [e for e in heap if e.gpio_str != gpio_str]
+            numRemoved += len(heap) - len(kept)
+            self._dropped([e for e in heap if e.gpio_str == gpio_str])
+            heap[:] = kept
+            heapq.heapify(heap)
+        for key in [k for k in self.pendingPolls if k[1] == gpio_str]:
+            del self.pendingPolls[key]
+        for key in [k for k in self.inFlight if k[1] == gpio_str]:
+            del self.inFlight[key]
+        return numRemoved
+
+    def get_stats(self) -> dict:
+        ''' queue depth per class plus the coalesce/shed counters. Cheap; intended for logs and status displays'''
+        return {"pending_operator": len(self.heaps[PRIORITY_OPERATOR]),
+                "pending_waveform": len(self.heaps[PRIORITY_WAVEFORM]),
+                "pending_poll": len(self.heaps[PRIORITY_POLL]),
+                "polls_in_flight": len(self.inFlight),
+                **self.stats}
     
     def _heapsort(self, iterable):
         # this code from https://docs.python.org/3/library/heapq.html
@@ -120,16 +341,16 @@ class CommandQueue:
         return [heapq.heappop(h) for i in range(len(h))]
             
     def __str__(self) -> str:
-        sortedH = self._heapsort(self.heap)
-        return ", ".join([str(e) for e in sortedH]) # each heap element is a tuple of timestamp and element
+        sortedH = self._heapsort(e for heap in self.heaps.values() for e in heap)
+        return ", ".join([str(e) for e in sortedH])
     
     def __len__(self) -> int:
-        return len(self.heap)
+        return sum(len(heap) for heap in self.heaps.values())
         
 if __name__ == "__main__":
     d1 = dataEntry(chType = "ao", gpio_str = "GPIO26", val = 18.50, time = time.time()+5)
     d2 = dataEntry(chType = "ai", gpio_str = "GPIO23", val = 0.00, time = time.time()+10)
-    d3 = dataEntry(chType = "di", gpio_str = "GPIO24", val = int(1), time = time.time()-10)
+    d3 = dataEntry(chType = "di", gpio_str = "GPIO24", val = int(1), time = time.time()-1)
     
     q = CommandQueue()
     q.put_all([d1, d2, d3])
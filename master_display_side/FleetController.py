@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Drives several simulators (one RPi each) from a single process. Every unit keeps its own SocketSenderManager,
+Channel_Entries and response queue, but none of them starts a sender thread of its own: one scheduler thread pops
+due entries from all of the units' command queues and hands each batch to a small, shared pool of I/O workers.
+At most one batch per unit is handed to the pool at a time. Without `pipelined_requests` that is also the only batch
+in flight, because the RPi server then handles one batch at a time.
+
+Example fleet file:
+{
+    "io_workers": 4,
+    "units": [
+        {"name": "panel A", "host": "192.168.80.1", "port": 5000, "config": "config.json"},
+        {"name": "panel B", "host": "192.168.81.1", "port": 5000, "config": "config_panel_b.json"}
+    ]
+}
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import statistics
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+current_dir = os.path.dirname(os.path.abspath(__file__)) # Get the current file's directory
+parent_dir = os.path.dirname(current_dir) # Get the parent directory
+sys.path.append(parent_dir) # Add the parent directory to sys.path
+
+from channel_definitions import Channel_Entries
+from SocketSenderManager import SocketSenderManager
+
+
+class FleetUnit:
+    ''' one simulator in the fleet. Place commands with `unit.ssm.place_*` and read responses from `unit.resp_queue`,
+    exactly as with a stand-alone SocketSenderManager.'''
+    def __init__(self, name: str, ssm: SocketSenderManager, channel_entries: Channel_Entries,
+                 resp_queue: queue.Queue, runtime_settings: dict):
+        self.name = name
+        self.ssm = ssm
+        self.channel_entries = channel_entries
+        self.resp_queue = resp_queue
+        self.runtime_settings = runtime_settings
+
+        self.busy = False # True while a batch for this unit is in the I/O pool
+        self.numBatches = 0
+        self.numEntries = 0
+        self.numFailures = 0
+        self.rtts = deque(maxlen=5000) # seconds, most recent at end
+
+    def stats(self) -> dict:
+        rtts_ms = sorted(r * 1000 for r in self.rtts)
+        latency = {}
+        if len(rtts_ms) > 0:
+            latency = {"mean_ms": statistics.fmean(rtts_ms),
+                       "p50_ms": statistics.median(rtts_ms),
+                       "p95_ms": rtts_ms[min(len(rtts_ms) - 1, int(0.95 * len(rtts_ms)))],
+                       "max_ms": rtts_ms[-1]}
+        return {"host": self.ssm.host, "batches": self.numBatches, "entries": self.numEntries,
+                "failures": self.numFailures, "latency": latency}
+
+
+class FleetController:
+    def __init__(self, io_workers: int = 4, loopDelay: float = 0.1):
+        '''
+        io_workers : number of threads that perform socket exchanges for all units together
+        loopDelay : longest time (seconds) the scheduler sleeps when no entry is due
+        '''
+        self.loopDelay = loopDelay
+        self.units = dict() # name -> FleetUnit
+        self.pool = ThreadPoolExecutor(max_workers=max(1, io_workers), thread_name_prefix="fleet-io")
+        self.wakeEvent = threading.Event() # shared by every unit's SocketSenderManager
+        self.statsMutex = threading.Lock()
+        self._stop = False
+        self.startTime = time.time()
+        self.schedulerThread = threading.Thread(target=self._schedule, daemon=True)
+
+    @classmethod
+    def from_fleet_file(cls, fleet_file_path: str) -> 'FleetController':
+        ''' alternative constructor; builds a controller and its units from a fleet JSON file (see module docstring)'''
+        with open(fleet_file_path, 'r') as f:
+            fleet_json = json.load(f)
+        fc = cls(io_workers=fleet_json.get("io_workers", 4))
+        baseDir = os.path.dirname(os.path.abspath(fleet_file_path))
+        for u in fleet_json["units"]:
+            fc.add_unit(name=u["name"], host=u["host"], port=u.get("port", 5000),
+                        config_file_path=os.path.join(baseDir, u.get("config", "config.json")))
+        return fc
+
+    def add_unit(self, name: str, host: str, port: int, config_file_path: str) -> FleetUnit:
+        if name in self.units:
+            raise ValueError(f"A unit named `{name}` is already part of the fleet")
+        channel_entries = Channel_Entries()
+        channel_entries.load_from_config_file(config_file_path=config_file_path)
+        with open(config_file_path, 'r') as f:
+            runtime_settings = json.load(f).get("runtime_settings", {})
+
+        resp_queue = queue.Queue()
+        ssm = SocketSenderManager(host=host, port=port, q=resp_queue,
+                                  socketTimeout=runtime_settings.get("socket_timeout_s", 3),
+                                  testSocketOnInit=False, loopDelay=self.loopDelay,
+                                  log=runtime_settings.get("enable_verbose_logging", False), startLoop=False,
+                                  pipelined=runtime_settings.get("pipelined_requests", False),
+                                  wakeEvent=self.wakeEvent) # placing a command on any unit wakes the shared scheduler
+        ssm.set_channel_map(channel_entries, edgeCaptureBuffer=runtime_settings.get("di_edge_capture_buffer", 0),
+                            aiAcquisitionRate=runtime_settings.get("ai_acquisition_rate_hz", 0),
+                            aiBufferSize=runtime_settings.get("ai_acquisition_buffer", 256),
+                            aiDefaultWindow=runtime_settings.get("ai_LPF_boxcar_length", 5))
+        unit = FleetUnit(name, ssm, channel_entries, resp_queue, runtime_settings)
+        ssm.replyListeners.append(lambda rtt, u=unit: self._record_rtt(u, rtt)) # pipelined replies arrive after `_exchange`
+        self.units[name] = unit
+        return unit
+
+    def unit(self, name: str) -> FleetUnit:
+        return self.units[name]
+
+    def start(self) -> None:
+        self.startTime = time.time()
+        self.schedulerThread.start()
+
+    def close(self) -> None:
+        self._stop = True
+        self.wakeEvent.set()
+        for unit in self.units.values():
+            unit.ssm.close()
+        self.pool.shutdown(wait=False)
+
+    def _schedule(self) -> None:
+        ''' the single scheduler: pops due entries from every idle unit and submits each batch to the I/O pool'''
+        while not self._stop:
+            # cleared before the scan, so that an entry placed (or a batch returned) during the scan cuts the wait short
+            self.wakeEvent.clear()
+            nextDue = None
+            for unit in self.units.values():
+                if unit.busy:
+                    continue # its next batch is popped once the one in flight returns
+                outgoings = unit.ssm.pop_due_batch()
+                if outgoings is not None:
+                    unit.busy = True
+                    self.pool.submit(self._exchange, unit, outgoings, time.time())
+                    continue
+                unitNextDue = unit.ssm.next_due_time() # a unit whose link is down retries with its outbox
+                if unitNextDue is not None and (nextDue is None or unitNextDue < nextDue):
+                    nextDue = unitNextDue
+
+            waitFor = self.loopDelay
+            if nextDue is not None:
+                waitFor = min(waitFor, nextDue - time.time())
+            if waitFor > 0:
+                self.wakeEvent.wait(waitFor)
+
+    def _exchange(self, unit: FleetUnit, outgoings: list, popTime: float) -> None:
+        try:
+            sent = unit.ssm.send_batch(outgoings, popTime)
+        except Exception as e:
+            print(f"[FleetController] unexpected error while talking to {unit.name}: {e}")
+            sent = False
+        with self.statsMutex:
+            unit.numBatches += 1
+            if sent:
+                unit.numEntries += len(outgoings)
+            else:
+                unit.numFailures += 1
+        unit.busy = False
+        self.wakeEvent.set() # the unit can take its next batch now
+
+    def _record_rtt(self, unit: FleetUnit, rtt: float) -> None:
+        with self.statsMutex:
+            unit.rtts.append(rtt)
+
+    def report(self) -> dict:
+        ''' per-unit latency (socket round-trip time per packet) and aggregate throughput since `start`'''
+        elapsed = max(time.time() - self.startTime, 1e-9)
+        with self.statsMutex:
+            perUnit = {name: u.stats() for name, u in self.units.items()}
+        totalEntries = sum(u["entries"] for u in perUnit.values())
+        totalBatches = sum(u["batches"] for u in perUnit.values())
+        return {"elapsed_s": elapsed,
+                "aggregate": {"entries": totalEntries, "batches": totalBatches,
+                              "entries_per_s": totalEntries / elapsed, "batches_per_s": totalBatches / elapsed},
+                "units": perUnit}
+
+
+if __name__ == "__main__":
+    import argparse
+    from ScenarioRunner import ScenarioRunner
+    from SimulatorController import SimulatorController, read_runtime_settings
+
+    parser = argparse.ArgumentParser(description="Drive several simulators concurrently")
+    parser.add_argument("fleet", help="fleet JSON file (see FleetController.py)")
+    parser.add_argument("--scenario", default=None, help="run this scenario file on every unit concurrently")
+    parser.add_argument("--poll-seconds", type=float, default=10,
+                        help="without --scenario: poll every input channel of every unit for this long")
+    args = parser.parse_args()
+
+    fleet = FleetController.from_fleet_file(args.fleet)
+    fleet.start()
+    try:
+        if args.scenario is not None:
+            scenario = ScenarioRunner.load_scenario(args.scenario)
+            results = dict()
+            def _run_on(unit):
+                controller = SimulatorController(unit.ssm, unit.channel_entries,
+                                                 read_runtime_settings({"runtime_settings": unit.runtime_settings}))
+                runner = ScenarioRunner(controller, log=lambda msg, n=unit.name: print(f"[{n}] {msg}"))
+                results[unit.name] = runner.run(scenario)
+                runner.close()
+            threads = [threading.Thread(target=_run_on, args=(u,)) for u in fleet.units.values()]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            for name, r in results.items():
+                print(f"{name}: {'PASSED' if r['passed'] else 'FAILED'} in {r['duration_s']:.2f} s")
+        else:
+            end = time.time() + args.poll_seconds
+            while time.time() < end:
+                for unit in fleet.units.values():
+                    for ch in unit.channel_entries.channels.values():
+                        if ch.getGPIOStr() is None:
+                            continue
+                        if ch.sig_type.lower() == "ai":
+                            unit.ssm.place_single_mA(ch2send=ch, mA_val=unit.runtime_settings.get("ai_LPF_boxcar_length", 5), time=time.time())
+                        elif ch.sig_type.lower() == "di":
+                            unit.ssm.place_single_EngineeringUnits(ch2send=ch, val_in_eng_units=0, time=time.time())
+                    while not unit.resp_queue.empty():
+                        unit.resp_queue.get()
+                time.sleep(0.05)
+        print(json.dumps(fleet.report(), indent=4))
+    finally:
+        fleet.close()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+In-band link monitor for the simulator. A background thread sends a small `h` (heartbeat) packet to the RPi server
+every `period_s` and keeps rolling round-trip-time, jitter and loss statistics. The RPi echoes heartbeats without
+touching its command queue, so they measure the link and the server process rather than the hardware.
+
+The GUI reads `get_health()` from its Tk loop; it only copies a snapshot under a lock and never blocks on the network.
+"""
+
+import os
+import sys
+import socket
+import threading
+import time
+from collections import deque
+
+current_dir = os.path.dirname(os.path.abspath(__file__)) # Get the current file's directory
+parent_dir = os.path.dirname(current_dir) # Get the parent directory
+sys.path.append(parent_dir) # Add the parent directory to sys.path
+
+from PacketBuilder import DataPacketModel
+
+
+class HeartbeatMonitor:
+    STATE_UNKNOWN = "unknown" # no heartbeat has been answered yet (and fewer than `offline_after_misses` were lost)
+    STATE_ONLINE = "online"
+    STATE_DEGRADED = "degraded" # answering, but losing heartbeats or answering slowly
+    STATE_OFFLINE = "offline" # `offline_after_misses` heartbeats in a row went unanswered
+
+    def __init__(self, host: str, port: int, period_s: float = 0.5, timeout_s: float = 0.5,
+                 window: int = 20, offline_after_misses: int = 2, degraded_rtt_s: float = 0.25):
+        '''
+        host, port : the RPi server (same as SocketSenderManager)
+        period_s : time between heartbeats
+        timeout_s : a heartbeat not answered within this time counts as lost. Keep this well under the command
+                    socket timeout so that a dead link is reported before any command times out.
+        window : number of recent heartbeats used for the loss and mean RTT statistics
+        offline_after_misses : consecutive lost heartbeats before the link is declared offline
+        degraded_rtt_s : mean RTT above which an answering link is reported as degraded
+        '''
+        self.host = host
+        self.port = port
+        self.period_s = period_s
+        self.timeout_s = timeout_s
+        self.offline_after_misses = max(1, offline_after_misses)
+        self.degraded_rtt_s = degraded_rtt_s
+
+        self._mutex = threading.Lock()
+        self._outcomes = deque(maxlen=window) # True for answered heartbeats, False for lost ones
+        self._rtts = deque(maxlen=window) # seconds, answered heartbeats only
+        self._lastRTT = None
+        self._jitter = 0.0 # smoothed RTT variation (RFC 3550 style), seconds
+        self._consecutiveMisses = 0
+        self._lastAnswered = None # time.time() of the last answered heartbeat
+        self._numSent = 0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+
+    def probe_once(self) -> float | None:
+        ''' sends a single heartbeat and waits for the echo. Returns the round-trip time in seconds, or None if the
+        server did not answer within `timeout_s`. Does not update the rolling statistics.'''
+        sentTime = time.time()
+        sock = socket.socket()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.timeout_s)
+        try:
+            sock.connect((self.host, self.port))
+            DataPacketModel(dataEntries=[], msg_type="h", error_entries=None, time=sentTime).to_socket(sock)
+            reply = DataPacketModel.from_socket(sock)
+        except Exception:
+            return None
+        finally:
+            sock.close()
+        if reply.msg_type != "h":
+            return None
+        return time.time() - sentTime
+
+    def _loop(self) -> None:
+        nextBeat = time.time()
+        while not self._stop.is_set():
+            rtt = self.probe_once()
+            self._record(rtt)
+            nextBeat += self.period_s
+            # never try to catch up on missed beats; a lost heartbeat already took `timeout_s`
+            nextBeat = max(nextBeat, time.time())
+            self._stop.wait(nextBeat - time.time())
+
+    def _record(self, rtt: float | None) -> None:
+        with self._mutex:
+            self._numSent += 1
+            self._outcomes.append(rtt is not None)
+            if rtt is None:
+                self._consecutiveMisses += 1
+                return
+            if self._lastRTT is not None:
+                self._jitter += (abs(rtt - self._lastRTT) - self._jitter) / 16
+            self._lastRTT = rtt
+            self._rtts.append(rtt)
+            self._consecutiveMisses = 0
+            self._lastAnswered = time.time()
+
+    def get_health(self) -> dict:
+        ''' non-blocking snapshot of the link health. Times are in milliseconds; `loss` is the fraction of the
+        recent window of heartbeats that went unanswered.'''
+        with self._mutex:
+            numOutcomes = len(self._outcomes)
+            loss = 0.0 if numOutcomes == 0 else self._outcomes.count(False) / numOutcomes
+            meanRTT = None if len(self._rtts) == 0 else sum(self._rtts) / len(self._rtts)
+
+            if self._consecutiveMisses >= self.offline_after_misses:
+                state = self.STATE_OFFLINE
+            elif self._lastAnswered is None: # nothing answered yet, but not enough misses to call it offline
+                state = self.STATE_UNKNOWN
+            elif loss > 0 or (meanRTT is not None and meanRTT > self.degraded_rtt_s):
+                state = self.STATE_DEGRADED
+            else:
+                state = self.STATE_ONLINE
+
+            return {"state": state,
+                    "rtt_ms": None if self._lastRTT is None else self._lastRTT * 1000,
+                    "rtt_mean_ms": None if meanRTT is None else meanRTT * 1000,
+                    "jitter_ms": self._jitter * 1000,
+                    "loss": loss,
+                    "consecutive_misses": self._consecutiveMisses,
+                    "last_answered": self._lastAnswered,
+                    "heartbeats_sent": self._numSent}
+
+
+if __name__ == "__main__":
+    hm = HeartbeatMonitor(host="192.168.80.1", port=5000, period_s=0.5, timeout_s=0.5)
+    hm.start()
+    try:
+        while True:
+            time.sleep(1)
+            print(hm.get_health())
+    except KeyboardInterrupt:
+        hm.close()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+Headless scenario engine for automated panel tests. A scenario is a declarative list of steps that is
+run against the simulator through a SimulatorController, without the Tk GUI. Example scenario file:
+
+{
+    "name": "motor trips on high pressure",
+    "steps": [
+        {"set": "Motor Status 1", "value": 1},
+        {"set_together": {"SPT 1": 120, "MAT 1": 35}},
+        {"ramp": "SPT 1", "from": 100, "to": 150, "rate": 5},
+        {"wait_until": "MTR 1", "op": "==", "value": 0, "timeout_s": 2},
+        {"assert": "UVT 1", "op": ">", "value": 40},
+        {"wait_until": "SPD 1", "field": "freq_hz", "op": ">", "value": 55, "timeout_s": 3},
+        {"relay_sequence": [{"set": "Motor Status 1", "value": 1, "at_ms": 0}, {"set": "Motor Status 2", "value": 1, "at_ms": 250},
+                            {"set": "Motor Status 1", "value": 0, "at_ms": 2250}, {"set": "Motor Status 2", "value": 0, "at_ms": 2250}],
+         "max_late_ms": 5},
+        {"sleep": 0.5}
+    ]
+}
+
+Values are in the channel's engineering units unless the step has "units": "mA". For a di channel in "frequency"
+mode, "field" picks which part of the reading is compared ("count", "freq_hz", "duty" or "level").
+Waits and assertions block on a condition variable that is notified whenever a response arrives from the RPi,
+so a step finishes as soon as the awaited reading is received rather than on the next sleep tick.
+A "set_together" step writes several analog outputs so that they change at the same moment on the RPi (see
+SimulatorController.set_values_together); it waits for every one of them to be acknowledged.
+A "relay_sequence" step is uploaded to the RPi and timed there (see SimulatorController.run_relay_sequence); it fails if
+any switch was more than "max_late_ms" late (if given).
+"""
+
+import os
+import sys
+import json
+import time
+import operator
+
+current_dir = os.path.dirname(os.path.abspath(__file__)) # Get the current file's directory
+parent_dir = os.path.dirname(current_dir) # Get the parent directory
+sys.path.append(parent_dir) # Add the parent directory to sys.path
+
+from Tracer import tracer
+from channel_definitions import Channel_Entry
+from SimulatorController import SimulatorController
+
+
+class ScenarioRunner:
+    ''' runs declarative test scenarios against one simulator. The controller's background threads are started
+    to read responses and poll inputs, so the same controller must not also be driven by a GUI.
+    '''
+    comparisons = {"==": operator.eq, "!=": operator.ne, ">": operator.gt,
+                   ">=": operator.ge, "<": operator.lt, "<=": operator.le}
+
+    def __init__(self, controller: SimulatorController, poll_period_s: float | None = None, log=print):
+        '''
+        controller : the SimulatorController of the simulator to test
+        poll_period_s : how often input channels used by the running scenario are read (default: from the settings)
+        log : callable used for progress messages; pass None for silence
+        '''
+        self.controller = controller
+        self.ssm = controller.ssm
+        self.channel_entries = controller.channel_entries
+        self.poll_period_s = poll_period_s if poll_period_s is not None else controller.settings["poll_buffer_period_ms"] / 1000
+        self.log = log
+
+        self.store = controller.store
+        self.errors = controller.errors # errorEntries received while running, most recent at end
+        controller.start(poll_period_s=self.poll_period_s)
+
+    def close(self) -> None:
+        ''' stops the controller's background threads '''
+        self.controller.stop()
+
+    # --- scenario execution ---
+
+    @staticmethod
+    def load_scenario(file_path: str) -> dict:
+        with open(file_path, 'r') as f:
+            scenario = json.load(f)
+        if "steps" not in scenario:
+            raise ValueError(f"Scenario file {file_path} has no `steps` list")
+        scenario.setdefault("name", os.path.basename(file_path))
+        return scenario
+
+    def run(self, scenario: dict, stop_on_failure: bool = True) -> dict:
+        ''' runs every step of `scenario` in order and returns a result dict with per-step timing.
+        Input channels referenced by the scenario are polled for as long as it runs.
+        '''
+        steps = scenario.get("steps", [])
+        polled = {s[k] for s in steps for k in ("wait_until", "assert") if k in s}
+        for name in polled:
+            self._get_channel(name) # fail early on misspelled signal names
+        self.controller.polled = polled
+
+        results = []
+        scenarioStart = time.time()
+        try:
+            for i, step in enumerate(steps):
+                stepStart = time.time()
+                try:
+                    passed, detail = self._run_step(step)
+                except Exception as e:
+                    passed, detail = (False, f"{type(e).__name__}: {e}")
+                result = {"index": i, "name": step.get("name", self._describe(step)), "passed": passed,
+                          "start_offset_s": stepStart - scenarioStart, "duration_s": time.time() - stepStart,
+                          "detail": detail}
+                results.append(result)
+                if self.log is not None:
+                    self.log(f"[{'PASS' if passed else 'FAIL'}] step {i} {result['name']} "
+                             f"({result['duration_s']*1000:.0f} ms) {detail}")
+                if not passed and stop_on_failure:
+                    break
+        finally:
+            self.controller.polled = set()
+
+        return {"scenario": scenario.get("name", ""),
+                "passed": len(results) == len(steps) and all(r["passed"] for r in results),
+                "duration_s": time.time() - scenarioStart,
+                "steps": results}
+
+    def _run_step(self, step: dict) -> tuple[bool, str]:
+        if "sleep" in step:
+            time.sleep(float(step["sleep"]))
+            return (True, "")
+        if "set" in step:
+            return self._step_set(step)
+        if "set_together" in step:
+            return self._step_set_together(step)
+        if "ramp" in step:
+            return self._step_ramp(step)
+        if "relay_sequence" in step:
+            return self._step_relay_sequence(step)
+        if "wait_until" in step:
+            return self._step_wait(step["wait_until"], step, timeout_s=float(step.get("timeout_s", 5)), freshOnly=True)
+        if "assert" in step:
+            # an assertion checks the next reading; it only waits long enough for one to arrive
+            return self._step_wait(step["assert"], step, timeout_s=float(step.get("timeout_s", 3*self.poll_period_s + self.ssm.socketTimeout)),
+                                   freshOnly=step.get("fresh", True), mustHoldFirstTime=True)
+        raise ValueError(f"Unrecognized step {step}")
+
+    def _step_set(self, step: dict) -> tuple[bool, str]:
+        ch = self._get_channel(step["set"])
+        value = step["value"]
+        seqBefore = self.store.current_seq()
+        success, errorString = self.controller.set_value(ch.name, value, units=step.get("units"))
+        if step.get("units") == "mA" and ch.sig_type.lower()[0] == "a":
+            value = ch.mA_to_EngineeringUnits(float(value))
+        if not success:
+            return (False, errorString)
+        if not step.get("wait", True):
+            return (True, "placed")
+        return self._await_ack(ch, value, seqBefore, timeout_s=float(step.get("timeout_s", self.ssm.socketTimeout + 2)))
+
+    def _step_set_together(self, step: dict) -> tuple[bool, str]:
+        channels = [self._get_channel(name) for name in step["set_together"]]
+        seqBefore = self.store.current_seq()
+        success, errorString = self.controller.set_values_together(step["set_together"], units=step.get("units"))
+        if not success:
+            return (False, errorString)
+        if not step.get("wait", True):
+            return (True, "placed")
+        timeout_s = float(step.get("timeout_s", self.ssm.socketTimeout + 2))
+        for ch in channels:
+            value = step["set_together"][ch.name]
+            if step.get("units") == "mA":
+                value = ch.mA_to_EngineeringUnits(float(value))
+            ok, detail = self._await_ack(ch, value, seqBefore, timeout_s=timeout_s)
+            if not ok:
+                return (False, detail)
+        return (True, f"acknowledged {len(channels)} outputs together")
+
+    def _step_ramp(self, step: dict) -> tuple[bool, str]:
+        ch = self._get_channel(step["ramp"])
+        inMA = step.get("units") == "mA"
+        start = step.get("from")
+        if start is None:
+            start = self.store.get(ch.name) # resume from the last acknowledged value
+            if start is None or start == "NAK":
+                return (False, f"No `from` value given and no previous value is known for {ch.name}")
+            if inMA:
+                start = ch.EngineeringUnits_to_mA(start)
+        stop = float(step["to"])
+        rate = abs(float(step["rate"]))
+        if not inMA: # place_ramp works in mA
+            startmA, stopmA, ratemA = (ch.EngineeringUnits_to_mA(float(start)), ch.EngineeringUnits_to_mA(stop),
+                                       ch.EngineeringUnitsRate_to_mARate(rate))
+        else:
+            startmA, stopmA, ratemA = (float(start), stop, rate)
+
+        seqBefore = self.store.current_seq()
+        placed, _ = self.controller.ramp(ch.name, startmA, stopmA, ratemA, units="mA")
+        if not placed:
+            return (False, f"Refused ramp for {ch.name} from {start} to {stop}")
+        if not step.get("wait", True):
+            return (True, "placed")
+        expectedDuration = abs(stopmA - startmA) / abs(ratemA)
+        stopEng = ch.mA_to_EngineeringUnits(stopmA)
+        return self._await_ack(ch, stopEng, seqBefore,
+                               timeout_s=float(step.get("timeout_s", expectedDuration + self.ssm.socketTimeout + 2)))
+
+    def _await_ack(self, ch: Channel_Entry, value, seqBefore: int, timeout_s: float) -> tuple[bool, str]:
+        ''' waits for the RPi's echo of an output command with the given value (engineering units) '''
+        def _matches(v):
+            if v == "NAK":
+                return True # stop waiting; reported as a failure below
+            if ch.sig_type.lower()[0] == "a":
+                return abs(v - value) <= 1e-6 * max(1.0, abs(value))
+            return int(v) == int(value)
+
+        ok, last = self.store.wait_for(ch.name, _matches, timeout_s=timeout_s, after_seq=seqBefore)
+        if not ok:
+            return (False, f"No acknowledgement of {value} for {ch.name} within {timeout_s:.1f} s (last value: {last})")
+        if last == "NAK":
+            return (False, f"RPi reported an error writing {ch.name}")
+        return (True, f"acknowledged {ch.name}={last}")
+
+    def _step_relay_sequence(self, step: dict) -> tuple[bool, str]:
+        steps = [(float(s.get("at_ms", 0)), s["set"], int(s["value"])) for s in step["relay_sequence"]]
+        ok, result = self.controller.run_relay_sequence(steps, timeout_s=step.get("timeout_s"))
+        if isinstance(result, str):
+            return (False, result)
+        worst = max((s[4] for s in result["steps"]), default=0)
+        if not ok:
+            return (False, f"relay sequence {result['state']} after {len(result['steps'])} of {len(steps)} switches; errors: {result['errors']}")
+        if "max_late_ms" in step and worst > float(step["max_late_ms"]):
+            return (False, f"a switch was {worst:.2f} ms late (limit {step['max_late_ms']} ms)")
+        return (True, f"{len(steps)} switches, at most {worst:.2f} ms late")
+
+    def _step_wait(self, name: str, step: dict, timeout_s: float, freshOnly: bool,
+                   mustHoldFirstTime: bool = False) -> tuple[bool, str]:
+        ch = self._get_channel(name)
+        compare = self.comparisons.get(step.get("op", "=="))
+        if compare is None:
+            raise ValueError(f"Unknown comparison `{step.get('op')}`. Use one of {list(self.comparisons.keys())}")
+        target = step["value"]
+        if step.get("units") == "mA" and ch.sig_type.lower() == "ai":
+            target = ch.mA_to_EngineeringUnits(float(target))
+
+        field = step.get("field")
+        pick = (lambda v: v[field] if isinstance(v, dict) else v) if field is not None else (lambda v: v)
+
+        if mustHoldFirstTime:
+            # an assertion is decided by the first fresh reading, whatever its value
+            predicate = lambda v: True
+        else:
+            predicate = lambda v: v != "NAK" and compare(pick(v), target)
+
+        ok, last = self.store.wait_for(ch.name, predicate, timeout_s=timeout_s,
+                                       after_seq=self.store.current_seq() if freshOnly else 0)
+        if not ok:
+            return (False, f"{ch.name} {step.get('op', '==')} {target} not met within {timeout_s:.1f} s (last value: {last})")
+        if mustHoldFirstTime and (last == "NAK" or not compare(pick(last), target)):
+            return (False, f"expected {ch.name} {step.get('op', '==')} {target}, but read {last}")
+        return (True, f"{ch.name}={last}")
+
+    def _get_channel(self, name: str) -> Channel_Entry:
+        ch = self.channel_entries.getChannelEntry(name)
+        if ch is None:
+            raise ValueError(f"Unknown signal name `{name}`")
+        if ch.getGPIOStr() is None:
+            raise ValueError(f"The boardSlotPosition ({ch.boardSlotPosition}) for {name} is invalid.")
+        return ch
+
+    @staticmethod
+    def _describe(step: dict) -> str:
+        for k in ("set", "ramp", "wait_until", "assert"):
+            if k in step:
+                return f"{k} {step[k]}"
+        if "sleep" in step:
+            return f"sleep {step['sleep']} s"
+        if "set_together" in step:
+            return f"set together {step['set_together']}"
+        if "relay_sequence" in step:
+            return f"relay sequence of {len(step['relay_sequence'])} switches"
+        return str(step)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run scenario files against the simulator without the GUI")
+    parser.add_argument("scenarios", nargs="+", help="scenario JSON files, run in the given order")
+    parser.add_argument("--config", default="config.json", help="channel configuration file")
+    parser.add_argument("--host", default="192.168.80.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--report", default=None, help="write the JSON results of all scenarios to this file")
+    parser.add_argument("--keep-going", action="store_true", help="run the remaining steps of a scenario after a failure")
+    parser.add_argument("--trace", default=None, help="trace every command and write a Chrome trace (JSON) to this file")
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        tracer.enable()
+    controller = SimulatorController.from_config_file(args.config, host=args.host, port=args.port, log=False)
+    runner = ScenarioRunner(controller)
+    allResults = []
+    try:
+        for path in args.scenarios:
+            scenario = ScenarioRunner.load_scenario(path)
+            print(f"=== {scenario['name']} ===")
+            allResults.append(runner.run(scenario, stop_on_failure=not args.keep_going))
+    finally:
+        runner.close()
+        controller.close()
+        if args.trace is not None:
+            print(f"wrote {tracer.export(args.trace)} trace events to {args.trace}")
+
+    numPassed = sum(1 for r in allResults if r["passed"])
+    print(f"{numPassed}/{len(allResults)} scenarios passed")
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(allResults, f, indent=4)
+    sys.exit(0 if numPassed == len(allResults) else 1)
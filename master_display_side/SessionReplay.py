@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Record and replay the stream of commands that an engineer places through a SocketSenderManager,
+so that a manual panel test can be re-run later as a repeatable regression run.
+
+Recording:
+    SSM.recorder = SessionRecorder("logs/session_2025-04-01.jsonl")
+    ... drive the GUI as usual ...
+    SSM.recorder.close()
+
+Replaying:
+    replayer = SessionReplayer(SSM, "logs/session_2025-04-01.jsonl", speed=2.0)
+    report = replayer.run()
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import statistics
+
+current_dir = os.path.dirname(os.path.abspath(__file__)) # Get the current file's directory
+parent_dir = os.path.dirname(current_dir) # Get the parent directory
+sys.path.append(parent_dir) # Add the parent directory to sys.path
+
+from PacketBuilder import dataEntry
+
+
+class SessionRecorder:
+    ''' Writes every dataEntry handed to `record` as one JSON line. The first line is a header that holds the
+    session start time; every following line holds the wall-clock time at which the command was placed (`placed`)
+    and the entry itself, whose `time` field is the time the command was scheduled to go out (ramps are scheduled
+    into the future, so the two can differ).
+    Lines are flushed as they are written so that a crashed GUI still leaves a usable recording.
+    '''
+    def __init__(self, file_path: str, include_polls: bool = True):
+        '''
+        file_path : where to write the recording. Will be overwritten if it exists.
+        include_polls : if False, the periodic `ai`/`di` read requests are not recorded
+        '''
+        self.file_path = file_path
+        self.include_polls = include_polls
+        self.numRecorded = 0
+        self.mutex = threading.Lock() # entries are placed from both the GUI thread and the ramp helpers
+        self.sessionStart = time.time()
+        self._f = open(file_path, "w", encoding="utf-8")
+        self._f.write(json.dumps({"session_start": self.sessionStart}) + "\n")
+        self._f.flush()
+
+    def record(self, de: dataEntry, placedTime: float) -> None:
+        if not self.include_polls and de.chType.lower()[1] == "i":
+            return
+        line = json.dumps({"placed": placedTime, "entry": de.as_dict(), "priority": getattr(de, "priority", None)})
+        with self.mutex:
+            if self._f.closed:
+                return
+            self._f.write(line + "\n")
+            self._f.flush()
+            self.numRecorded += 1
+
+    def close(self) -> None:
+        with self.mutex:
+            if not self._f.closed:
+                self._f.close()
+
+
+class SessionReplayer:
+    ''' Re-issues a recording made by SessionRecorder through a SocketSenderManager's CommandQueue.
+    Every recorded entry keeps its offset from the start of the recorded session (divided by `speed`), so ramps
+    and the pauses between operator actions are reproduced. The manager's sender loop wakes up exactly when each
+    entry falls due, and this class listens to its dispatches to measure how far each entry went out from its
+    intended time.
+    '''
+    def __init__(self, ssm, file_path: str, speed: float = 1.0, include_polls: bool = True, lead_time_s: float = 0.5):
+        '''
+        ssm : a running SocketSenderManager instance
+        file_path : a recording written by SessionRecorder
+        speed : playback speed multiplier. 2.0 replays twice as fast; 0.5 at half speed
+        include_polls : if False, recorded `ai`/`di` read requests are skipped
+        lead_time_s : delay between calling `run` and the first replayed entry, so that placing a long recording
+                      onto the queue does not eat into the schedule
+        '''
+        if speed <= 0:
+            raise ValueError(f"Expected a positive playback speed, but received {speed}")
+        self.ssm = ssm
+        self.file_path = file_path
+        self.speed = speed
+        self.include_polls = include_polls
+        self.lead_time_s = lead_time_s
+
+        self.sessionStart, self.records = self._load(file_path)
+
+        self._pending = dict() # id(dataEntry) -> dataEntry, for entries that have not been sent yet
+        self._popErrors = [] # seconds between intended time and the sender loop popping the entry
+        self._sendErrors = [] # seconds between intended time and the packet leaving on the socket
+        self._numDropped = 0 # entries the manager merged, shed or compacted instead of sending
+        self._mutex = threading.Lock()
+        self._allSent = threading.Event()
+
+    @staticmethod
+    def _load(file_path: str) -> tuple[float, list[dict]]:
+        with open(file_path, "r", encoding="utf-8") as f:
+            lines = [json.loads(l) for l in f if l.strip() != ""]
+        if len(lines) == 0 or "session_start" not in lines[0]:
+            raise ValueError(f"{file_path} is not a session recording (missing header line)")
+        return (lines[0]["session_start"], lines[1:])
+
+    def _on_drop(self, entries: list[dataEntry]) -> None:
+        ''' entries that were merged into another, shed or compacted will never be sent; they count as resolved '''
+        with self._mutex:
+            for e in entries:
+                if self._pending.pop(id(e), None) is not None:
+                    self._numDropped += 1
+            if len(self._pending) == 0:
+                self._allSent.set()
+
+    def _on_dispatch(self, entries: list[dataEntry], popTime: float, sendTime: float) -> None:
+        with self._mutex:
+            for e in entries:
+                if self._pending.pop(id(e), None) is None:
+                    continue # not one of ours (e.g. a GUI poll placed during the replay)
+                self._popErrors.append(popTime - e.time)
+                self._sendErrors.append(sendTime - e.time)
+            if len(self._pending) == 0:
+                self._allSent.set()
+
+    def run(self, timeout_s: float | None = None, grace_s: float = 30.0) -> dict:
+        ''' places every recorded entry on the command queue at its rescaled time, then blocks until all of them have
+        been sent or dropped by the manager (or `timeout_s` has elapsed) and returns the scheduling error statistics.
+        See `summarize`. If `timeout_s` is None, the wait ends `grace_s` seconds after the last entry was due.
+        '''
+        replayStart = time.time() + self.lead_time_s
+        entries = []
+        for r in self.records:
+            de = dataEntry.from_dict(r["entry"])
+            if not self.include_polls and de.chType.lower()[1] == "i":
+                continue
+            de.time = float(replayStart + (de.time - self.sessionStart) / self.speed)
+            de.priority = r.get("priority") # so replayed ramp steps keep their waveform class
+            entries.append(de)
+
+        if len(entries) == 0:
+            return self.summarize(numPlaced=0)
+
+        if timeout_s is None:
+            timeout_s = max(de.time for de in entries) - time.time() + grace_s
+        with self._mutex:
+            self._pending = {id(de): de for de in entries}
+            self._numDropped = 0
+            self._allSent.clear()
+        self.ssm.dispatchListeners.append(self._on_dispatch)
+        self.ssm.dropListeners.append(self._on_drop)
+        try:
+            for de in entries:
+                self.ssm.place_single_dataEntry(de)
+            self._allSent.wait(timeout=timeout_s)
+        finally:
+            self.ssm.dispatchListeners.remove(self._on_dispatch)
+            self.ssm.dropListeners.remove(self._on_drop)
+        return self.summarize(numPlaced=len(entries))
+
+    def summarize(self, numPlaced: int) -> dict:
+        ''' scheduling error statistics in milliseconds. A positive error means the entry went out late.
+        `dispatch` errors are measured when the sender loop popped the entry (the scheduler's own accuracy);
+        `on_wire` errors also include the socket connect time.
+        '''
+        with self._mutex:
+            report = {"placed": numPlaced, "sent": len(self._sendErrors), "dropped": self._numDropped,
+                      "unsent": len(self._pending),
+                      "speed": self.speed}
+            for name, errs in (("dispatch", self._popErrors), ("on_wire", self._sendErrors)):
+                report[name] = self._error_stats_ms(errs)
+        return report
+
+    @staticmethod
+    def _error_stats_ms(errs: list[float]) -> dict:
+        if len(errs) == 0:
+            return {}
+        ms = sorted(e * 1000 for e in errs)
+        return {"mean_ms": statistics.fmean(ms),
+                "median_ms": statistics.median(ms),
+                "p95_ms": ms[min(len(ms) - 1, int(0.95 * len(ms)))],
+                "max_abs_ms": max(abs(m) for m in ms),
+                "stdev_ms": statistics.pstdev(ms),
+                "within_10ms": sum(1 for m in ms if abs(m) <= 10) / len(ms)}
+
+
+if __name__ == "__main__":
+    import argparse
+    import queue
+    from SocketSenderManager import SocketSenderManager
+
+    parser = argparse.ArgumentParser(description="Replay a recorded simulator session")
+    parser.add_argument("recording", help="a session_*.jsonl file written by SessionRecorder")
+    parser.add_argument("--host", default="192.168.80.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--speed", type=float, default=1.0, help="playback speed multiplier")
+    parser.add_argument("--no-polls", action="store_true", help="skip recorded ai/di read requests")
+    args = parser.parse_args()
+
+    respQueue = queue.Queue()
+    ssm = SocketSenderManager(host=args.host, port=args.port, q=respQueue, socketTimeout=3,
+                              testSocketOnInit=False, loopDelay=0.1, log=False)
+    replayer = SessionReplayer(ssm, args.recording, speed=args.speed, include_polls=not args.no_polls)
+    print(f"Replaying {len(replayer.records)} recorded entries at {args.speed}x...")
+    report = replayer.run()
+    ssm.close()
+
+    numErrors = 0
+    while not respQueue.empty():
+        if not isinstance(respQueue.get(), dataEntry):
+            numErrors += 1
+    print(json.dumps(report, indent=4))
+    print(f"{numErrors} error entries were received during the replay")
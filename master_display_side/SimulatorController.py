@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+"""
+The simulator's control logic without any GUI. A SimulatorController owns the SocketSenderManager, the channel
+configuration and the latest value received for every channel. The Tk window (simulator_gui.py), the scenario engine
+(ScenarioRunner.py) and any automation script all drive the simulator through the same methods:
+
+    from SimulatorController import SimulatorController
+    sim = SimulatorController.from_config_file("config.json")
+    sim.start()                                   # headless: handle responses and poll inputs in the background
+    sim.set_value("SPT 1", 150)                   # engineering units (or units="mA")
+    sim.ramp("SPT 1", start=100, stop=150, rate=5)
+    sim.set_digital("Motor Status 1", 1)
+    sim.polled.add("UVT 1")                       # read this input every poll period
+    ok, reading = sim.store.wait_for("UVT 1", lambda v: v > 40, timeout_s=2)
+    sim.close()
+
+Commands return (success, error string), like the `place_*` methods of SocketSenderManager.
+A GUI does not call `start`. It calls `process_responses` and `poll_inputs` from its own event loop instead, so that
+its listeners are called on the GUI thread:
+    valueListeners      : f(channel_entry, value, raw_val) for every reading or acknowledgement. `value` is in
+                          engineering units for analog channels (or "NAK"), 0/1 for digital ones (a dict for a di in
+                          "frequency" mode, see channel_definitions.Channel_Entry); `raw_val` is the
+                          value from the packet (mA for analog channels)
+    errorListeners      : f(message, error_entry) for every error that should be shown to the operator
+    connectionListeners : f(online) whenever a response (True) or a socket error (False) arrives
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import threading
+from collections import deque
+from datetime import datetime
+
+current_dir = os.path.dirname(os.path.abspath(__file__)) # Get the current file's directory
+parent_dir = os.path.dirname(current_dir) # Get the parent directory
+sys.path.append(parent_dir) # Add the parent directory to sys.path
+
+from PacketBuilder import dataEntry, errorEntry
+from channel_definitions import Channel_Entries, Channel_Entry
+from CommandQueue import CommandQueue
+from SessionReplay import SessionRecorder
+from Tracer import tracer
+
+
+def read_runtime_settings(all_json: dict) -> dict:
+    ''' the `runtime_settings` section of a parsed config file, with a default for every missing key and every value
+    clamped to its valid range '''
+    s = all_json.get("runtime_settings") or {}
+    return {"error_stack_max_len": max(s.get("error_stack_max_len", 20), 1),
+            "enable_verbose_logging": s.get("enable_verbose_logging", True),
+            "ai_LPF_boxcar_length": max(s.get("ai_LPF_boxcar_length", 5), 1),
+            "poll_buffer_period_ms": max(s.get("poll_buffer_period_ms", 200), 1),
+            "socket_timeout_s": max(s.get("socket_timeout_s", 3), 0),
+            "record_session": s.get("record_session", False),
+            "heartbeat_period_ms": max(s.get("heartbeat_period_ms", 500), 0), # 0 disables the link monitor
+            "max_pending_polls": max(s.get("max_pending_polls", 256), 1),
+            "stale_poll_ms": max(s.get("stale_poll_ms", 2000), 0), # 0 never drops a late poll
+            "coalesce_outputs": s.get("coalesce_outputs", False),
+            "ramp_catchup_policy": s.get("ramp_catchup_policy", "jump"), # "jump", "shift" or "replay"
+            "max_packet_entries": s.get("max_packet_entries", 64), # None for no limit
+            "pipelined_requests": s.get("pipelined_requests", False), # one open connection, several batches in flight
+            "socket_buffer_bytes": max(s.get("socket_buffer_bytes", 0), 0), # SO_SNDBUF/SO_RCVBUF; 0 keeps the OS default
+            "di_edge_capture_buffer": max(s.get("di_edge_capture_buffer", 0), 0), # di edges kept per pin; 0 turns capture off
+            "ai_acquisition_rate_hz": max(s.get("ai_acquisition_rate_hz", 0), 0), # background ai sampling on the RPi; 0 reads on request
+            "ai_acquisition_buffer": max(s.get("ai_acquisition_buffer", 256), 1), # ai samples kept per channel
+            "trace_commands": s.get("trace_commands", False), # writes ./logs/trace_*.json on close (see Tracer.py)
+            "lazy_gui_build": s.get("lazy_gui_build", True)}
+
+
+class LatestValueStore:
+    ''' thread-safe store of the most recent value received for each channel (by signal name).
+    Every update bumps a per-channel sequence number and notifies all waiters, which lets a waiter insist on
+    a reading that arrived after some point in time (see `wait_for`).
+    '''
+    def __init__(self):
+        self._values = dict() # name -> (value, time received, sequence number)
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def update(self, name: str, value, t: float | None = None) -> None:
+        with self._cond:
+            self._seq += 1
+            self._values[name] = (value, time.time() if t is None else t, self._seq)
+            self._cond.notify_all()
+
+    def touch(self, name: str, t: float | None = None) -> None:
+        ''' records that the latest value of `name` was confirmed (e.g. by a reading the RPi reported as unchanged),
+        which counts as a fresh reading for `wait_for` '''
+        with self._cond:
+            v = self._values.get(name)
+            if v is None:
+                return
+            self._seq += 1
+            self._values[name] = (v[0], time.time() if t is None else t, self._seq)
+            self._cond.notify_all()
+
+    def get(self, name: str):
+        ''' returns the latest value for `name`, or None if nothing has been received yet'''
+        with self._cond:
+            v = self._values.get(name)
+        return None if v is None else v[0]
+
+    def current_seq(self) -> int:
+        with self._cond:
+            return self._seq
+
+    def wait_for(self, name: str, predicate, timeout_s: float, after_seq: int = 0) -> tuple[bool, object]:
+        ''' blocks until the latest value of `name` satisfies `predicate` and was received after sequence number
+        `after_seq`. Returns (True, value) on success or (False, last value seen) on timeout.
+        '''
+        def _ready():
+            v = self._values.get(name)
+            return v is not None and v[2] > after_seq and predicate(v[0])
+
+        with self._cond:
+            ok = self._cond.wait_for(_ready, timeout=timeout_s)
+            v = self._values.get(name)
+        return (ok, None if v is None else v[0])
+
+
+class SimulatorController:
+    def __init__(self, ssm, channel_entries: Channel_Entries, settings: dict | None = None):
+        '''
+        ssm : a SocketSenderManager (see `from_config_file` to have one made from the config file). Its response
+              queue (`ssm.qForGUI`) is read by this controller only
+        channel_entries : the channel configuration
+        settings : runtime settings as returned by `read_runtime_settings` (defaults if None)
+        '''
+        self.ssm = ssm
+        self.channel_entries = channel_entries
+        self.settings = settings if settings is not None else read_runtime_settings({})
+        self.resp_queue = ssm.qForGUI
+
+        self.store = LatestValueStore()
+        self.errors = deque(maxlen=self.settings["error_stack_max_len"]) # errorEntries received, most recent at end
+        self.polled = set() # names of input channels read every poll period while `start`ed
+        self.edges = deque(maxlen=1000) # (name, value, time of the edge) of captured di transitions, most recent at end
+        self.valueListeners = []
+        self.errorListeners = []
+        self.connectionListeners = []
+
+        self._stop = threading.Event()
+        self._threads = []
+
+    @classmethod
+    def from_config_file(cls, config_file_path: str = "config.json", host: str = "192.168.80.1", port: int = 5000,
+                         **ssm_kwargs) -> 'SimulatorController':
+        ''' alternative constructor; reads the config file once and builds the channel entries and a
+        SocketSenderManager set up from its `runtime_settings`. `ssm_kwargs` override SocketSenderManager arguments.'''
+        from SocketSenderManager import SocketSenderManager
+
+        with open(config_file_path, 'r') as f:
+            all_json = json.load(f)
+        channel_entries = Channel_Entries()
+        channel_entries.load_from_dict(all_json)
+        settings = read_runtime_settings(all_json)
+
+        kwargs = dict(socketTimeout=settings["socket_timeout_s"], testSocketOnInit=False, loopDelay=0.1,
+                      log=settings["enable_verbose_logging"],
+                      heartbeatPeriod=settings["heartbeat_period_ms"]/1000 if settings["heartbeat_period_ms"] > 0 else None,
+                      commandQueue=CommandQueue(max_poll=settings["max_pending_polls"],
+                                                stale_poll_s=settings["stale_poll_ms"]/1000 if settings["stale_poll_ms"] > 0 else None,
+                                                ramp_catchup=settings["ramp_catchup_policy"]),
+                      coalesceOutputs=settings["coalesce_outputs"], maxPacketEntries=settings["max_packet_entries"],
+                      pipelined=settings["pipelined_requests"], socketBufferSize=settings["socket_buffer_bytes"] or None)
+        kwargs.update(ssm_kwargs)
+        ssm = SocketSenderManager(host=host, port=port, q=queue.Queue(), **kwargs)
+        # the RPi creates every driver when we connect, not on each channel's first command
+        ssm.set_channel_map(channel_entries, edgeCaptureBuffer=settings["di_edge_capture_buffer"],
+                            aiAcquisitionRate=settings["ai_acquisition_rate_hz"], aiBufferSize=settings["ai_acquisition_buffer"],
+                            aiDefaultWindow=settings["ai_LPF_boxcar_length"])
+        if settings["record_session"]:
+            # every command placed through ssm is written to this file and can be re-run later with SessionReplay.py
+            ssm.recorder = SessionRecorder(file_path=f'./logs/session_{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.jsonl')
+        if settings["trace_commands"]:
+            tracer.enable()
+        return cls(ssm, channel_entries, settings)
+
+    # --- commands ---
+
+    def set_value(self, name: str, value: float, units: str | None = None) -> tuple[bool, str]:
+        ''' writes one value to an output channel, in engineering units, or in mA if `units` is "mA" '''
+        ch = self.channel_entries.getChannelEntry(name)
+        if ch is None:
+            return (False, f"Unknown signal name `{name}`")
+        if units == "mA":
+            return self.ssm.place_single_mA(ch2send=ch, mA_val=float(value), time=time.time())
+        return self.ssm.place_single_EngineeringUnits(ch2send=ch, val_in_eng_units=value, time=time.time())
+
+    def set_values_together(self, values: dict, units: str | None = None) -> tuple[bool, str]:
+        ''' writes several analog outputs at once, e.g. {"SPT 1": 120, "MAT 1": 35}, so that they change at the same moment
+        on the RPi (see SocketSenderManager.place_group_mA). Values are in engineering units, or in mA if `units` is "mA".'''
+        writes = []
+        for name, value in values.items():
+            ch = self.channel_entries.getChannelEntry(name)
+            if ch is None:
+                return (False, f"Unknown signal name `{name}`")
+            if ch.sig_type.lower() != "ao":
+                return (False, f"{name} is not an ao channel")
+            writes.append((ch, float(value) if units == "mA" else ch.EngineeringUnits_to_mA(value)))
+        return self.ssm.place_group_mA(writes, time=time.time())
+
+    def set_digital(self, name: str, state: int) -> tuple[bool, str]:
+        return self.set_value(name, int(state))
+
+    def ramp(self, name: str, start: float, stop: float, rate: float, units: str | None = None) -> tuple[bool, str]:
+        ''' ramps an analog output from `start` to `stop` at `rate` per second, in engineering units or in mA '''
+        ch = self.channel_entries.getChannelEntry(name)
+        if ch is None:
+            return (False, f"Unknown signal name `{name}`")
+        if units != "mA": # place_ramp works in mA
+            start, stop, rate = (ch.EngineeringUnits_to_mA(start), ch.EngineeringUnits_to_mA(stop),
+                                 ch.EngineeringUnitsRate_to_mARate(rate))
+        placed = self.ssm.place_ramp(ch2send=ch, start_mA=start, stop_mA=stop, stepPerSecond_mA=rate)
+        if placed is False or not placed[0]:
+            if units == "mA":
+                return (False, f"Invalid ramp command for {ch.name}. Valid range: 4 - 20 mA.")
+            return (False, f"Invalid ramp command for {ch.name}. Valid range: {ch.realUnitsLowAmount} - {ch.realUnitsHighAmount} {ch.units}")
+        return (True, "")
+
+    def cancel_ramp(self, name: str) -> int:
+        ''' removes every command for this channel that hasn't been sent yet. Returns the number removed.'''
+        ch = self.channel_entries.getChannelEntry(name)
+        if ch is None or ch.getGPIOStr() is None:
+            return 0
+        return self.ssm.clearAllEntriesWithGPIOStr(ch.getGPIOStr())
+
+    def run_relay_sequence(self, steps: list[tuple[float, str, int]], timeout_s: float | None = None) -> tuple[bool, dict | str]:
+        ''' runs a relay sequence on the RPi's own clock and waits for it to finish.
+        steps : (at_ms, name, state) of do channels, at_ms measured from the start of the sequence.
+        Returns (True, result) once every step was made without errors, where result["steps"] lists
+        [at_ms, name, state, actual switch time, lateness ms]; otherwise (False, result or an error message).'''
+        gpioSteps = []
+        for at_ms, name, state in steps:
+            ch = self.channel_entries.getChannelEntry(name)
+            if ch is None:
+                return (False, f"Unknown signal name `{name}`")
+            if ch.sig_type.lower() != "do":
+                return (False, f"{name} is not a do channel")
+            if ch.getGPIOStr() is None:
+                return (False, f"{name} is not wired to a board slot")
+            gpioSteps.append((at_ms, ch.getGPIOStr(), int(state)))
+        seqId, err = self.ssm.start_relay_sequence(gpioSteps)
+        if seqId is None:
+            return (False, f"Could not start the relay sequence: {err}")
+
+        if timeout_s is None:
+            timeout_s = max(at for at, _, _ in gpioSteps) / 1000 + self.ssm.socketTimeout + 2
+        deadline = time.time() + timeout_s
+        result = None
+        while time.time() < deadline:
+            result = self.ssm.get_relay_sequence(seqId)
+            if result is not None and result["state"] != "running":
+                break
+            time.sleep(0.1)
+        if result is None or result["state"] == "running":
+            self.ssm.cancel_relay_sequence()
+            return (False, f"The relay sequence did not finish within {timeout_s:.1f} s")
+
+        for step in result["steps"]:
+            ch = self.channel_entries.get_channelEntry_from_GPIOstr(step[1])
+            step[1] = ch.name
+            self.store.update(ch.name, step[2], t=step[3])
+        ok = result["state"] == "done" and len(result["errors"]) == 0
+        return (ok, result)
+
+    def poll_inputs(self, names) -> list[str]:
+        ''' places one read request for every named input channel. Returns the error strings of refused requests.'''
+        errors = []
+        for name in names:
+            ch = self.channel_entries.getChannelEntry(name)
+            if ch is None or ch.getGPIOStr() is None:
+                continue
+            if ch.sig_type.lower() == "ai":
+                # for ai channels the "mA" value is the number of samples the RPi averages
+                success, errString = self.ssm.place_single_mA(ch2send=ch, mA_val=self.settings["ai_LPF_boxcar_length"], time=time.time())
+            else:
+                success, errString = self.ssm.place_single_EngineeringUnits(ch2send=ch, val_in_eng_units=0, time=time.time())
+            if not success:
+                errors.append(errString)
+        return errors
+
+    def report_error(self, source: str, description: str) -> None:
+        ''' queues an error that did not come from the RPi (e.g. invalid operator input), so that it is handled like any other'''
+        self.resp_queue.put(errorEntry(source, criticalityLevel="medium", description=description))
+
+    def get_link_health(self) -> dict | None:
+        return None if self.ssm.heartbeat is None else self.ssm.heartbeat.get_health()
+
+    # --- responses ---
+
+    def process_responses(self, block_s: float = 0) -> int:
+        ''' handles every response waiting on the response queue: updates `store` and calls the listeners.
+        Waits up to `block_s` seconds for the first response. Returns the number of responses handled.'''
+        numHandled = 0
+        while True:
+            try:
+                resp = self.resp_queue.get(timeout=block_s) if (numHandled == 0 and block_s > 0) else self.resp_queue.get_nowait()
+            except queue.Empty:
+                return numHandled
+            numHandled += 1
+            if isinstance(resp, errorEntry):
+                self._handle_error(resp)
+            elif isinstance(resp, dataEntry):
+                self._handle_data(resp)
+
+    def _handle_error(self, err: errorEntry) -> None:
+        self.errors.append(err)
+        message = err.description
+        if err.source.lower()[0] == "a": # only analog signals throw errors
+            # description is in form: Loop error detected:{gpio_str}
+            parts = err.description.split(":")
+            ch = self.channel_entries.get_channelEntry_from_GPIOstr(parts[1].strip()) if len(parts) > 1 else None
+            where = "" if ch is None else f" for {ch.name} at board slot {ch.boardSlotPosition}"
+            if "Encountered unexpected exception" in err.description:
+                message = f"Encountered unexpected exception{where}"
+            elif "SPI communication error detected" in err.description:
+                # analog output transmitter: dac_res register contents is not 7 like it always should be
+                # analog input receiver: readings are completely zero, i.e. show no noise, which indicates failed SPI communication
+                message = f"{parts[0]}{where}"
+            elif "Background acquisition stalled" in err.description:
+                # ai channel sampled in the background whose cached value went stale; the reason may hold colons itself
+                stalled, _, gpio_str = err.description.rpartition(":")
+                ch = self.channel_entries.get_channelEntry_from_GPIOstr(gpio_str.strip())
+                where = "" if ch is None else f" for {ch.name} at board slot {ch.boardSlotPosition}"
+                message = f"{stalled}{where}"
+            else:
+                return
+        elif "ethernet" in err.source.lower():
+            for listener in self.connectionListeners:
+                listener(False)
+        for listener in self.errorListeners:
+            listener(message, err)
+
+    def _handle_data(self, resp: dataEntry) -> None:
+        if resp.trace_time is not None:
+            tracer.span("pickup", resp.trace_time, time.time(), args={"id": resp.trace_id})
+        for listener in self.connectionListeners:
+            listener(True)
+        ch = self.channel_entries.get_channelEntry_from_GPIOstr(resp.gpio_str)
+        if ch is None:
+            return
+        if resp.unchanged: # read, but within its deadband: the value (and what the GUI shows) stays as it is
+            self.store.touch(ch.name)
+            return
+        if resp.val == "NAK": # the RPi could not execute the command
+            value = "NAK"
+        elif ch.sig_type.lower()[0] == "a":
+            value = ch.mA_to_EngineeringUnits(resp.val)
+        elif isinstance(resp.val, dict): # a di in "frequency" mode: {"count", "freq_hz", "duty", "level"}
+            value = resp.val
+        else:
+            value = int(resp.val)
+        if resp.edge:
+            self.edges.append((ch.name, value, resp.time))
+        self.store.update(ch.name, value)
+        for listener in self.valueListeners:
+            listener(ch, value, resp.val)
+
+    # --- headless operation ---
+
+    def start(self, poll_period_s: float | None = None) -> None:
+        ''' starts background threads that handle responses as they arrive and read the `polled` channels every
+        `poll_period_s` seconds (default: poll_buffer_period_ms from the settings). Not for use with a GUI.'''
+        if len(self._threads) > 0:
+            return
+        period = poll_period_s if poll_period_s is not None else self.settings["poll_buffer_period_ms"] / 1000
+        self._threads = [threading.Thread(target=self._dispatch_loop, daemon=True),
+                         threading.Thread(target=self._poll_loop, args=(period,), daemon=True)]
+        for t in self._threads:
+            t.start()
+
+    def _dispatch_loop(self) -> None:
+        while not self._stop.is_set():
+            self.process_responses(block_s=0.5)
+
+    def _poll_loop(self, period: float) -> None:
+        while not self._stop.wait(period):
+            self.poll_inputs(list(self.polled))
+
+    def stop(self) -> None:
+        ''' stops the background threads; the SocketSenderManager keeps running '''
+        self._stop.set()
+
+    def close(self) -> None:
+        self.stop()
+        self.ssm.close() # removes any enqueued command requests
+        if self.ssm.recorder is not None:
+            self.ssm.recorder.close()
+        if tracer.enabled and self.settings["trace_commands"]:
+            tracer.export(f'./logs/trace_{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.json')
@@ -1,24 +1,27 @@
 import os
 import sys
+import errno
+import select
 import logging
 import socket
 import threading
 import time
 import queue
+import itertools
 from datetime import datetime # for creation of logging filename
 
-# libraries required to perform network ping
-import platform    # For getting the operating system name
-import subprocess  # For executing a shell command
-
 current_dir = os.path.dirname(os.path.abspath(__file__)) # Get the current file's directory
 parent_dir = os.path.dirname(current_dir) # Get the parent directory
 sys.path.append(parent_dir) # Add the parent directory to sys.path
 
-from CommandQueue import CommandQueue
-from channel_definitions import Channel_Entry # the configuration that defines which signals are connected to the Carrier board
+from CommandQueue import CommandQueue, PRIORITY_WAVEFORM
+from HeartbeatMonitor import HeartbeatMonitor
+from channel_definitions import Channel_Entry, Channel_Entries # the configuration that defines which signals are connected to the Carrier board
 from PacketBuilder import dataEntry, errorEntry, DataPacketModel
+from Transport import FramedSocket
+from Tracer import tracer, estimate_clock_offset, RPI_PID
 
+PIPE_GPIO_CHTYPES = ("do", "di") # served by the RPi's gpio lane in pipelined mode; everything else uses the SPI bus
 
 
 class SocketSenderManager:
@@ -28,29 +31,61 @@ class SocketSenderManager:
 
     def __init__(self, host:str, port:int, q: queue.Queue, socketTimeout:float=5, 
                  testSocketOnInit:bool=True, loopDelay:float=0.1,
-                 log=True):
+                 log=True, startLoop:bool=True, heartbeatPeriod:float|None=None,
+                 commandQueue:CommandQueue|None=None, coalesceOutputs:bool=False, maxPacketEntries:int|None=None,
+                 reconnectBackoff:tuple[float, float]=(0.25, 8.0), maxOutbox:int=256,
+                 pipelined:bool=False, maxInFlight:int=4, socketBufferSize:int|None=None,
+                 wakeEvent:threading.Event|None=None):
         '''
         An intermediary class that accepts signal commands from a GUI (use `place_single_dataEntry` or `place_ramp`)
         It will handle sending the commands as packets using its own instance of the CommandQueue class. Any responses
         from the Raspberry Pi will be placed on the queue whose reference is passed to the constructor.
         If using a GUI, you can periodically poll the queue to see if this class has received any new responses.
 
-        if testSocketOnInit is True, this constructor will try to ping the host.
+        if testSocketOnInit is True, this constructor will send a single heartbeat to the host (see `pingHost`).
         If the host responds, a network confirmation status message will be placed on `q`. Otherwise, will place an errorEntry.
 
         ARGS:
         host and port correspond to the RPi (192.168.80.1:5000). Any response data that this class receives from the RPi will be 
         placed on `q` and can be read by another process
-        loopDelay != 0 (seconds): defines the polling frequency for the background thread to check if any packets are waiting to
-                                be sent over the socket.  Setting this delay to zero might cause the GUI to lag or become unresponsive.
+        loopDelay != 0 (seconds): the longest the background thread will sleep before re-checking whether any packets are waiting to
+                                be sent over the socket. The thread also wakes up exactly when the next entry falls due and whenever
+                                a new entry is placed, so this only bounds the idle polling. Setting this delay to zero might cause
+                                the GUI to lag or become unresponsive.
                             Note that the an unresponsive socket will slow down the polling frequency because socketTimeout is elapsed 
                             at each attempt to make a socket connection. Recommended to decrease this value instead of loopDelay if you
                             want a more responsive loop effect.
+        startLoop: if False, no background sender thread is started. Something else must then take batches with
+                   `pop_due_batch` and hand them to `send_batch` (e.g. the shared scheduler in FleetController.py).
+        heartbeatPeriod (seconds): if not None, a HeartbeatMonitor is started as `self.heartbeat` to track the link's RTT,
+                   jitter and loss. Read its state with `self.heartbeat.get_health()`; it never blocks.
+        commandQueue: an already-configured CommandQueue (per-class bounds, stale poll age). A default one is made if None.
+        coalesceOutputs: if True, only the newest output per channel of each popped batch is sent (see
+                   CommandQueue.coalesce_outputs). The superseded commands are still echoed to `q` as acknowledged once
+                   the batch is answered, so the GUI sees every value it asked for.
+        maxPacketEntries: most entries sent in one packet. Due ramp steps and polls beyond that wait for the next packet,
+                   which keeps recovery after an outage quick and bounded. Due operator commands are never held back.
+        reconnectBackoff: (first, longest) wait in seconds between reconnect attempts once a connection has failed. The wait
+                   doubles after every failed attempt. While the link is down, due outputs are kept in an outbox that holds
+                   only the newest command per channel (at most `maxOutbox` channels) and due polls are dropped. The
+                   outbox is sent in one packet as soon as a reconnect attempt succeeds (see `get_link_state`).
+        pipelined: if True, batches go out on one connection that stays open, without waiting for the previous reply.
+                   Each batch is split by RPi lane (do/di on the gpio lane, ao/ai on the SPI lane) into packets that
+                   carry a sequence id, and the RPi answers them in whatever order they finish, so a relay toggle isn't
+                   held up behind a slow boxcar ai read. At most `maxInFlight` packets are unanswered at a time.
+                   Needs an RPi server that understands `seq` (see PacketBuilder.DataPacketModel).
+        socketBufferSize: SO_SNDBUF and SO_RCVBUF of every connection to the RPi, in bytes (None keeps the OS default).
+                   Bytes and packets sent and received are counted in `get_link_state`.
+        wakeEvent: set whenever an entry is placed. Pass one event to several instances to wake a shared scheduler
+                   (see FleetController.py); a private one is made if None.
         '''
         self.host = host
         self.port = port
         self.socketTimeout = socketTimeout
         self.loopDelay = loopDelay
+        self.coalesceOutputs = coalesceOutputs
+        self.maxPacketEntries = maxPacketEntries
+        self.socketBufferSize = socketBufferSize
 
         self.qForGUI = q # a queue of errorEntries or dataEntries; 
         # stores data that should be available to the GUI (from RPI or error messages thrown by this class or echoes of sent ramp values)
@@ -62,33 +97,178 @@ class SocketSenderManager:
             respStatus = self.pingHost()
             end = time.time()
             if not respStatus:
-                self.qForGUI.put(errorEntry(source="Ethernet Socket", criticalityLevel="high", description=f"Could not receive ping response from {self.host}", time=time.time()))
+                self.qForGUI.put(errorEntry(source="Ethernet Socket", criticalityLevel="high", description=f"Could not receive heartbeat response from {self.host}", time=time.time()))
             else:
                 self.qForGUI.put(dataEntry(chType="ao", gpio_str="status:SocketSenderManager is online", val=1, time=time.time()))
                 # send a status message to gui. We'll repurpose the errorEntry class with criticality None
-                self.qForGUI.put(errorEntry(source="Ethernet Connection", criticalityLevel=None, description=f"Host {self.host} responded to a ping.", time=time.time()))
-                self.logger.info(f"testSocketOnInit received ping response. Ping delay was {int((end - start)*1000)} ms.")     
+                self.qForGUI.put(errorEntry(source="Ethernet Connection", criticalityLevel=None, description=f"Host {self.host} responded to a heartbeat.", time=time.time()))
+                self.logger.info(f"testSocketOnInit received heartbeat response. Round trip was {int((end - start)*1000)} ms.")     
+
+        self.heartbeat = None
+        if heartbeatPeriod is not None and heartbeatPeriod > 0:
+            # a heartbeat that takes longer than the command timeout is certainly lost, and usually much sooner
+            self.heartbeat = HeartbeatMonitor(host=self.host, port=self.port, period_s=heartbeatPeriod,
+                                              timeout_s=min(heartbeatPeriod, self.socketTimeout))
+            self.heartbeat.start()
 
         self.endcqLoop = False # semaphore to tell _loopCommandQueue thread to stop
-        self.theCommandQueue = CommandQueue() # a special class to manage timestamp-organized data entries sent to the Raspberry Pi
+        if commandQueue is None:
+            # an unanswered poll is given up on once its exchange has certainly timed out (connect + receive)
+            commandQueue = CommandQueue(in_flight_timeout_s=2*self.socketTimeout + 1)
+        self.theCommandQueue = commandQueue # a special class to manage timestamp-organized data entries sent to the Raspberry Pi
         self.mutex = threading.Lock() # to ensure one-at-a time access to shared CommandQueue instance
+        # set whenever a new entry is placed so the sender loop can re-evaluate its sleep
+        self.wakeEvent = wakeEvent if wakeEvent is not None else threading.Event()
+        self.spinWindow = 0.002 # seconds. The last part of every wait is spun out because OS sleeps can overshoot by a full scheduler tick
+
+        self.outbox = dict() # (chType, gpio_str) -> newest output that fell due while the link was down
+        self.maxOutbox = maxOutbox
+        self.reconnectBackoff = reconnectBackoff
+        self.backoff = reconnectBackoff[0] # wait before the next reconnect attempt, seconds
+        self.linkDown = False
+        self.nextConnectAttempt = 0.0 # time.time() before which no connection is attempted while the link is down
+        self.linkStats = {"outputs_compacted": 0, "outputs_shed": 0, "polls_shed_offline": 0,
+                          "failed_connects": 0, "reconnects": 0,
+                          "bytes_sent": 0, "bytes_received": 0, "frames_sent": 0, "frames_received": 0, "partial_sends": 0}
+
+        self.pipelined = pipelined
+        self.maxInFlight = max(maxInFlight, 1)
+        self.pipeSock = None # the open connection (a FramedSocket) of pipelined mode, None until the first batch
+        self.pending = dict() # seq -> unanswered packet of the pipelined connection (see `_pipeline_batch`)
+        self.pendingCond = threading.Condition() # guards pipeSock and pending; notified whenever a packet is answered
+        self.seqCounter = itertools.count(1)
+        self.groupCounter = itertools.count(1) # ids of ao groups placed with `place_group_mA`
+
+        self.channelMapInfo = dict() # sent in the `c` packet's info: edge capture and pulse counters (see `set_channel_map`)
+        self.channelMap = None # list of dataEntry sent to the RPi as a `c` packet before the first batch (see `set_channel_map`)
+        self.channelMapSent = False
+        self.recorder = None # optional SessionRecorder; every placed dataEntry is handed to it (see SessionReplay.py)
+        self.dispatchListeners = [] # callables like f(entries, popTime, sendTime), called after each batch goes out on the socket
+        self.dropListeners = [] # callables like f(entries), called with placed entries that will never be sent (merged, shed or compacted)
+        self.replyListeners = [] # callables like f(rtt), called with the round-trip time (seconds) of every answered packet
+        self.theCommandQueue.dropListeners.append(self._entries_dropped)
         self.cqLoopThreadReference = threading.Thread(target=self._loopCommandQueue, daemon=True)
         # print(self.cqLoopThreadReference) # print the handle for debugging
-        self.cqLoopThreadReference.start()
+        if startLoop:
+            self.cqLoopThreadReference.start()
     
-    def pingHost(self):
+    def pingHost(self) -> bool:
         """
-        Returns True if host (str) responds to a ping request.
-        Remember that a host may not respond to a ping (ICMP) request even if the host name is valid.
-        https://stackoverflow.com/a/32684938
+        Returns True if the simulator server on `self.host` answers a single heartbeat packet within `socketTimeout`.
+        Unlike an ICMP ping, this checks that the server process itself is running, and needs no platform-specific
+        subprocess.
         """
-
-        # Option for the number of packets as a function of
-        param = '-n' if platform.system().lower()=='windows' else '-c'
-        # Building the command. Ex: "ping -c 1 google.com"
-        command = ['ping', param, '1', self.host]
-        return subprocess.call(command) == 0
+        probe = HeartbeatMonitor(host=self.host, port=self.port, timeout_s=self.socketTimeout)
+        return probe.probe_once() is not None
         
+    def set_channel_map(self, channel_entries: Channel_Entries, edgeCaptureBuffer: int = 0, aiAcquisitionRate: float = 0,
+                        aiBufferSize: int = 256, aiDefaultWindow: int = 5) -> None:
+        ''' remembers the channel map of `channel_entries`. It is sent to the RPi before the next batch, and again after
+        every reconnect, so that the RPi creates its drivers up front instead of on each channel's first command.
+        edgeCaptureBuffer: if > 0, the RPi also records every transition of its di pins (keeping this many per pin
+        between two replies). The captured transitions are placed on `q` as di entries with `edge` set, timed at the
+        edge and ahead of the reply's own entries.
+        di channels in "frequency" mode get their pulse counters started on the RPi, and ao channels get the driver of
+        their `ao_module` (see Channel_Entry).
+        aiAcquisitionRate: if > 0, the RPi samples every ai channel this many times per second into a ring buffer of
+        `aiBufferSize` samples, filters it with the channel's `ai_filter` (default: a moving average of `aiDefaultWindow`
+        samples) and answers ai reads from the latest filtered value right away.
+        Input channels with a `deadband` are reported by exception: the RPi leaves a reading out of its reply unless it
+        moved by more than the deadband or the channel's `max_silence_ms` has passed. Such a reading is placed on `q` as
+        an entry with `unchanged` set and `val` None.'''
+        self.channelMapInfo = dict()
+        if edgeCaptureBuffer > 0:
+            self.channelMapInfo["di_edge_capture"] = edgeCaptureBuffer
+        counters = channel_entries.get_counter_map()
+        if len(counters) > 0:
+            self.channelMapInfo["di_counters"] = counters
+        if aiAcquisitionRate > 0:
+            self.channelMapInfo["ai_acquisition"] = {"rate_hz": aiAcquisitionRate, "buffer": aiBufferSize,
+                                                     "channels": channel_entries.get_ai_filter_map(default_window=aiDefaultWindow)}
+        reportByException = channel_entries.get_report_by_exception_map()
+        if len(reportByException) > 0:
+            self.channelMapInfo["report_by_exception"] = reportByException
+        aoModules = channel_entries.get_ao_module_map()
+        if len(aoModules) > 0:
+            self.channelMapInfo["ao_modules"] = aoModules
+        self.channelMap = [dataEntry(chType=c["chType"], gpio_str=c["gpio_str"], val=0, time=time.time())
+                           for c in channel_entries.get_channel_map()]
+        self.channelMapSent = False
+
+    def send_channel_map(self) -> bool:
+        ''' sends `self.channelMap` in a single `c` exchange. Returns True if the RPi answered. Any channel the RPi
+        could not provision is reported on `qForGUI` as an errorEntry.'''
+        if self.channelMap is None:
+            return False
+        sock = self._new_socket()
+        sock.sock.settimeout(self.socketTimeout)
+        try:
+            sock.sock.connect((self.host, self.port))
+            DataPacketModel(dataEntries=self.channelMap, msg_type="c", error_entries=None, time=time.time(),
+                            info=self.channelMapInfo if len(self.channelMapInfo) > 0 else None).to_socket(sock)
+            reply = DataPacketModel.from_socket(sock)
+        except Exception as e:
+            if self.log: self.logger.warning(f"send_channel_map: could not send the channel map to {self.host}: {e}")
+            return False
+        finally:
+            self._close_socket(sock)
+        for err in (reply.error_entries or []):
+            self.qForGUI.put(err)
+        if self.log: self.logger.info(f"send_channel_map: {self.host} provisioned {len(self.channelMap)} channels")
+        return True
+
+    def query(self, request: dict) -> dict | None:
+        ''' sends a `q` packet carrying `request` (e.g. {"request": "timing"}) and returns the `info` dict of the RPi's
+        answer, or None if the RPi could not be reached. Queries bypass the command queue.'''
+        sock = self._new_socket()
+        sock.sock.settimeout(self.socketTimeout)
+        try:
+            sock.sock.connect((self.host, self.port))
+            DataPacketModel(dataEntries=[], msg_type="q", error_entries=None, time=time.time(), info=request).to_socket(sock)
+            reply = DataPacketModel.from_socket(sock)
+        except Exception as e:
+            if self.log: self.logger.warning(f"query: {request} to {self.host} failed: {e}")
+            return None
+        finally:
+            self._close_socket(sock)
+        return reply.info
+
+    def get_timing_report(self, reset: bool = False) -> dict | None:
+        ''' the RPi hardware thread's timing histograms, per output channel type:
+        `lateness` (actual minus intended write time, on the master's clock) and `duration` (driver call time), both in ms.
+        If `reset` is True, the RPi starts new histograms after answering.'''
+        info = self.query({"request": "timing", "reset": int(reset)})
+        if info is None:
+            return None
+        return info.get("timing")
+
+    def start_relay_sequence(self, steps: list[tuple[float, str, int]]) -> tuple[int | None, str]:
+        ''' uploads a relay sequence that the RPi runs on its own clock (see RPI_side/relay_sequencer.py).
+        steps : (at_ms, gpio_str, state) with at_ms measured from the start of the sequence.
+        Returns (sequence id, "") or (None, error message). Read the outcome with `get_relay_sequence`.'''
+        info = self.query({"request": "relay_sequence", "steps": [[float(at), gpio, int(state)] for at, gpio, state in steps]})
+        if info is None:
+            return (None, f"Could not reach {self.host}")
+        if "error" in info:
+            return (None, info["error"])
+        return (info["sequence_id"], "")
+
+    def get_relay_sequence(self, seqId: int) -> dict | None:
+        ''' progress of an uploaded relay sequence: {"state": "running" | "done" | "cancelled" | "failed" | "unknown",
+        "steps": [[at_ms, gpio_str, state, actual switch time, lateness ms], ...], "errors": [...]}, with the switch
+        times moved onto this machine's clock. None if the RPi could not be reached.'''
+        info = self.query({"request": "relay_sequence_result", "sequence_id": seqId})
+        if info is None or "sequence" not in info:
+            return None
+        result = info["sequence"]
+        offset = info.get("clock_offset_ms", 0) / 1000
+        for step in result.get("steps", []):
+            step[3] -= offset
+        return result
+
+    def cancel_relay_sequence(self) -> bool:
+        return self.query({"request": "relay_sequence_cancel"}) is not None
+
     def place_ramp(self, ch2send: Channel_Entry, start_mA:float, stop_mA:float, stepPerSecond_mA:float) -> bool:
         '''Note: all values must be in mA. Returns True if successful. False if bounding error.'''
 
@@ -114,7 +294,8 @@ class SocketSenderManager:
         refTime = time.time()
         reportErrorString = ""
         for i in range(0, len(value_entries)):
-            success, errorString = self.place_single_mA(ch2send = ch2send, mA_val = value_entries[i], time = float(refTime + timestamp_offsets[i]))
+            success, errorString = self.place_single_mA(ch2send = ch2send, mA_val = value_entries[i], time = float(refTime + timestamp_offsets[i]),
+                                                        priority = PRIORITY_WAVEFORM)
             if not success and reportErrorString == "": # only retain a single error message from the entire place_ramp command
                 reportErrorString = errorString
 
@@ -123,10 +304,12 @@ class SocketSenderManager:
         else:
             return (False, reportErrorString)
 
-    def place_single_EngineeringUnits(self, ch2send : Channel_Entry, val_in_eng_units : float, time : float) -> tuple[bool, str]:
+    def place_single_EngineeringUnits(self, ch2send : Channel_Entry, val_in_eng_units : float, time : float,
+                                      priority : int | None = None) -> tuple[bool, str]:
         ''' use this method to put commands that are not raw mA values. Conversion from engineering units to mA values 
         will happen within this method's call to Channel_Entry.convert_to_packetUnits()
         returns true iff the place request was successful. False if value out of bounds.
+        priority: one of the CommandQueue.PRIORITY_* classes. None lets the queue decide (reads are polls, writes are operator commands)
         '''
 
         if ch2send.sig_type.lower() == "ao" and not ch2send.isValidEngineeringUnits(val_in_eng_units):
@@ -135,12 +318,11 @@ class SocketSenderManager:
             return (False, f"The boardSlotPosition ({ch2send.boardSlotPosition}) for {ch2send.name} is invalid.")
     
         de = dataEntry(chType=ch2send.sig_type, gpio_str=ch2send.getGPIOStr(), val=ch2send.convert_to_packetUnits(val_in_eng_units), time=time)
-        with self.mutex:
-            self.theCommandQueue.put(de)
+        self.place_single_dataEntry(de, priority=priority)
         if self.log: self.logger.info(f"place_single_EngineeringUnits: {de}")
         return (True, "")
     
-    def place_single_mA(self, ch2send : Channel_Entry, mA_val : float, time : float) -> tuple[bool, str]:
+    def place_single_mA(self, ch2send : Channel_Entry, mA_val : float, time : float, priority : int | None = None) -> tuple[bool, str]:
         # first element of returned tuple is success status: True if no errors. Second element in
         # tuple is error string (None if no error)
         # Engineering units to mA conversion happens on the master side. RPi receives only mA values.
@@ -150,11 +332,56 @@ class SocketSenderManager:
             return (False, f"GPIO for {ch2send.name} is undefined. Check channel_definitions.py")
         
         de = dataEntry(chType=ch2send.sig_type, gpio_str=ch2send.getGPIOStr(), val=mA_val, time=time)
-        with self.mutex:
-            self.theCommandQueue.put(de)
+        self.place_single_dataEntry(de, priority=priority)
         if self.log: self.logger.info(f"place_single_mA: {de}")
         return (True, "")
 
+    def place_group_mA(self, writes: list[tuple[Channel_Entry, float]], time: float, priority: int | None = None) -> tuple[bool, str]:
+        ''' places several analog output values (in mA) that the RPi applies together: the outputs change within a few SPI
+        frames of each other instead of one packet entry at a time (see Module_Manager.write_ao_group). Channels whose
+        `ao_module` is "T_CLICK_2" are latched at the same instant. Nothing is placed unless every value is valid.'''
+        for ch2send, mA_val in writes:
+            if ch2send.sig_type.lower() != "ao":
+                return (False, f"{ch2send.name} is not an ao channel, so it cannot be part of an analog group")
+            if not ch2send.isValidmA(mA_val):
+                return (False, f"mA value requested ({mA_val} mA) for {ch2send.name} must be between 4.0 and 20.0 mA.")
+            if ch2send.getGPIOStr() is None:
+                return (False, f"GPIO for {ch2send.name} is undefined. Check channel_definitions.py")
+        group = next(self.groupCounter)
+        entries = []
+        for ch2send, mA_val in writes:
+            de = dataEntry(chType="ao", gpio_str=ch2send.getGPIOStr(), val=mA_val, time=time)
+            de.group = group
+            entries.append(de)
+        # one placement, so that the sender loop cannot pop the group half-way and split it over two packets
+        self.place_dataEntries(entries, priority=priority)
+        if self.log: self.logger.info(f"place_group_mA: {[str(de) for de in entries]}")
+        return (True, "")
+
+    def place_single_dataEntry(self, de: dataEntry, priority: int | None = None) -> None:
+        ''' places an already-built dataEntry on the command queue without any channel validation. All of the `place_*`
+        methods funnel through here, so this is also where an attached session recorder sees every command.
+        Used directly by the session replayer, whose entries were validated when they were first recorded.
+        `priority` is passed on to CommandQueue.put.
+        '''
+        self.place_dataEntries([de], priority=priority)
+
+    def place_dataEntries(self, entries: list[dataEntry], priority: int | None = None) -> None:
+        ''' like `place_single_dataEntry`, for several entries that must reach the queue at once '''
+        for de in entries:
+            if de.time is None:
+                de.time = time.time()
+            if tracer.enabled:
+                if de.trace_id is None: # a re-placed entry keeps its id
+                    de.trace_id = tracer.next_id()
+                de.trace_time = time.time()
+        with self.mutex:
+            self.theCommandQueue.put_all(entries, priority=priority)
+        if self.recorder is not None:
+            for de in entries:
+                self.recorder.record(de, placedTime=time.time())
+        self.wakeEvent.set() # the new entries might be due sooner than whatever the sender loop is waiting on
+
     def _loopCommandQueue(self) -> None:
         '''A continuous loop that should be run in a background thread. Checks to see if any data entries are (over)due
         to be sent over the socket. If so, initiates a single-use socket connection with `self.host`, sends those entries, awaits a response,
@@ -164,15 +391,11 @@ class SocketSenderManager:
         if self.log: self.logger.info("_loopCommandQueue thread has started successfully")
 
         while not self.endcqLoop:
-            with self.mutex:
-                outgoings = self.theCommandQueue.pop_all_due() # returns a list of dataEntry objects or an empty list
-                # note that we pop the due entries regardless of whether the socket is viable. But we re-place
-                # entries that are not auto-polling requests (see below)
-
-            if self.loopDelay>0: # the GUI freezes at first if this loop is run unchecked
-                time.sleep(self.loopDelay)
+            self._wait_for_due_entries()
+            outgoings = self.pop_due_batch()
+            popTime = time.time()
 
-            if len(outgoings) == 0:
+            if outgoings is None:
                 continue
         
             # echo back outgoing commands to the queue. In practice, only ramped AO signals are of interest--to show the operator that
@@ -180,57 +403,471 @@ class SocketSenderManager:
             # for el in outgoings:
                 # self.qForGUI.put(el)
 
-            dpm_out = DataPacketModel(dataEntries = outgoings, msg_type = "d", error_entries = None, time = time.time())
+            self.send_batch(outgoings, popTime)
+        if self.log: self.logger.info("_loopCommandQueue has shut down after having received semaphore")
+
+    def pop_due_batch(self) -> list[dataEntry] | None:
+        ''' pops the entries that are due now (at most `maxPacketEntries`) for one call of `send_batch`. Returns None
+        if there is nothing to send; an empty list means only the outbox is due for a reconnect attempt.
+        Note that the due entries are popped regardless of whether the socket is viable. But entries that are not
+        auto-polling requests are re-placed if the batch can't be sent (see `send_batch`).'''
+        with self.mutex:
+            outgoings = self.theCommandQueue.pop_all_due(max_entries=self.maxPacketEntries)
+        if len(outgoings) == 0 and not self._outbox_flush_due():
+            return None
+        return outgoings
+
+    def next_due_time(self) -> float | None:
+        ''' time.time() at which the next call of `pop_due_batch` will have something to send, or None if nothing is
+        scheduled '''
+        with self.mutex:
+            nextDue = self.theCommandQueue.peek_next_time()
+            if len(self.outbox) > 0 and (nextDue is None or self.nextConnectAttempt < nextDue):
+                nextDue = self.nextConnectAttempt # the outbox is flushed by the next reconnect attempt
+        return nextDue
+
+    def send_batch(self, outgoings: list[dataEntry], popTime: float) -> bool:
+        ''' sends one batch of popped entries over a single-use socket connection, waits for the response and places
+        the response entries on `self.qForGUI`. Returns True if the batch went out and (unless `pipelined`) was
+        answered. The round-trip time of every answer is handed to `replyListeners`.
+        Output entries of a batch that could not be sent are re-placed on the command queue.
+        Called by `_loopCommandQueue`, or by an external scheduler (see FleetController.py) when `startLoop` is False.
+        However the exchange ends, the batch's polls stop counting as in flight, so their channels can be polled again.
+        While the link is down, nothing is sent until the next reconnect attempt is due; see `reconnectBackoff`.
+        In `pipelined` mode this returns as soon as the batch is sent; its replies are handled by the pipe's
+        reader thread.
+        '''
+        resolveNow = outgoings
+        try:
+            if self.linkDown:
+                if time.time() < self.nextConnectAttempt:
+                    self._hold_offline(outgoings)
+                    return False
+                outgoings = self._take_outbox(outgoings) # this attempt carries everything that is still wanted
+            if self.channelMap is not None and not self.channelMapSent and not self.linkDown:
+                self.channelMapSent = self.send_channel_map()
+            if self.pipelined:
+                sent = self._pipeline_batch(outgoings, popTime)
+                if sent:
+                    resolveNow = [] # resolved as their replies arrive (or when the connection is lost)
+                return sent
+            return self._exchange_batch(outgoings, popTime) is not None
+        finally:
+            with self.mutex:
+                self.theCommandQueue.resolve_in_flight(resolveNow)
+
+    def _exchange_batch(self, outgoings: list[dataEntry], popTime: float) -> float | None:
+        popped = outgoings # dispatch listeners hear about every popped entry, superseded or not
+        superseded = []
+        if self.coalesceOutputs:
+            with self.mutex:
+                outgoings, superseded = self.theCommandQueue.coalesce_outputs(outgoings)
+        traced = tracer.enabled
+        if traced:
+            packetId = tracer.next_id()
+            traceIds = [de.trace_id for de in outgoings]
+            for de in popped:
+                if de.trace_time is not None:
+                    tracer.span("queue wait", de.trace_time, popTime, args={"id": de.trace_id, "packet": packetId})
+            encodeStart = time.time()
+        dpm_out = DataPacketModel(dataEntries = outgoings, msg_type = "d", error_entries = None, time = time.time(),
+                                  info = self._packet_info(outgoings, packetId if traced else None))
+        payload = dpm_out.get_payload_bytes()
+
+        startRTT = time.time()
+        if traced:
+            tracer.span("encode", encodeStart, startRTT, args={"packet": packetId, "ids": traceIds})
+
+        # create a single-use socket
+        sock = self._new_socket()
+        self.sock = sock # keep a reference so that `close` can abort a transfer in progress
+        # a reconnect attempt only needs to find out whether the RPi is back, so it gives up sooner
+        connectTimeout = self.socketTimeout if not self.linkDown else min(self.socketTimeout, 1.0)
+        
+        try:
+            self._connect(sock.sock, connectTimeout)
+        except Exception as e:
+            sock.close()
+            self._connect_failed(outgoings, connectTimeout, e)
+            return None
+        if self.linkDown:
+            self._link_restored()
+        
+        # print(f"packet sent is {dpm_out.get_packet_as_string()}")
+        try:
+            connectTime = time.time()
+            sock.send_frame("d", payload)
+            sendTime = time.time()
+            for listener in self.dispatchListeners:
+                listener(popped, popTime, sendTime)
+            dpm_catch = DataPacketModel.from_socket(sock)
+        except Exception as e:
+            self.qForGUI.put(errorEntry(source="Ethernet Client Socket", criticalityLevel="high", description=f"{e}", time=time.time()))
+            self._close_socket(sock)
+            return None
+
+        self._close_socket(sock)
+        replyTime = time.time()
+        rtt = replyTime - startRTT
+        if traced:
+            self._trace_exchange(dpm_catch, packetId, traceIds, startRTT, connectTime, sendTime, replyTime)
+        self._deliver_reply(dpm_catch, superseded, rtt)
+        return rtt
+
+    @staticmethod
+    def _packet_info(entries: list[dataEntry], packetId: int | None) -> dict | None:
+        ''' the `info` of a `d` packet: the trace request (if `packetId` is not None) and the ao groups among `entries` '''
+        info = dict()
+        if packetId is not None:
+            info["trace"] = packetId
+        groups = dict() # group id -> indices of its entries in this packet
+        for i, de in enumerate(entries):
+            if de.group is not None:
+                groups.setdefault(de.group, []).append(i)
+        if len(groups) > 0:
+            info["ao_groups"] = list(groups.values())
+        return info if len(info) > 0 else None
+
+    def _deliver_reply(self, dpm_catch: DataPacketModel, superseded: list[dataEntry], rtt: float) -> None:
+        ''' places the answer to one packet on `self.qForGUI` '''
+        # sometimes returns None, in which case 0 errors
+        if dpm_catch.error_entries is None:
+            numErrors = 0
+        else:
+            numErrors = len(dpm_catch.error_entries)
+        
+        if dpm_catch.data_entries is None:
+            dpm_catch.data_entries = []
 
-            startRTT = time.time()
+        if self.log: self.logger.info(f"_loopCommandQueue: received response from {self.host} in {rtt:.2f} s containing {len(dpm_catch.data_entries)} entries and {numErrors} errors.")
+        for listener in self.replyListeners:
+            listener(rtt)
+        
+        # commands that were dropped in favour of a newer value for the same channel are acknowledged first,
+        # so that the real answer for that channel is the last one the GUI sees
+        for de in superseded:
+            self.qForGUI.put(dataEntry(chType=de.chType, gpio_str=de.gpio_str, val=de.val, time=time.time()))
+
+        # di transitions that happened since the previous reply come before the state polled just now
+        if dpm_catch.info is not None:
+            for d in dpm_catch.info.get("edges", []):
+                de = dataEntry.from_dict(d)
+                de.edge = True
+                self.qForGUI.put(de)
+
+        # place the received entries onto the shared queue to be read by the gui
+        for de in dpm_catch.data_entries:
+            self.qForGUI.put(de) # queues are thread-safe
+        # readings that the RPi left out because they stayed within their deadband (report by exception)
+        if dpm_catch.info is not None:
+            for chType, gpio_str in dpm_catch.info.get("unchanged", []):
+                de = dataEntry(chType=chType, gpio_str=gpio_str, val=None, time=time.time())
+                de.unchanged = True
+                self.qForGUI.put(de)
+        for i in range(0, numErrors):
+            self.qForGUI.put(dpm_catch.error_entries[i]) 
+
+    def _pipeline_batch(self, outgoings: list[dataEntry], popTime: float) -> bool:
+        ''' sends one batch on the pipelined connection (opening it if needed) without waiting for the reply. The
+        batch goes out as one packet per RPi lane, each registered in `self.pending` under its own sequence id.
+        Returns False if no connection could be made or a packet could not be sent, in which case the unsent packets
+        were handled like a failed exchange.'''
+        connectTimeout = self.socketTimeout if not self.linkDown else min(self.socketTimeout, 1.0)
+        try:
+            sock = self._get_pipe(connectTimeout)
+        except Exception as e:
+            self._connect_failed(outgoings, connectTimeout, e)
+            return False
+        if self.linkDown:
+            self._link_restored()
 
-            # create a single-use socket
-            self.sock = socket.socket()
-            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # tell TCP to send out data as soon as it arrives in its buffer
-            self.sock.settimeout(self.socketTimeout)
-            
+        popped = outgoings
+        superseded = []
+        if self.coalesceOutputs:
+            with self.mutex:
+                outgoings, superseded = self.theCommandQueue.coalesce_outputs(outgoings)
+        traced = tracer.enabled
+        if traced:
+            for de in popped:
+                if de.trace_time is not None:
+                    tracer.span("queue wait", de.trace_time, popTime, args={"id": de.trace_id})
+
+        # the gpio lane goes first: its packet is the quick one
+        lanes = {"gpio": ([], []), "spi": ([], [])}
+        for de in outgoings:
+            lanes["gpio" if de.chType in PIPE_GPIO_CHTYPES else "spi"][0].append(de)
+        for de in superseded: # acknowledged just before the answer of the packet that holds their channel's newer value
+            lanes["gpio" if de.chType in PIPE_GPIO_CHTYPES else "spi"][1].append(de)
+
+        sendTime = time.time()
+        sent = True
+        laneList = list(lanes.values())
+        for i, (entries, laneSuperseded) in enumerate(laneList):
+            if len(entries) == 0:
+                continue # (a superseded command always shares its lane with the newer one)
+            with self.pendingCond:
+                # keep at most maxInFlight packets unanswered; a lost connection wakes this up too
+                while len(self.pending) >= self.maxInFlight and self.pipeSock is sock:
+                    self.pendingCond.wait(self.socketTimeout)
+                seq = next(self.seqCounter)
+                record = {"sock": sock, "entries": entries, "superseded": laneSuperseded, "sendStart": time.time(),
+                          "packetId": tracer.next_id() if traced else None,
+                          "traceIds": [de.trace_id for de in entries] if traced else None}
+                self.pending[seq] = record
+            dpm_out = DataPacketModel(dataEntries = entries, msg_type = "d", error_entries = None, time = time.time(),
+                                      info = self._packet_info(entries, record["packetId"]), seq = seq)
             try:
-                self.sock.connect((self.host, self.port))
+                dpm_out.to_socket(sock)
             except Exception as e:
-                self.qForGUI.put(errorEntry(source="Ethernet Client Socket", criticalityLevel="high", description=f"Attempted socket connection with {self.host} failed within timeout={self.socketTimeout} s. Error message: {e}", time=time.time()))
-                if self.log: self.logger.critical(f"_loopCommandQueue Could not establish a socket connection with host within timeout={self.socketTimeout} seconds. Debug str is {e}")
-                # re-place requests that failed to send back on the queue, unless they're auto-poll requests
-                for el in outgoings:
-                    if isinstance(el, dataEntry) and el.chType.lower()[1]=="o":
-                        # then it's probably a user-requested output signal. Re-place the element
-                        # back on the queue to be treated when the socket comes online again
-                        # this behavior is needed to reactivate the do toggle switch on the UI
-                        self.theCommandQueue.put(el)
-                continue
-            
-            # print(f"packet sent is {dpm_out.get_packet_as_string()}")
-            self.sock.send(dpm_out.get_packet_as_string().encode())
+                self._close_pipe(sock, e) # also takes care of this packet's entries
+                # the lanes that were never sent are held like a failed exchange, and their polls are freed
+                unsent = [de for laterEntries, laterSuperseded in laneList[i+1:] for de in laterEntries + laterSuperseded]
+                self._hold_offline(unsent)
+                with self.mutex:
+                    self.theCommandQueue.resolve_in_flight(unsent)
+                sent = False
+                break
+            sendTime = record["sendTime"] = time.time()
+        for listener in self.dispatchListeners:
+            listener(popped, popTime, sendTime)
+        return sent
+
+    def _get_pipe(self, connectTimeout: float) -> FramedSocket:
+        ''' the open pipelined connection, connecting (and starting its reader thread) if there is none '''
+        with self.pendingCond:
+            if self.pipeSock is not None:
+                return self.pipeSock
+        sock = self._new_socket()
+        try:
+            self._connect(sock.sock, connectTimeout)
+        except Exception:
+            sock.close()
+            raise
+        with self.pendingCond:
+            self.pipeSock = sock
+        threading.Thread(target=self._read_pipe, args=(sock,), daemon=True).start()
+        if self.log: self.logger.info(f"_get_pipe: opened a pipelined connection with {self.host}")
+        return sock
+
+    def _read_pipe(self, sock: FramedSocket) -> None:
+        ''' reader thread of one pipelined connection: hands every reply to the packet it answers (matched by seq)
+        until the connection closes, fails, or leaves a packet unanswered for longer than `socketTimeout` '''
+        while True:
+            with self.pendingCond:
+                if self.pipeSock is not sock:
+                    return
+                oldest = min((r["sendStart"] for r in self.pending.values() if r["sock"] is sock), default=None)
             try:
-                dpm_catch = DataPacketModel.from_socket(self.sock)
+                readable, _, _ = select.select([sock], [], [], min(self.socketTimeout, 0.5))
+                if len(readable) == 0:
+                    if oldest is not None and time.time() - oldest > self.socketTimeout:
+                        raise TimeoutError(f"no reply within timeout={self.socketTimeout} s")
+                    continue
+                dpm_catch = DataPacketModel.from_socket(sock)
             except Exception as e:
-                self.qForGUI.put(errorEntry(source="Ethernet Client Socket", criticalityLevel="high", description=f"{e}", time=time.time()))
-                self.sock.close()
+                self._close_pipe(sock, e)
+                return
+            replyTime = time.time()
+
+            with self.pendingCond:
+                record = self.pending.pop(dpm_catch.seq, None)
+                self.pendingCond.notify_all()
+            if record is None:
+                if self.log: self.logger.warning(f"_read_pipe: dropped a reply to unknown request seq={dpm_catch.seq}")
+                continue
+            rtt = replyTime - record["sendStart"]
+            if record["packetId"] is not None:
+                sendTime = record.get("sendTime", replyTime)
+                self._trace_exchange(dpm_catch, record["packetId"], record["traceIds"], record["sendStart"],
+                                     record["sendStart"], sendTime, replyTime)
+            self._deliver_reply(dpm_catch, record["superseded"], rtt)
+            with self.mutex:
+                self.theCommandQueue.resolve_in_flight(record["entries"])
+
+    def _close_pipe(self, sock: FramedSocket, err: Exception | None) -> None:
+        ''' closes a pipelined connection. Its unanswered packets are treated like a failed exchange: outputs go to
+        the outbox (a write may be repeated once the link is back, never lost) and polls are dropped '''
+        with self.pendingCond:
+            if self.pipeSock is sock:
+                self.pipeSock = None
+            lost = [seq for seq, r in self.pending.items() if r["sock"] is sock]
+            records = [self.pending.pop(seq) for seq in lost]
+            self.pendingCond.notify_all()
+        self._close_socket(sock)
+        if self.endcqLoop:
+            return
+        self.channelMapSent = False # the RPi may have restarted
+        if self.log: self.logger.warning(f"_close_pipe: pipelined connection with {self.host} closed with {len(records)} packets unanswered: {err}")
+        if len(records) == 0:
+            return # e.g. an idle connection that the RPi dropped; the next batch reconnects
+        self.qForGUI.put(errorEntry(source="Ethernet Client Socket", criticalityLevel="high", description=f"Connection with {self.host} lost with {len(records)} requests unanswered: {err}", time=time.time()))
+        for r in records:
+            self._hold_offline(r["entries"])
+            with self.mutex:
+                self.theCommandQueue.resolve_in_flight(r["entries"])
+        self._link_failed()
+
+    def _trace_exchange(self, dpm_catch: DataPacketModel, packetId: int, traceIds: list, startRTT: float,
+                        connectTime: float, sendTime: float, replyTime: float) -> None:
+        ''' records the socket stages of one traced packet, merges the RPi's spans for it (moved onto this clock) and
+        tags the response entries so that the GUI can record when it picks them up '''
+        args = {"packet": packetId, "ids": traceIds}
+        tracer.span("connect", startRTT, connectTime, args=args)
+        tracer.span("send", connectTime, sendTime, args=args)
+        tracer.span("await reply", sendTime, replyTime, args=args)
+        info = dpm_catch.info if dpm_catch.info is not None else {}
+        if "trace" in info and "trace_clock" in info:
+            remoteReceive, remoteSend = info["trace_clock"]
+            offset = estimate_clock_offset(connectTime, remoteReceive, remoteSend, replyTime)
+            tracer.add_remote_spans(info["trace"], clock_offset=offset, ids=traceIds, packet_id=packetId, pid=RPI_PID)
+            # reply encode and send spans of earlier traced packets (see PacketBuilder.DataPacketModel)
+            for latePacketId, *span in info.get("trace_late", []):
+                tracer.add_remote_spans([span], clock_offset=offset, ids=[], packet_id=latePacketId, pid=RPI_PID)
+        # the RPi answers every entry with exactly one response, in packet order (unless it left unchanged readings out)
+        if dpm_catch.data_entries is not None and len(dpm_catch.data_entries) == len(traceIds):
+            for de, traceId in zip(dpm_catch.data_entries, traceIds):
+                de.trace_id = traceId
+                de.trace_time = replyTime
+
+    def _new_socket(self) -> FramedSocket:
+        sock = socket.socket()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # tell TCP to send out data as soon as it arrives in its buffer
+        # buffer sizes are set before connecting so that the receive window is negotiated with them
+        return FramedSocket(sock, sendBufferSize=self.socketBufferSize, recvBufferSize=self.socketBufferSize)
+
+    def _close_socket(self, sock: FramedSocket) -> None:
+        ''' closes a connection and adds its byte and packet counts to `linkStats` '''
+        try:
+            sock.close()
+        except OSError:
+            pass
+        with self.mutex:
+            for key, value in sock.stats().items():
+                self.linkStats[key] += value
+
+    def _connect(self, sock: socket.socket, timeout: float) -> None:
+        ''' connects `sock` to the RPi without blocking for longer than `timeout`, then leaves it in timeout mode
+        (`socketTimeout`) for the exchange. Raises OSError (or TimeoutError) if the connection can't be made.'''
+        sock.setblocking(False)
+        err = sock.connect_ex((self.host, self.port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, 10035): # 10035 is WSAEWOULDBLOCK
+            raise OSError(err, os.strerror(err))
+        if err != 0:
+            _, writable, failed = select.select([], [sock], [sock], timeout) # Windows reports a refused connect as failed
+            if len(writable) == 0 and len(failed) == 0:
+                raise TimeoutError(f"timed out after {timeout} s")
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                raise OSError(err, os.strerror(err))
+        sock.settimeout(self.socketTimeout)
+
+    def _connect_failed(self, outgoings: list[dataEntry], connectTimeout: float, e: Exception) -> None:
+        self.channelMapSent = False # the RPi may have restarted by the time it is reachable again
+        self.qForGUI.put(errorEntry(source="Ethernet Client Socket", criticalityLevel="high", description=f"Attempted socket connection with {self.host} failed within timeout={connectTimeout} s. Error message: {e}", time=time.time()))
+        if self.log: self.logger.critical(f"_loopCommandQueue Could not establish a socket connection with host within timeout={connectTimeout} seconds. Debug str is {e}")
+        # keep the newest output per channel for when the socket comes online again; this is also what
+        # reactivates the do toggle switch on the UI. Polls are dropped: a fresh one will be placed by then
+        self._hold_offline(outgoings)
+        self._link_failed()
+
+    def _hold_offline(self, entries: list[dataEntry]) -> None:
+        ''' keeps the newest output of every channel in the outbox and drops polls '''
+        with self.mutex:
+            self._compact_into_outbox(entries)
+
+    def _compact_into_outbox(self, entries: list[dataEntry]) -> None:
+        # the caller holds self.mutex
+        dropped = []
+        for de in entries:
+            if de.chType.lower()[1] != "o":
+                self.linkStats["polls_shed_offline"] += 1
+                dropped.append(de)
                 continue
+            key = (de.chType, de.gpio_str)
+            held = self.outbox.get(key)
+            if held is not None:
+                if held is de:
+                    continue # already held (e.g. re-offered from a batch that took the outbox)
+                self.linkStats["outputs_compacted"] += 1
+                if held.time > de.time:
+                    dropped.append(de)
+                    continue
+                dropped.append(held)
+            elif len(self.outbox) >= self.maxOutbox:
+                self.linkStats["outputs_shed"] += 1
+                dropped.append(de)
+                continue
+            self.outbox[key] = de
+        self._entries_dropped(dropped)
 
-            self.sock.close()
-            
-            # sometimes returns None, in which case 0 errors
-            if dpm_catch.error_entries is None:
-                numErrors = 0
-            else:
-                numErrors = len(dpm_catch.error_entries)
-            
-            if dpm_catch.data_entries is None:
-                dpm_catch.data_entries = []
-
-            if self.log: self.logger.info(f"_loopCommandQueue: received response from socket in {time.time() - startRTT:.2f} s containing {len(dpm_catch.data_entries)} entries and {numErrors} errors.")
-            
-            # place the received entries onto the shared queue to be read by the gui
-            for de in dpm_catch.data_entries:
-                self.qForGUI.put(de) # queues are thread-safe
-            for i in range(0, numErrors):
-                self.qForGUI.put(dpm_catch.error_entries[i]) 
-        if self.log: self.logger.info("_loopCommandQueue has shut down after having received semaphore")
+    def _entries_dropped(self, entries: list[dataEntry]) -> None:
+        if len(entries) == 0:
+            return
+        for listener in self.dropListeners:
+            listener(entries)
+
+    def _take_outbox(self, outgoings: list[dataEntry]) -> list[dataEntry]:
+        ''' empties the outbox into one batch together with `outgoings`, still keeping only the newest output per channel '''
+        with self.mutex:
+            self._compact_into_outbox([de for de in outgoings if de.chType.lower()[1] == "o"])
+            held = sorted(self.outbox.values(), key=lambda de: de.time)
+            self.outbox = dict()
+        return held + [de for de in outgoings if de.chType.lower()[1] != "o"]
+
+    def _outbox_flush_due(self) -> bool:
+        return len(self.outbox) > 0 and time.time() >= self.nextConnectAttempt
+
+    def _link_failed(self) -> None:
+        now = time.time()
+        with self.mutex:
+            self.linkStats["failed_connects"] += 1
+            if self.linkDown:
+                self.backoff = min(self.backoff * 2, self.reconnectBackoff[1])
+            self.linkDown = True
+            self.nextConnectAttempt = now + self.backoff
+
+    def _link_restored(self) -> None:
+        with self.mutex:
+            self.linkStats["reconnects"] += 1
+            self.linkDown = False
+            self.backoff = self.reconnectBackoff[0]
+        if self.log: self.logger.info(f"_exchange_batch: reconnected to {self.host}")
+
+    def get_link_state(self) -> dict:
+        ''' whether the command link is down, when the next reconnect attempt is due, what the outbox holds and
+        how many entries were compacted or dropped while the link was down, and the traffic of every connection so far '''
+        pipe = self.pipeSock
+        with self.mutex:
+            state = {"link_down": self.linkDown,
+                     "next_attempt_in_s": max(self.nextConnectAttempt - time.time(), 0) if self.linkDown else 0,
+                     "backoff_s": self.backoff,
+                     "outbox_size": len(self.outbox),
+                     **self.linkStats}
+        if pipe is not None: # still open, so not yet in linkStats
+            for key, value in pipe.stats().items():
+                state[key] += value
+        return state
+
+    def _wait_for_due_entries(self) -> None:
+        ''' blocks until the soonest entry on the command queue is due, a new entry is placed, or `loopDelay` elapses
+        (whichever comes first). Event.wait and time.sleep can oversleep by a whole scheduler tick (~15 ms on Windows),
+        so the final `spinWindow` seconds before a due time are spun out instead of slept.
+        '''
+        nextDue = self.next_due_time()
+        waitFor = self.loopDelay
+        if nextDue is not None:
+            waitFor = min(waitFor, nextDue - time.time())
+        if waitFor <= 0:
+            return
+
+        if waitFor > self.spinWindow:
+            self.wakeEvent.wait(waitFor - self.spinWindow)
+        if self.wakeEvent.is_set():
+            self.wakeEvent.clear() # a new entry arrived; let the caller re-check the queue right away
+            return
+        if nextDue is not None:
+            while time.time() < nextDue and not self.wakeEvent.is_set():
+                pass
 
     def _arange(self, start, stop, step):
         ''' functional clone of numpy's arange function. Defined here so that we can remove the numpy dependency'''
@@ -265,6 +902,9 @@ class SocketSenderManager:
     
     def close(self) -> None:
         self.endcqLoop = True
+        self.wakeEvent.set() # don't let the sender loop sleep through the shutdown request
+        if self.heartbeat is not None:
+            self.heartbeat.close()
         self.cqLoopThreadReference.die = True
         # don't need to call cqLoopThreadReference.join() because we don't want main gui thread to hang while the thread closes
         # and the Threading class will automatically do thread cleanup
@@ -273,4 +913,6 @@ class SocketSenderManager:
             self.sock.close()
         except:
             pass
+        if self.pipeSock is not None:
+            self._close_pipe(self.pipeSock, None)
         if self.log: self.logger.info("SocketSenderManager has closed successfully")
@@ -32,7 +32,9 @@ class Channel_Entry:
 
     def __init__(self, name : str, boardSlotPosition : int, sig_type : str, units : str | None,
                  realUnitsLowAmount : str | None, realUnitsHighAmount : str | None, showOnGUI:bool=True, 
-                 offset_calib_constant:float|None=None, slope_calib_constant:float|None=None):
+                 offset_calib_constant:float|None=None, slope_calib_constant:float|None=None,
+                 di_mode:str="level", gate_time_ms:float=1000, ao_module:str="T_CLICK_1", ai_filter:dict|None=None,
+                 deadband:float|None=None, max_silence_ms:float=5000):
         '''  
         Args:
             name (str): like "AOP 1", "IVT 3", etc. What the operator will call to send a command
@@ -47,6 +49,18 @@ class Channel_Entry:
             units (str|None): Engineering units for the channel (e.g. PSI, Amps, Fahrenheit, etc.)
             realUnitsLowAmount (float|None): realUnitsLowAmount: lower bound of the signal's magnitude in engineering units (Amps, PSI, etc.)
             realUnitsHighAmount (float|None) : upper bound
+            di_mode (str): for a di channel, "level" (each reading is 0 or 1) or "frequency" (the RPi counts pulses in the
+                background and each reading is a dict {"count", "freq_hz", "duty", "level"} for the last gate)
+            gate_time_ms (float): the counting window of the "frequency" mode
+            ao_module (str): for an ao channel, the transmitter board in its slot: "T_CLICK_1" or "T_CLICK_2". Several
+                T_CLICK_2 outputs written as a group change at the same moment (see SocketSenderManager.place_group_mA)
+            ai_filter (dict|None): for an ai channel, the filter the RPi runs over its background samples when
+                "ai_acquisition_rate_hz" is set, e.g. {"type": "median", "window": 9, "decimation": 2} (see
+                RPI_side/acquisition.py). None is a moving average over "ai_LPF_boxcar_length" samples
+            deadband (float|None): for an input channel, report by exception: the RPi only sends a reading back when it
+                moved by more than this (engineering units for ai, Hz for a di in "frequency" mode; a di level is sent
+                whenever it changes, so use 0) since the last value sent. None sends every reading
+            max_silence_ms (float): with a deadband, a reading is sent anyway once this long has passed without one
         '''
         self.name = name
         self.boardSlotPosition = boardSlotPosition
@@ -55,6 +69,12 @@ class Channel_Entry:
         self.realUnitsLowAmount = realUnitsLowAmount
         self.realUnitsHighAmount = realUnitsHighAmount
         self.showOnGUI = showOnGUI
+        self.di_mode = di_mode
+        self.gate_time_ms = gate_time_ms
+        self.ao_module = ao_module
+        self.ai_filter = ai_filter
+        self.deadband = deadband
+        self.max_silence_ms = max_silence_ms
 
         self.gpio = self._slot2gpio.get(boardSlotPosition)
     
@@ -144,12 +164,58 @@ class Channel_Entries:
     
     def getChannelEntry(self, sigName:str) -> Channel_Entry:
         return self.channels.get(sigName)
+
+    def get_channel_map(self) -> list[dict]:
+        ''' every channel that has a valid board slot, as {"chType": ..., "gpio_str": ...}. Sent to the RPi so that it can
+        create all of its drivers before the first command arrives (see SocketSenderManager.set_channel_map)'''
+        channel_map = []
+        for ch in self.channels.values():
+            if ch.getGPIOStr() is None:
+                continue
+            channel_map.append({"chType": ch.sig_type.lower(), "gpio_str": ch.getGPIOStr()})
+        return channel_map
+
+    def get_counter_map(self) -> dict:
+        ''' {gpio_str: gate time in ms} of every di channel in "frequency" mode. Sent to the RPi with the channel map
+        so that it starts their pulse counters'''
+        return {ch.getGPIOStr(): ch.gate_time_ms for ch in self.channels.values()
+                if ch.sig_type.lower() == "di" and ch.di_mode == "frequency" and ch.getGPIOStr() is not None}
+
+    def get_ai_filter_map(self, default_window: int = 5) -> dict:
+        ''' {gpio_str: filter config} of every ai channel, for the RPi's background acquisition. Channels without an
+        `ai_filter` get a moving average over `default_window` samples'''
+        return {ch.getGPIOStr(): ch.ai_filter if ch.ai_filter is not None else {"type": "moving_average", "window": default_window}
+                for ch in self.channels.values() if ch.sig_type.lower() == "ai" and ch.getGPIOStr() is not None}
+
+    def get_report_by_exception_map(self) -> dict:
+        ''' {gpio_str: {"deadband", "max_silence_ms"}} of every input channel that has a deadband, for the RPi. ai
+        deadbands are converted to mA, the unit of the readings'''
+        rbe = dict()
+        for ch in self.channels.values():
+            if ch.deadband is None or ch.sig_type.lower() not in ("ai", "di") or ch.getGPIOStr() is None:
+                continue
+            deadband = ch.deadband
+            if ch.sig_type.lower() == "ai":
+                deadband = abs(ch.EngineeringUnitsRate_to_mARate(deadband)) # a span, so no 4 mA offset
+            rbe[ch.getGPIOStr()] = {"deadband": deadband, "max_silence_ms": ch.max_silence_ms}
+        return rbe
+
+    def get_ao_module_map(self) -> dict:
+        ''' {gpio_str: module name} of every ao channel that is not a T_CLICK_1. Sent to the RPi with the channel map
+        so that it creates the right driver'''
+        return {ch.getGPIOStr(): ch.ao_module for ch in self.channels.values()
+                if ch.sig_type.lower() == "ao" and ch.ao_module != "T_CLICK_1" and ch.getGPIOStr() is not None}
     
     def load_from_config_file(self, config_file_path: str) -> None:
         ''' reads a json config file. Reads the channel contents from the config file and adds channel entries to this instance
         '''
         with open(config_file_path, 'r') as f:
             all_json = json.load(f)
+        self.load_from_dict(all_json)
+
+    def load_from_dict(self, all_json: dict) -> None:
+        ''' adds a channel entry for every element of the "signals" list of an already-parsed config file, so that a
+        caller that also needs the file's other sections reads it only once '''
         chs_from_json = all_json.get("signals")
         for s in chs_from_json:
             self.add_ChannelEntry(Channel_Entry(name=s.get("name"), 
@@ -160,4 +226,10 @@ class Channel_Entries:
                                                 realUnitsHighAmount=s.get("engineeringUnitsHighAmount"),
                                                 showOnGUI=s.get("showOnGUI", False),
                                                 offset_calib_constant=s.get("offset_calib_constant"),
-                                                slope_calib_constant=s.get("slope_calib_constant")))
+                                                slope_calib_constant=s.get("slope_calib_constant"),
+                                                di_mode=s.get("di_mode", "level"),
+                                                gate_time_ms=s.get("gate_time_ms", 1000),
+                                                ao_module=s.get("ao_module", "T_CLICK_1"),
+                                                ai_filter=s.get("ai_filter"),
+                                                deadband=s.get("deadband"),
+                                                max_silence_ms=s.get("max_silence_ms", 5000)))
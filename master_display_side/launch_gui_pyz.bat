@@ -1,3 +1,7 @@
 set "SHIV_PREPEND_PYTHONPATH=%cd%"
+rem unpack the environment once into a local cache (keyed by the pyz build id) and precompile its bytecode,
+rem so later launches import straight from .pyc files instead of reading and compiling the archive's sources
+set "SHIV_ROOT=%LOCALAPPDATA%\FSE_Capstone_sim\shiv"
+set "SHIV_COMPILE_PYC=1"
 ".\zipped_env.pyz" "simulator_gui.py"
-pause
\ No newline at end of file
+pause
@@ -1,9 +1,21 @@
 # -*- coding: utf-8 -*-
+import time
+_startup_phases = [] # (phase, seconds) pairs for the startup timing report; see `mark_startup_phase`
+_phase_start = time.perf_counter()
+
+def mark_startup_phase(phase:str):
+    # closes the current startup phase. Each phase lasts from the previous mark until now
+    global _phase_start
+    now = time.perf_counter()
+    _startup_phases.append((phase, now - _phase_start))
+    _phase_start = now
+
 print("Importing libraries...", end="")
 import customtkinter as ctk
+mark_startup_phase("import customtkinter")
 from tkdial import Meter
+mark_startup_phase("import tkdial")
 import queue
-import time
 import os
 import sys
 from collections import deque
@@ -13,13 +25,12 @@ current_dir = os.path.dirname(os.path.abspath(__file__)) # Get the current file'
 parent_dir = os.path.dirname(current_dir) # Get the parent directory
 sys.path.append(parent_dir) # Add the parent directory to sys.path
 
-from PacketBuilder import dataEntry, errorEntry # this class is in the parent dir
-from channel_definitions import Channel_Entries
-from SocketSenderManager import SocketSenderManager
+from SimulatorController import SimulatorController # all of the control logic; this file is only the view
 # enable logging
 import logging
 import traceback
 from datetime import datetime
+mark_startup_phase("import simulator modules")
 
 print("done.")
 
@@ -33,36 +44,21 @@ def exception_handler(type, value, tb):
     
 print("Reading config.json...", end="")
 
-# load channel entries from config file
-my_channel_entries = Channel_Entries()
-my_channel_entries.load_from_config_file(config_file_path="config.json")
-
-# now read the `runtime_settings`
-with open("config.json", 'r') as f:
-    all_json = json.load(f)
-
-try:
-    runtime_settings = all_json.get("runtime_settings")
-    error_stack_max_len = max(runtime_settings.get("error_stack_max_len", 20), 1) # second parameter to `get` is default value if key doesn't exist
-    enable_verbose_logging = runtime_settings.get("enable_verbose_logging", True)
-    ai_LPF_boxcar_length = max(runtime_settings.get("ai_LPF_boxcar_length", 5), 1)
-    poll_buffer_period_ms = max(runtime_settings.get("poll_buffer_period_ms", 200), 1)
-    socket_timeout_s = max(runtime_settings.get("socket_timeout_s", 3), 0)
-except Exception as e:
-    logging.exception(f"Failed to parse `config.json` file because of error: {e}. Will assert default values.")
+# the controller parses config.json once, for both the channel entries and the `runtime_settings`, and
+# starts the SocketSenderManager that sends commands to the RPi
+controller = SimulatorController.from_config_file(config_file_path="config.json", host="192.168.80.1", port=5000, loopDelay=1)
+my_channel_entries = controller.channel_entries
+settings = controller.settings
+error_stack_max_len = settings["error_stack_max_len"]
+enable_verbose_logging = settings["enable_verbose_logging"]
+poll_buffer_period_ms = settings["poll_buffer_period_ms"]
+lazy_gui_build = settings["lazy_gui_build"] # show the window first, then fill in the panes one channel at a time
 
 print("done")
+mark_startup_phase("read config, start sender")
 
 print("Initializing window and background processes...")
 
-
-socketRespQueue = queue.Queue() # will contain responses from the RPi
-SSM = SocketSenderManager(host="192.168.80.1", port=5000,
-                          q=socketRespQueue, socketTimeout=socket_timeout_s, 
-                          testSocketOnInit=False, loopDelay=1, log=enable_verbose_logging)
-# # we will call this object's methods: `place_ramp`, `place_single_mA`, and `place_single_EngineeringUnits`
-# # to send commands to the RPi
-
 # Configure the main application window
 app = ctk.CTk()
 app.wm_iconbitmap('app_icon.ico')
@@ -76,7 +72,7 @@ logging.basicConfig(filename=f'./logs/instance_{datetime.now().strftime("%Y-%m-%
 app.report_callback_exception = exception_handler # this here.
 
 def shutdown():
-    SSM.close() # removes any enqueued command requests
+    controller.close() # removes any enqueued command requests
     app.destroy()
     
 app.protocol("WM_DELETE_WINDOW", shutdown)
@@ -140,13 +136,9 @@ scrollable_frame.pack(fill="both", expand=True)
 # we'll need to keep references to the meter objects so we can update the meter readings
 ai_meter_objects = dict() # key:value = "IVT":<Meter obj>
 
-currCol = 0
-currRow = 0
-numInCurrCol=0
-for name, ch_entry in my_channel_entries.channels.items():
+pane_builders = [] # one callable per channel widget group; see `build_panes`
 
-    if ch_entry.sig_type.lower() != "ai" or not ch_entry.showOnGUI:
-        continue
+def build_ai_meter(name, ch_entry, currRow, currCol):
     # UVT Gauge
     meter_frame = ctk.CTkFrame(analog_inputs_frame)
     # currRow + 1 because first row is reserved for AI frame label
@@ -161,6 +153,16 @@ for name, ch_entry in my_channel_entries.channels.items():
     l = ctk.CTkLabel(meter_frame, text=f"{name} ({ch_entry.units})")
     l.grid(row=1, column=0, pady=10, sticky="s")
     ai_meter_objects[name] = meter
+
+ai_meter_builders = [] # the meters are the slowest widgets to draw, so they are built last
+currCol = 0
+currRow = 0
+numInCurrCol=0
+for name, ch_entry in my_channel_entries.channels.items():
+
+    if ch_entry.sig_type.lower() != "ai" or not ch_entry.showOnGUI:
+        continue
+    ai_meter_builders.append(lambda n=name, c=ch_entry, r=currRow, col=currCol: build_ai_meter(n, c, r, col))
     
     numInCurrCol += 1
     currRow = (currRow + 1)%2
@@ -182,14 +184,8 @@ def toggle_dropdown(frame,parent_frame,sendBtn, arrowBtn):
 
 def cancel_ramp_callback(frame, sigName:str):
     # frame.pack_forget()
-    ch = my_channel_entries.getChannelEntry(sigName)
-    if ch.getGPIOStr() is None:
-        return
-    # print(f"SSM.theCommandQueue.len is {len(SSM.theCommandQueue)}")
-    # print(f"Entire SSM.theCommandQueue is {SSM.theCommandQueue}")
-    numRemoved = SSM.clearAllEntriesWithGPIOStr(ch.getGPIOStr())
+    numRemoved = controller.cancel_ramp(sigName)
     # print(f"removed {numRemoved} entries with sigName={sigName}")
-    # SSM.clearCommandQueue()
     
 def create_dropdown(parent, name):
     frame = ctk.CTkFrame(parent)
@@ -231,17 +227,12 @@ def place_single(name:str, entry, segmentedUnitButton):
     if enable_verbose_logging:
         print(f"[place_single] name is {name}, entry is {val}, unit is {unit}")
     
-    success = None
-    if unit == "mA":
-        success, errorString = SSM.place_single_mA(ch2send=my_channel_entries.getChannelEntry(sigName=name), mA_val=float(val), time=time.time())
-        # print(f"mA placement success: {success}")
-    else:
-        success, errorString = SSM.place_single_EngineeringUnits(ch2send=my_channel_entries.getChannelEntry(sigName=name), val_in_eng_units=float(val), time=time.time())
+    success, errorString = controller.set_value(name, val, units=unit if unit == "mA" else None)
     print(f"success for place_single is {success}")  
     if success:
         entry.delete(0, ctk.END) # clear entry contents. See https://stackoverflow.com/a/74507736    
     else:
-        socketRespQueue.put(errorEntry(f"{name} single input", criticalityLevel="medium", description=errorString))
+        controller.report_error(f"{name} single input", errorString)
     
 
 def place_ramp(name:str, startEntry, stopEntry, rateEntry, segmentedUnitButton):
@@ -252,23 +243,15 @@ def place_ramp(name:str, startEntry, stopEntry, rateEntry, segmentedUnitButton):
     except ValueError:
         return
     unit = str(segmentedUnitButton.get())
-    chEntry = my_channel_entries.getChannelEntry(sigName=name)
     # print(f"[place_ramp] name is {name}, entry is {val}, unit is {unit}")
-    if unit != "mA": # convert to mA if not already
-        startVal = chEntry.EngineeringUnits_to_mA(startVal)
-        stopVal = chEntry.EngineeringUnits_to_mA(stopVal)
-        rateVal = chEntry.EngineeringUnitsRate_to_mARate(rateVal)
-    print(f"start:{startVal}, stop:{stopVal}, rate:{rateVal}")
-    success = SSM.place_ramp(ch2send=chEntry, start_mA=startVal, stop_mA=stopVal, stepPerSecond_mA=rateVal)
+    print(f"start:{startVal}, stop:{stopVal}, rate:{rateVal} {unit}")
+    success, errorString = controller.ramp(name, startVal, stopVal, rateVal, units=unit if unit == "mA" else None)
     if success:
         startEntry.delete(0, ctk.END) # clear entry contents. See https://stackoverflow.com/a/74507736
         stopEntry.delete(0, ctk.END) # clear entry contents. See https://stackoverflow.com/a/74507736
         rateEntry.delete(0, ctk.END) # clear entry contents. See https://stackoverflow.com/a/74507736
     else:
-        if unit == "mA":
-            socketRespQueue.put(errorEntry(f"{name} ramp input", criticalityLevel="medium", description=f"Invalid ramp command for {chEntry.name}. Valid range: 4 - 20 mA."))
-        else:
-            socketRespQueue.put(errorEntry(f"{name} ramp input", criticalityLevel="medium", description=f"Invalid ramp command for {chEntry.name}. Valid range: {chEntry.realUnitsLowAmount} - {chEntry.realUnitsHighAmount} {chEntry.units}"))
+        controller.report_error(f"{name} ramp input", errorString)
         
 
 def segmented_button_callback(unit, dminLabel, dmaxLabel, drateLabel):
@@ -282,9 +265,7 @@ def segmented_button_callback(unit, dminLabel, dmaxLabel, drateLabel):
 # or whatever element of the row that will need to be updated with value
 
 ao_label_objects = dict() # key:value = "SPT":[<label obj>,dd1,dd2,dd3] where ddx are labels of start, stop, and rate boxes
-for name, ch_entry in my_channel_entries.channels.items():
-    if ch_entry.sig_type.lower() != "ao" or not ch_entry.showOnGUI:
-        continue
+def build_ao_row(name, ch_entry):
     frame = ctk.CTkFrame(scrollable_frame)
     frame.pack(pady=5, fill='x')
 
@@ -317,9 +298,14 @@ for name, ch_entry in my_channel_entries.channels.items():
     lastSentLabel.grid(row=0, column=5, padx=5, sticky="e")
     ao_label_objects[name] = lastSentLabel
 
+for name, ch_entry in my_channel_entries.channels.items():
+    if ch_entry.sig_type.lower() != "ao" or not ch_entry.showOnGUI:
+        continue
+    pane_builders.append(lambda n=name, c=ch_entry: build_ao_row(n, c))
+
 def toggleDOswitch(name:str, ctkSwitch):
     val = ctkSwitch.get() # should be an integer already
-    success, errorString = SSM.place_single_EngineeringUnits(ch2send=my_channel_entries.getChannelEntry(sigName=name), val_in_eng_units=int(val), time=time.time())
+    success, errorString = controller.set_digital(name, int(val))
     if success:
         ctkSwitch.configure(state="disabled") # wait for a response from RPi to enable again
     else:
@@ -330,17 +316,19 @@ do_switches = dict() # like name:<switch obj>
 ctk.CTkLabel(digital_outputs_frame, text="Digital Outputs", font=("Arial", 16)).pack(pady=10)
 
 
-for name, ch_entry in my_channel_entries.channels.items():
-
-    if ch_entry.sig_type.lower() != "do" or not ch_entry.showOnGUI:
-        continue
-
+def build_do_switch(name, ch_entry):
     motor_status_switch = ctk.CTkSwitch(digital_outputs_frame, text=ch_entry.name, onvalue=1, offvalue=0)
     motor_status_switch.configure(command = lambda n=name, switchObj=motor_status_switch: toggleDOswitch(n, switchObj))
     motor_status_switch.pack(side="left", padx=10, expand=True)
     motor_status_switch.select()
     do_switches[name] = motor_status_switch
 
+for name, ch_entry in my_channel_entries.channels.items():
+
+    if ch_entry.sig_type.lower() != "do" or not ch_entry.showOnGUI:
+        continue
+    pane_builders.append(lambda n=name, c=ch_entry: build_do_switch(n, c))
+
 # Digital Inputs
 def toggle_light():
     indicator_light.configure(fg_color="green" if motor_status_switch.get() else "gray")
@@ -348,11 +336,7 @@ def toggle_light():
 di_label_objects = dict() # key:value = "AOP":<label obj>. Change the fg_color
 ctk.CTkLabel(digital_inputs_frame, text="Digital Inputs", font=("Arial", 16)).pack(pady=10)
 
-for name, ch_entry in my_channel_entries.channels.items():
-
-    if ch_entry.sig_type.lower() != "di" or not ch_entry.showOnGUI:
-        continue
-
+def build_di_indicator(name, ch_entry):
     indicator_frame = ctk.CTkFrame(digital_inputs_frame)
     indicator_frame.pack(pady=10, padx=20, side="left", expand=True)
     indicator_label = ctk.CTkLabel(indicator_frame, text=ch_entry.name)
@@ -361,6 +345,13 @@ for name, ch_entry in my_channel_entries.channels.items():
     di_label_objects[name] = indicator_light
     indicator_light.pack(side="left")
 
+for name, ch_entry in my_channel_entries.channels.items():
+
+    if ch_entry.sig_type.lower() != "di" or not ch_entry.showOnGUI:
+        continue
+    pane_builders.append(lambda n=name, c=ch_entry: build_di_indicator(n, c))
+pane_builders.extend(ai_meter_builders)
+
 def pop_error():
     if len(error_stack) == 0:
         show_error("")
@@ -393,9 +384,10 @@ def show_error(message:str):
 # Function to write connector_frame with network status
 def show_connection_status(online:bool|None, message:str=""):
     if online is None:
-        status_label.configure(text="Unknown")
+        status_label.configure(text=f"Unknown{message}")
         status_label.configure(text_color="gray")
-        
+        return
+
     if online:
         status_label.configure(text=f"Connected ✓{message}")
         status_label.configure(text_color="green")
@@ -403,104 +395,110 @@ def show_connection_status(online:bool|None, message:str=""):
         status_label.configure(text=f"No Connection ❌{message}")
         status_label.configure(text_color="red")
 
+# Function to write connector_frame from a HeartbeatMonitor health snapshot
+def show_link_health(health:dict):
+    if health["state"] == "unknown":
+        show_connection_status(online=None)
+    elif health["state"] == "offline":
+        show_connection_status(online=False, message=f"\n{health['consecutive_misses']} heartbeats lost")
+    else:
+        show_connection_status(online=True, message=f"\nRTT {health['rtt_mean_ms']:.0f} ms, jitter {health['jitter_ms']:.1f} ms, loss {health['loss']:.0%}")
+        if health["state"] == "degraded":
+            status_label.configure(text_color="orange")
     
 
 # we have to call these on startup for them to initialize their frames
 show_error(message="")
 show_connection_status(online=None)
     
-def process_queue():
-    while not socketRespQueue.empty():
-        sockResp = socketRespQueue.get() # could be a dataEntry or an errorEntry
-        
-        if enable_verbose_logging:
-            print(f"sockResp is {sockResp}")
+# the view's side of the controller: these are called from `process_queue`, i.e. on the Tk thread
+def on_value(chEntry, value, raw_val):
+    if enable_verbose_logging:
+        print(f"[on_value] {chEntry.name} = {value} ({raw_val})")
+    if chEntry.sig_type.lower() == "ai":
+        meterObj = ai_meter_objects.get(chEntry.name)
+        if meterObj is not None and value != "NAK": # None if its pane hasn't been built yet (see `build_panes`)
+            meterObj.set(value) # move needle on meter
+    elif chEntry.sig_type.lower() == "di":
+        labelObj = di_label_objects.get(chEntry.name)
+        if labelObj is None:
+            return
+        if isinstance(value, dict): # pulse counter reading
+            labelObj.configure(fg_color = "green" if value["level"] == 1 else "gray", text = f"{value['freq_hz']:.1f} Hz")
+        else:
+            labelObj.configure(fg_color = "green" if value == 1 else "gray")
+    elif chEntry.sig_type.lower() == "do":
+        # then the response is ack from RPI
+        switchObj = do_switches.get(chEntry.name)
+        if switchObj is not None:
+            switchObj.configure(state="normal") # make togglable again after receive confirmation of execution
+    elif "ao" in chEntry.sig_type.lower():
+        # then the response is ack from RPI
+        labelObj = ao_label_objects.get(chEntry.name)
+        if labelObj is None:
+            return
+        # the dataEntry packet response might have NAK for the value if the ao module has a loop error
+        if raw_val == "NAK":
+            labelObj.configure(text="ERR")
+        else:
+            # update label to indicate receiving of ACK echo from RPi
+            labelObj.configure(text=f"{raw_val:.{1}f} mA")
 
-        if isinstance(sockResp, errorEntry):
-            if sockResp.source.lower()[0] == "a": # only analog signals throw errors
-                gpio_str = sockResp.description.split(":")[1].strip() # description is in form: Loop error detected:{gpio_str}
-                chEntry_to_blame = my_channel_entries.get_channelEntry_from_GPIOstr(gpio_str)
-                
-                if "Encountered unexpected exception" in sockResp.description:
-                    show_error(message=f"Encountered unexpected exception for {chEntry_to_blame.name} at board slot {chEntry_to_blame.boardSlotPosition}")
-
-                if "SPI communication error detected" in sockResp.description:
-                    # reasons why this error might be raised:
-                    # analog output transmitter: dac_res register contents is not 7 like it always should be
-                    # analog input receiver: if readings from the analog input modules are completely zero
-                    # i.e. show no noise. This symptom is indicative of a failed SPI communication.
-                    errMessage = sockResp.description.split(":")[0]
-                    show_error(message=f"{errMessage} for {chEntry_to_blame.name} at board slot {chEntry_to_blame.boardSlotPosition}")
-
-            elif "ethernet" in sockResp.source.lower():
-                show_connection_status(online=False)
-                show_error(message=sockResp.description)
-
-            else:
-                show_error(message=sockResp.description)
-                print(f"received error entry: {sockResp}")
-            
-        elif isinstance(sockResp, dataEntry):
-            show_connection_status(online=True)
-        
-            chEntry = my_channel_entries.get_channelEntry_from_GPIOstr(sockResp.gpio_str)
-            if chEntry is None:
-                if sockResp.gpio_str == "ack":
-                    print("received ack packet")
-                continue
-
-            if chEntry.sig_type.lower() == "ai":
-                meterObj = ai_meter_objects[chEntry.name]
-                meterObj.set(chEntry.mA_to_EngineeringUnits(sockResp.val)) # move needle on meter
-            elif chEntry.sig_type.lower() == "di":
-                if int(sockResp.val) == 1:
-                    di_label_objects[chEntry.name].configure(fg_color = "green")
-                else:
-                    di_label_objects[chEntry.name].configure(fg_color = "gray")
-            elif chEntry.sig_type.lower() == "do":
-                # then the response is ack from RPI
-                do_switches[chEntry.name].configure(state="normal") # make togglable again
-                # after receive confirmation of execution
-                # print("empty branch for do")
-            elif "ao" in chEntry.sig_type.lower(): # response is like "ao ack"
-                # then the response is ack from RPI
-                # print(f"chEntry.sig_type is {chEntry.sig_type.lower()}")
-                labelObj = ao_label_objects.get(chEntry.name)
-                # the dataEntry packet response might have NAK for the value if the ao module has a loop error
-                if sockResp.val == "NAK":
-                    labelObj.configure(text="ERR")
-                else:
-                    # update label to indicate receiving of ACK echo from RPi
-                    labelObj.configure(text=f"{sockResp.val:.{1}f} mA")
+def on_error(message, err):
+    show_error(message=message)
+    if enable_verbose_logging:
+        print(f"received error entry: {err}")
+
+controller.valueListeners.append(on_value)
+controller.errorListeners.append(on_error)
+controller.connectionListeners.append(lambda online: show_connection_status(online=online))
+
+def process_queue():
+    controller.process_responses()
                 
+    ## the heartbeat monitor (if enabled) has the most current picture of the link, so let it have the last word
+    health = controller.get_link_health()
+    if health is not None:
+        show_link_health(health)
 
-    ## finally, place read periodic read requests for ai and di channels
-    ## ai channels first
-    for name,meter in ai_meter_objects.items():
-        # only the ch2send name is important. value can be whatever
-        ch = my_channel_entries.getChannelEntry(name)
-        if ch.getGPIOStr() is None:
-            pass # print("invalid gpio config?")
-        else:
-            # using place_single_mA instead of place_single_EngineeringUnits
-            # because the mA_val is interpreted for `ai` channels only as the number of samples to take
-            # in the averaging filter
-            SSM.place_single_mA(ch2send=ch, mA_val=ai_LPF_boxcar_length, time=time.time())
-            
-    ## this di placer has the same problem with unmapped gpios, so I've commented it out until i fix the ai ^^
-    for name,label_obj in di_label_objects.items():
-        try:
-            success, errString = SSM.place_single_EngineeringUnits(ch2send=my_channel_entries.getChannelEntry(name), val_in_eng_units=0, time=time.time())
-            if not success:
-                show_error(errString)
-        except Exception as e:
-            print(f"Encountered error: {e}")
+    ## finally, place periodic read requests for the ai and di channels on screen
+    for errString in controller.poll_inputs(list(ai_meter_objects.keys()) + list(di_label_objects.keys())):
+        show_error(errString)
 
     app.after(poll_buffer_period_ms, process_queue)  # Check queue again after specified period
 
+def print_startup_report():
+    total = sum(seconds for _, seconds in _startup_phases)
+    lines = [f"  {phase:<28}{seconds*1000:8.1f} ms" for phase, seconds in _startup_phases]
+    report = "Startup timing:\n" + "\n".join(lines) + f"\n  {'total':<28}{total*1000:8.1f} ms"
+    print(report)
+    logging.info(report)
+
+def build_panes():
+    # runs once the main loop has started, i.e. once the window is on screen. In lazy mode, one channel's widgets
+    # are built per idle callback so that the window stays responsive while the panes fill in
+    mark_startup_phase("build window and show it")
+    if lazy_gui_build:
+        app.after_idle(build_next_pane)
+        return
+    for builder in pane_builders:
+        builder()
+    pane_builders.clear()
+    build_next_pane()
+
+def build_next_pane():
+    if len(pane_builders) > 0:
+        pane_builders.pop(0)()
+    if len(pane_builders) > 0:
+        app.after_idle(build_next_pane)
+        return
+    mark_startup_phase("build panes")
+    print_startup_report()
+
 # print("after defined process_queue")
+app.after(0, func=build_panes)
 app.after(0, func=process_queue)
-SSM.loopDelay=0.1
+controller.ssm.loopDelay=0.1
 # print(f"for tkinter file: {threading.current_thread()}")
 
 app.mainloop()